@@ -36,6 +36,11 @@ CORS_ALLOW_HEADERS = [
     "accept",
     "accept-encoding",
     "authorization",
+    "x-assignment-token",
+]
+
+CORS_EXPOSE_HEADERS = [
+    "x-assignment-token",
 ]
 
 CORS_ALLOW_METHODS = [
@@ -82,6 +87,7 @@ AUTH_USER_MODEL = "experiments.AdminUser"
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'experiments.compression.LibraryCompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -127,6 +133,111 @@ CACHES = {
     }
 }
 
+# Seconds a worker keeps its compiled snapshot of a project's running experiments
+EXPERIMENT_SNAPSHOT_TTL = int(os.environ.get('EXPERIMENT_SNAPSHOT_TTL', '30'))
+
+# Number of distributions read, bucketed and written per batch when recalculating
+RECALCULATION_CHUNK_SIZE = int(os.environ.get('RECALCULATION_CHUNK_SIZE', '5000'))
+
+# How distributions are recalculated: "bulk" (batched in Python) or "sql" (inside PostgreSQL)
+RECALCULATION_MODE = os.environ.get('RECALCULATION_MODE', 'bulk')
+
+# Run recalculations triggered by variant changes in the background worker (manage.py run_recalculation_worker)
+RECALCULATION_ASYNC = os.environ.get('RECALCULATION_ASYNC', 'True') == 'True'
+# Seconds to wait for further variant edits before a queued recalculation runs
+RECALCULATION_DEBOUNCE_SECONDS = float(os.environ.get('RECALCULATION_DEBOUNCE_SECONDS', '5'))
+# Seconds after which a running recalculation is considered abandoned
+RECALCULATION_JOB_TIMEOUT = int(os.environ.get('RECALCULATION_JOB_TIMEOUT', '3600'))
+
+# Buffer ProjectUser last_seen and device metadata updates and write them in batches
+USER_ACTIVITY_BUFFER = os.environ.get('USER_ACTIVITY_BUFFER', 'True') == 'True'
+# Seconds between batched writes, i.e. how stale last_seen and metadata may be
+USER_ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('USER_ACTIVITY_FLUSH_INTERVAL', '5'))
+# Rows per UPDATE when flushing, also the buffered users that trigger an early flush,
+# and buffered users beyond which the updates of the first ones are dropped
+USER_ACTIVITY_BATCH_SIZE = int(os.environ.get('USER_ACTIVITY_BATCH_SIZE', '1000'))
+USER_ACTIVITY_MAX_PENDING = int(os.environ.get('USER_ACTIVITY_MAX_PENDING', '10000'))
+
+# Serve the library endpoints with the async views instead of the DRF views
+LIBRARY_ASYNC_VIEWS = os.environ.get('LIBRARY_ASYNC_VIEWS', 'True') == 'True'
+
+# Maximum number of users evaluated by one batch evaluation request
+BATCH_EVALUATION_MAX_USERS = int(os.environ.get('BATCH_EVALUATION_MAX_USERS', '1000'))
+
+# How clients learn about reassignments after a recalculation: "config" sends one
+# config_changed message per project, "user" also notifies every moved user
+DISTRIBUTION_PUSH_MODE = os.environ.get('DISTRIBUTION_PUSH_MODE', 'config')
+
+# Serve assignments from Redis hashes and write new ones behind to the database,
+# needs django_redis as the default cache. Unchanged hashes expire after ASSIGNMENT_STORE_TTL seconds
+ASSIGNMENT_STORE = os.environ.get('ASSIGNMENT_STORE', 'False') == 'True'
+ASSIGNMENT_STORE_TTL = int(os.environ.get('ASSIGNMENT_STORE_TTL', str(7 * 24 * 60 * 60)))
+
+# Seconds between batched writes of the first assignments of deferred experiments,
+# and buffered assignments that trigger an early write
+ASSIGNMENT_FLUSH_INTERVAL = float(os.environ.get('ASSIGNMENT_FLUSH_INTERVAL', '1'))
+ASSIGNMENT_MAX_PENDING = int(os.environ.get('ASSIGNMENT_MAX_PENDING', '10000'))
+
+# Library responses larger than this many bytes are compressed with brotli or gzip
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', '1024'))
+
+# Seconds an assignment token returned by the library endpoints is accepted
+ASSIGNMENT_TOKEN_MAX_AGE = int(os.environ.get('ASSIGNMENT_TOKEN_MAX_AGE', str(24 * 60 * 60)))
+
+# Database circuit breaker of the library endpoints: it opens after DB_BREAKER_FAILURE_THRESHOLD
+# failed calls, or calls slower than DB_BREAKER_SLOW_CALL_SECONDS, within DB_BREAKER_WINDOW_SECONDS,
+# and lets a call through again after DB_BREAKER_RESET_SECONDS
+DB_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('DB_BREAKER_FAILURE_THRESHOLD', '5'))
+DB_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('DB_BREAKER_SLOW_CALL_SECONDS', '1'))
+DB_BREAKER_WINDOW_SECONDS = float(os.environ.get('DB_BREAKER_WINDOW_SECONDS', '10'))
+DB_BREAKER_RESET_SECONDS = float(os.environ.get('DB_BREAKER_RESET_SECONDS', '5'))
+
+# Degraded responses while the database is unavailable: users remembered per worker to hash
+# them with their id, skipped writes kept per worker, and seconds between attempts to backfill them
+DEGRADED_USER_CACHE_SIZE = int(os.environ.get('DEGRADED_USER_CACHE_SIZE', '10000'))
+DEGRADED_MAX_SKIPPED_WRITES = int(os.environ.get('DEGRADED_MAX_SKIPPED_WRITES', '10000'))
+DEGRADED_BACKFILL_INTERVAL = float(os.environ.get('DEGRADED_BACKFILL_INTERVAL', '5'))
+
+# Buffer library events and write them in batches (COPY on PostgreSQL)
+EVENT_BUFFER = os.environ.get('EVENT_BUFFER', 'True') == 'True'
+# Seconds between batched event writes, and buffered events beyond which the oldest are dropped
+EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL', '1'))
+EVENT_MAX_PENDING = int(os.environ.get('EVENT_MAX_PENDING', '50000'))
+# Events per write, a full batch triggers an early write
+EVENT_BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', '5000'))
+# Failed writes of a batch before its events are written one by one and the failing ones dropped
+EVENT_MAX_FLUSH_ATTEMPTS = int(os.environ.get('EVENT_MAX_FLUSH_ATTEMPTS', '5'))
+# Maximum number of events sent in one request
+EVENT_BATCH_MAX_EVENTS = int(os.environ.get('EVENT_BATCH_MAX_EVENTS', '1000'))
+# Seconds an event timestamp may lie in the past, and in the future
+EVENT_TIMESTAMP_MAX_AGE = int(os.environ.get('EVENT_TIMESTAMP_MAX_AGE', str(7 * 24 * 60 * 60)))
+EVENT_TIMESTAMP_MAX_SKEW = int(os.environ.get('EVENT_TIMESTAMP_MAX_SKEW', str(60 * 60)))
+
+# Seconds an experiment analysis is cached, new events and enrollments invalidate it earlier
+ANALYSIS_CACHE_TTL = int(os.environ.get('ANALYSIS_CACHE_TTL', '3600'))
+
+# Sample ratio mismatch checks: p-value below which a split is flagged, users needed
+# before flagging, and days of check history kept
+SRM_P_VALUE_THRESHOLD = float(os.environ.get('SRM_P_VALUE_THRESHOLD', '0.001'))
+SRM_MIN_SAMPLE = int(os.environ.get('SRM_MIN_SAMPLE', '100'))
+SRM_HISTORY_DAYS = int(os.environ.get('SRM_HISTORY_DAYS', '30'))
+
+# Number of rows read per database round trip by the streaming exports
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', '2000'))
+
+# Seconds a worker caches the project of an API key, and of an unknown API key
+API_KEY_CACHE_TTL = int(os.environ.get('API_KEY_CACHE_TTL', '60'))
+API_KEY_CACHE_NEGATIVE_TTL = int(os.environ.get('API_KEY_CACHE_NEGATIVE_TTL', '30'))
+
+# Seconds between checks of a worker for API keys invalidated by other workers,
+# a revoked key is accepted for at most this long
+API_KEY_CACHE_SYNC_INTERVAL = float(os.environ.get('API_KEY_CACHE_SYNC_INTERVAL', '1'))
+
+# Maximum number of API keys cached per worker
+API_KEY_CACHE_SIZE = int(os.environ.get('API_KEY_CACHE_SIZE', '1024'))
+
+# Share cached API key lookups between workers through the default cache (Redis)
+API_KEY_CACHE_REDIS = os.environ.get('API_KEY_CACHE_REDIS', 'True') == 'True'
 
 CHANNEL_LAYERS = {
     "default": {
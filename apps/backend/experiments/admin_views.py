@@ -2,6 +2,7 @@ import secrets
 
 from django.db import transaction
 from django.db.models import Sum
+from django.utils.text import slugify
 from rest_framework import viewsets, status
 from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
@@ -9,18 +10,32 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
-from experiments.models import Project, Experiment, Variant, ProjectUser, Distribution
+from experiments.models import Project, Experiment, Variant, ProjectUser, Distribution, RecalculationJob
 from experiments.serializers import (
     ProjectSerializer,
     ExperimentSerializer,
     VariantSerializer,
     ProjectUserSerializer,
-    DistributionSerializer, BulkVariantUpdateSerializer,
-)
-from experiments.services.variant_service import (
-    calculate_distribution_stats,
-    recalculate_experiment_distributions
+    DistributionSerializer, BulkVariantUpdateSerializer, RecalculationJobSerializer,
+    SampleRatioCheckSerializer,
 )
+from experiments.services.allocation_service import preview_rollout_change
+from experiments.services.analysis_service import get_experiment_analysis
+from experiments.services.api_key_service import invalidate_api_key
+from experiments.services.export_service import streaming_export
+from experiments.services.recalculation_service import recalculate_experiment_distributions
+from experiments.services.srm_service import get_srm_history
+from experiments.services.variant_service import calculate_distribution_stats
+
+
+# Columns of the streaming exports
+USER_EXPORT_FIELDS = [
+    'id', 'device_id', 'email', 'external_id', 'first_seen', 'last_seen',
+    'latest_current_url', 'latest_os', 'latest_os_version', 'latest_device_type', 'properties'
+]
+DISTRIBUTION_EXPORT_FIELDS = [
+    'id', 'user_id', 'experiment_id', 'variant_id', 'variant__key', 'created_at', 'updated_at'
+]
 
 
 class AdminViewSetMixin:
@@ -66,10 +81,32 @@ class AdminProjectViewSet(AdminViewSetMixin, viewsets.ModelViewSet):
     def regenerate_api_key(self, request, pk=None):
         """Regenerate the API key for a specific project."""
         project = self.get_object()
+        old_api_key = project.api_key
         project.api_key = secrets.token_hex(16)
         project.save(update_fields=['api_key'])
+        # The project signals only know the new key, so drop the old one from the shared cache
+        transaction.on_commit(lambda: invalidate_api_key(old_api_key))
         return Response({'api_key': project.api_key}, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['get'])
+    def export_users(self, request, pk=None):
+        """
+        Stream all users of a project as NDJSON (default) or CSV.
+        The format is chosen with the export_format query parameter.
+        """
+        project = self.get_object()
+
+        try:
+            return streaming_export(
+                request,
+                ProjectUser.objects.filter(project=project).order_by(),
+                USER_EXPORT_FIELDS,
+                request.query_params.get('export_format', 'ndjson'),
+                f"{slugify(project.title) or project.id}-users"
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
 
 class AdminExperimentViewSet(AdminViewSetMixin, viewsets.ModelViewSet):
     """
@@ -103,16 +140,65 @@ class AdminExperimentViewSet(AdminViewSetMixin, viewsets.ModelViewSet):
 
     @action(detail=True, methods=['get'])
     def stats(self, request, pk=None):
-        """Get distribution statistics for an experiment."""
+        """
+        Get distribution statistics for an experiment, with its latest sample ratio
+        mismatch checks. The number of checks is set with the srm_history query parameter.
+        """
         experiment = self.get_object()
+
+        try:
+            history_limit = min(max(int(request.query_params.get('srm_history', 20)), 1), 1000)
+        except ValueError:
+            return Response({"error": "srm_history must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
         stats = calculate_distribution_stats(experiment)
+        checks = SampleRatioCheckSerializer(get_srm_history(experiment, history_limit), many=True).data
         return Response({
             'experiment': {
                 'id': str(experiment.id),
                 'key': experiment.key,
                 'name': experiment.name
             },
-            'stats': stats
+            'stats': stats,
+            'srm': {
+                'latest': checks[0] if checks else None,
+                'history': checks
+            }
+        })
+
+    @action(detail=True, methods=['get'])
+    def analysis(self, request, pk=None):
+        """
+        Compare the variants of an experiment over an event metric.
+
+        Query parameters: metric (event name, required), aggregation ("sum", "count"
+        or "conversion"), control (variant key), confidence and cuped ("true" or "false").
+        """
+        experiment = self.get_object()
+
+        metric = request.query_params.get('metric')
+        if not metric:
+            return Response({"error": "The metric query parameter is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            analysis = get_experiment_analysis(
+                experiment,
+                metric=metric,
+                aggregation=request.query_params.get('aggregation', 'sum'),
+                control_key=request.query_params.get('control'),
+                confidence=float(request.query_params.get('confidence', 0.95)),
+                cuped=request.query_params.get('cuped', 'true').lower() != 'false'
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'experiment': {
+                'id': str(experiment.id),
+                'key': experiment.key,
+                'name': experiment.name
+            },
+            'analysis': analysis
         })
 
     @action(detail=True, methods=['post'])
@@ -120,8 +206,11 @@ class AdminExperimentViewSet(AdminViewSetMixin, viewsets.ModelViewSet):
         """Trigger recalculation of variant distributions for an experiment."""
         experiment = self.get_object()
 
-        # Perform recalculation
-        changes_count = recalculate_experiment_distributions(experiment)
+        # Perform recalculation, optionally with an explicit engine ("bulk" or "sql")
+        try:
+            changes_count = recalculate_experiment_distributions(experiment, mode=request.data.get('mode'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         # Get updated stats
         stats = calculate_distribution_stats(experiment)
@@ -136,6 +225,59 @@ class AdminExperimentViewSet(AdminViewSetMixin, viewsets.ModelViewSet):
             'stats': stats
         })
 
+    @action(detail=True, methods=['post'])
+    def allocation_preview(self, request, pk=None):
+        """
+        Estimate how many users a rollout change would move, without applying it.
+        Accepts the same payload as bulk_update_variants.
+        """
+        experiment = self.get_object()
+
+        serializer = BulkVariantUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        rollouts = {
+            str(variant_data['id']): float(variant_data['rollout'])
+            for variant_data in serializer.validated_data['variants']
+            if variant_data.get('rollout') is not None
+        }
+
+        return Response({
+            'experiment': {
+                'id': str(experiment.id),
+                'key': experiment.key,
+                'name': experiment.name
+            },
+            'preview': preview_rollout_change(experiment, rollouts)
+        })
+
+    @action(detail=True, methods=['get'])
+    def recalculations(self, request, pk=None):
+        """Get the queued, running and most recent recalculations of an experiment."""
+        experiment = self.get_object()
+        jobs = RecalculationJob.objects.filter(experiment=experiment).order_by('-created_at')[:10]
+        return Response(RecalculationJobSerializer(jobs, many=True).data)
+
+    @action(detail=True, methods=['get'])
+    def export_distributions(self, request, pk=None):
+        """
+        Stream all distributions of an experiment as NDJSON (default) or CSV.
+        The format is chosen with the export_format query parameter.
+        """
+        experiment = self.get_object()
+
+        try:
+            return streaming_export(
+                request,
+                Distribution.objects.filter(experiment=experiment).order_by(),
+                DISTRIBUTION_EXPORT_FIELDS,
+                request.query_params.get('export_format', 'ndjson'),
+                f"{experiment.key}-distributions"
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
     @action(detail=True, methods=['post'])
     def bulk_update_variants(self, request, pk=None):
         """
@@ -0,0 +1,343 @@
+"""
+Async versions of the library views, served natively on the ASGI stack.
+
+They behave like the DRF views in library_views, including the response formats,
+but use the async ORM and cache, so a worker is not limited by its thread pool.
+Paths that need transactions (creating or merging users) still run in a thread.
+The DRF views stay available as a fallback, see LIBRARY_ASYNC_VIEWS.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from experiments.library_views import (
+    DATABASE_UNAVAILABLE,
+    DEGRADED_HEADERS,
+    degraded_response_data,
+    query_params_key,
+    token_user,
+    token_variants,
+    user_assignment_token,
+    user_experiments_data
+)
+from experiments.models import Experiment, ProjectUser
+from experiments.renderers import MSGPACK_MEDIA_TYPE, MessagePackRenderer, accepts_msgpack, pack_response
+from experiments.serializers import (
+    UserIdentifierSerializer,
+    ExperimentVariantResponseSerializer,
+    UserResponseSerializer,
+    EventBatchSerializer
+)
+from experiments.services.api_key_service import aget_project_by_api_key
+from experiments.services.assignment_store import is_store_enabled
+from experiments.services.assignment_token import ASSIGNMENT_TOKEN_HEADER, amatch_assignment_token
+from experiments.services.bucketing import compile_experiment
+from experiments.services.circuit_breaker import CONNECTION_ERRORS, CircuitOpenError, database_breaker
+from experiments.services.degraded_service import remember_user
+from experiments.services.event_service import ingest_events
+from experiments.services.experiment_cache import aget_project_snapshot
+from experiments.services.user_activity_service import arecord_user_seen
+from experiments.services.variant_service import (
+    aget_or_create_user,
+    aget_or_create_distributions,
+    aget_or_assign_variant
+)
+from experiments.services.version_service import (
+    experiments_etag,
+    aget_config_version,
+    aget_user_version,
+    amatch_experiments_etag
+)
+
+
+class AsyncLibraryView(View):
+    """
+    Base class for async library views.
+    Authenticates by API key like APIKeyAuthentication and ProjectAuthMiddleware,
+    and responds with MessagePack to clients that ask for it like MessagePackRenderer.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Authenticated by API key rather than session, like DRF views
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        api_key = request.headers.get('X-API-KEY') or request.GET.get('api_key')
+        if api_key and await aget_project_by_api_key(api_key) is None:
+            return JsonResponse({'detail': 'Invalid API key'}, status=401, headers={'WWW-Authenticate': 'ApiKey'})
+
+        # Set by the ProjectAuthMiddleware
+        if getattr(request, 'project', None) is None:
+            return JsonResponse({'detail': 'Project not found'}, status=404)
+
+        return await super().dispatch(request, *args, **kwargs)
+
+    def get_representation(self):
+        """The format of the response when it is not JSON, which ETags are specific to."""
+        if accepts_msgpack(self.request.headers.get('Accept')):
+            return MessagePackRenderer.format
+        return None
+
+    def render(self, data, status=200, headers=None) -> HttpResponse:
+        """
+        Respond with JSON, or with compact MessagePack if the client prefers it (see renderers).
+        """
+        if self.get_representation() == MessagePackRenderer.format:
+            response = HttpResponse(pack_response(data), content_type=MSGPACK_MEDIA_TYPE, status=status, headers=headers)
+        else:
+            response = JsonResponse(data, status=status, headers=headers)
+        # The format depends on the Accept header
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+    async def degraded_response(self, project, user_data, experiment_key=None) -> HttpResponse:
+        """
+        Serve variants computed without the database, see degraded_response_data.
+        Stored variants are read from the assignment store in a thread.
+        """
+        if is_store_enabled():
+            data = await sync_to_async(degraded_response_data)(project, user_data, experiment_key)
+        else:
+            data = degraded_response_data(project, user_data, experiment_key)
+
+        if data is None:
+            return self.render(DATABASE_UNAVAILABLE, status=503)
+        return self.render(data, headers=DEGRADED_HEADERS)
+
+    def parse_body(self, request):
+        """
+        Parse a JSON or form request body, returning an error response if the JSON is invalid.
+        """
+        if request.content_type == 'application/json':
+            try:
+                return json.loads(request.body or b'{}')
+            except ValueError as e:
+                return self.render({'detail': f"JSON parse error - {e}"}, status=400)
+        return request.POST
+
+
+class AsyncExperimentVariantView(AsyncLibraryView):
+    """
+    Async version of ExperimentVariantAPIView.
+    """
+
+    async def get(self, request, experiment_key):
+        """Get the variant for a user in an experiment."""
+        project = request.project
+
+        # Validate user identification data
+        user_serializer = UserIdentifierSerializer(data=request.GET)
+        if not user_serializer.is_valid():
+            return self.render(user_serializer.errors, status=400)
+
+        user_data = user_serializer.validated_data
+
+        try:
+            # Answer from a current assignment token and the cached snapshot, without the database
+            assignment_token = request.headers.get(ASSIGNMENT_TOKEN_HEADER)
+            if assignment_token:
+                params = query_params_key(request.GET)
+                token = await amatch_assignment_token(project.id, params, assignment_token)
+                experiment = token and (await aget_project_snapshot(project.id, token.config_version)).get(experiment_key)
+                variants = experiment and token_variants(token, [experiment])
+                if variants:
+                    await arecord_user_seen(token.user_id)
+                    serializer = ExperimentVariantResponseSerializer({
+                        'experiment': experiment,
+                        'variant': variants[(token.user_id, experiment.id)]
+                    })
+                    return self.render(serializer.data)
+
+            # Database work goes through the breaker, which fails fast while the database is down
+            with database_breaker.guard():
+                # Find the experiment in the cached snapshot of running experiments
+                experiment = (await aget_project_snapshot(project.id)).get(experiment_key)
+
+                if experiment is None:
+                    # Not cached, look it up to report why
+                    stored_experiment = await Experiment.objects.filter(
+                        project=project,
+                        key=experiment_key
+                    ).prefetch_related('variants').afirst()
+                    if not stored_experiment:
+                        return self.render({"error": f"Experiment '{experiment_key}' not found"}, status=404)
+
+                    # Ensure experiment is running
+                    if stored_experiment.status != "running":
+                        return self.render({
+                            "error": "Experiment is not running",
+                            "status": stored_experiment.status
+                        }, status=400)
+
+                    # Started after the snapshot was built
+                    experiment = compile_experiment(stored_experiment)
+
+                user = await aget_or_create_user(project, user_data)
+                variant = await aget_or_assign_variant(user, experiment)
+
+            remember_user(project.id, user_data, user.id)
+
+            serializer = ExperimentVariantResponseSerializer({'experiment': experiment, 'variant': variant})
+            return self.render(serializer.data)
+
+        except (CircuitOpenError, *CONNECTION_ERRORS):
+            return await self.degraded_response(project, user_data, experiment_key)
+
+        except ProjectUser.DoesNotExist as e:
+            return self.render({"error": str(e)}, status=404)
+        except Exception as e:
+            return self.render({"error": str(e)}, status=500)
+
+
+class AsyncUserIdentifyView(AsyncLibraryView):
+    """
+    Async version of UserIdentifyAPIView.
+    """
+
+    async def post(self, request):
+        """
+        Identify a user based on provided identifiers.
+        At least one of device_id, email, or external_id must be provided.
+        """
+        project = request.project
+
+        data = self.parse_body(request)
+        if isinstance(data, HttpResponse):
+            return data
+
+        # Validate user identification data
+        user_serializer = UserIdentifierSerializer(data=data)
+        if not user_serializer.is_valid():
+            return self.render(user_serializer.errors, status=400)
+
+        try:
+            user = await aget_or_create_user(project, user_serializer.validated_data)
+            return self.render(UserResponseSerializer(user).data)
+
+        except ProjectUser.DoesNotExist as e:
+            return self.render({"error": str(e)}, status=404)
+        except Exception as e:
+            return self.render({"error": str(e)}, status=500)
+
+
+class AsyncUserExperimentsView(AsyncLibraryView):
+    """
+    Async version of UserExperimentsAPIView, including conditional requests and assignment tokens.
+    """
+
+    async def get(self, request):
+        """Get all experiments and variants for a user."""
+        project = request.project
+        params = query_params_key(request.GET)
+        representation = self.get_representation()
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            match = await amatch_experiments_etag(project.id, params, if_none_match, representation)
+            if match is not None:
+                etag, user_id = match
+                # Still count the poll as activity, without loading the user
+                await arecord_user_seen(user_id)
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                patch_vary_headers(response, ('Accept',))
+                return response
+
+        # Validate user identification data
+        user_serializer = UserIdentifierSerializer(data=request.GET)
+        if not user_serializer.is_valid():
+            return self.render(user_serializer.errors, status=400)
+
+        user_data = user_serializer.validated_data
+
+        try:
+            # Answer from a current assignment token and the cached snapshot, without the database
+            assignment_token = request.headers.get(ASSIGNMENT_TOKEN_HEADER)
+            token = assignment_token and await amatch_assignment_token(project.id, params, assignment_token)
+            if token:
+                snapshot = await aget_project_snapshot(project.id, token.config_version)
+                running_experiments = list(snapshot.experiments.values())
+                variants = token_variants(token, running_experiments)
+                if variants is not None:
+                    # Count the request as activity, without loading the user
+                    await arecord_user_seen(token.user_id)
+                    return self.render(
+                        user_experiments_data(token_user(token, user_data), running_experiments, variants),
+                        headers={
+                            'ETag': experiments_etag(
+                                project.id, token.user_id, token.config_version, token.user_version, params,
+                                representation
+                            ),
+                            ASSIGNMENT_TOKEN_HEADER: assignment_token
+                        }
+                    )
+
+            # Read the config version first, so the response is at least as new as its ETag says
+            config_version = await aget_config_version(project.id)
+
+            # Database work goes through the breaker, which fails fast while the database is down
+            with database_breaker.guard():
+                user = await aget_or_create_user(project, user_data)
+                user_version = await aget_user_version(user.id)
+
+                snapshot = await aget_project_snapshot(project.id, config_version)
+                running_experiments = list(snapshot.experiments.values())
+                variants = await aget_or_create_distributions([user], running_experiments)
+
+            remember_user(project.id, user_data, user.id)
+
+            return self.render(
+                user_experiments_data(user, running_experiments, variants),
+                headers={
+                    'ETag': experiments_etag(
+                        project.id, user.id, config_version, user_version, params, representation
+                    ),
+                    ASSIGNMENT_TOKEN_HEADER: user_assignment_token(
+                        project, params, user, running_experiments, variants, config_version, user_version
+                    )
+                }
+            )
+
+        except (CircuitOpenError, *CONNECTION_ERRORS):
+            return await self.degraded_response(project, user_data)
+
+        except ProjectUser.DoesNotExist as e:
+            return self.render({"error": str(e)}, status=404)
+        except Exception as e:
+            return self.render({"error": str(e)}, status=500)
+
+
+class AsyncEventIngestionView(AsyncLibraryView):
+    """
+    Async version of EventIngestionAPIView.
+    """
+
+    async def post(self, request):
+        """Record a batch of events."""
+        project = request.project
+
+        data = self.parse_body(request)
+        if isinstance(data, HttpResponse):
+            return data
+
+        # Validate the events
+        batch_serializer = EventBatchSerializer(data=data)
+        if not batch_serializer.is_valid():
+            return self.render(batch_serializer.errors, status=400)
+
+        try:
+            # Resolving users needs transactions, so the batch is ingested in a thread
+            result = await sync_to_async(ingest_events)(project, batch_serializer.validated_data['events'])
+            return self.render(result, status=202)
+
+        except ValueError as e:
+            return self.render({"error": str(e)}, status=400)
+        except ProjectUser.DoesNotExist as e:
+            return self.render({"error": str(e)}, status=404)
+        except Exception as e:
+            return self.render({"error": str(e)}, status=500)
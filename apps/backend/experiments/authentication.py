@@ -1,8 +1,9 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 from django.utils.translation import gettext_lazy as _
 
-from experiments.models import Project
+from experiments.services.api_key_service import aget_project_by_api_key, get_project_by_api_key
 
 
 class APIKeyAuthentication(BaseAuthentication):
@@ -20,18 +21,16 @@ class APIKeyAuthentication(BaseAuthentication):
         if not api_key:
             return None  # Authentication was not attempted
 
-        try:
-            # Try to find a project with this API key
-            project = Project.objects.get(api_key=api_key)
-
-            # Return a tuple of (None, project) to indicate successful authentication
-            # We don't return a user since this is API key auth
-            return (None, project)
-
-        except Project.DoesNotExist:
+        # Try to find a project with this API key
+        project = get_project_by_api_key(api_key)
+        if project is None:
             # Invalid API key
             raise AuthenticationFailed(_('Invalid API key'))
 
+        # Return a tuple of (None, project) to indicate successful authentication
+        # We don't return a user since this is API key auth
+        return (None, project)
+
     def authenticate_header(self, request):
         # Return the header value that should be used in the WWW-Authenticate header
         return self.keyword
@@ -42,22 +41,37 @@ class ProjectAuthMiddleware:
     Middleware to add the authenticated project to the request.
     This is needed because DRF's authentication_classes only authenticates the user,
     but we also need to know which project the API key belongs to.
+    Supports both sync and async requests, so async views are not run through a thread.
     """
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
         # Process the request before the view is called
         # The project will be set by the APIKeyAuthentication class
 
         api_key = request.headers.get('X-API-KEY')
         if api_key is not None:
-            try:
-                project = Project.objects.get(api_key=api_key)
+            project = get_project_by_api_key(api_key)
+            if project is not None:
                 request.project = project
-            except Project.DoesNotExist:
-                pass
 
         response = self.get_response(request)
         return response
+
+    async def __acall__(self, request):
+        api_key = request.headers.get('X-API-KEY')
+        if api_key is not None:
+            project = await aget_project_by_api_key(api_key)
+            if project is not None:
+                request.project = project
+
+        return await self.get_response(request)
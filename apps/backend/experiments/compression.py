@@ -0,0 +1,97 @@
+"""
+Compression of large JSON responses of the library API.
+
+Brotli is used when the client accepts it at least as much as gzip, gzip otherwise.
+MessagePack responses are already compact and are not compressed.
+"""
+from typing import Dict, Optional
+
+import brotli
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_string
+
+# Brotli quality, the default (11) is too slow to compress on every request
+BROTLI_QUALITY = 5
+
+
+def _encoding_qualities(accept_encoding: str) -> Dict[str, float]:
+    """The quality of every coding named in an Accept-Encoding header, * included."""
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+    return qualities
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick the content coding of a response: 'br' or 'gzip', whichever the client
+    accepts with the higher quality, brotli on a tie. None if it accepts neither.
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = _encoding_qualities(accept_encoding)
+    wildcard = qualities.get('*', 0.0)
+    br_quality = qualities.get('br', wildcard)
+    gzip_quality = qualities.get('gzip', wildcard)
+
+    if br_quality > 0 and br_quality >= gzip_quality:
+        return 'br'
+    if gzip_quality > 0:
+        return 'gzip'
+    return None
+
+
+class LibraryCompressionMiddleware(MiddlewareMixin):
+    """
+    Compress JSON responses of the library endpoints, i.e. of requests authenticated
+    by API key, that are larger than RESPONSE_COMPRESSION_MIN_SIZE bytes.
+    """
+
+    def process_response(self, request, response):
+        if getattr(request, 'project', None) is None:
+            return response
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if not response.get('Content-Type', '').startswith('application/json'):
+            return response
+        if len(response.content) < getattr(settings, 'RESPONSE_COMPRESSION_MIN_SIZE', 1024):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING'))
+        if encoding == 'br':
+            content = brotli.compress(response.content, quality=BROTLI_QUALITY)
+        elif encoding == 'gzip':
+            content = compress_string(response.content)
+        else:
+            return response
+
+        # Only worth it when the body gets smaller
+        if len(content) >= len(response.content):
+            return response
+
+        response.content = content
+        response.headers['Content-Length'] = str(len(content))
+        response.headers['Content-Encoding'] = encoding
+
+        # The compressed body is another representation, like GZipMiddleware
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+
+        return response
@@ -1,19 +1,27 @@
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async
 
-from experiments.models import Project
-from experiments.services.variant_service import get_experiment_by_key
+from experiments.notifications import experiment_data, variant_data
+from experiments.services.api_key_service import get_project_by_api_key
+from experiments.services.variant_service import get_or_create_user, get_user_variants
 
 
 class ExperimentConsumer(AsyncJsonWebsocketConsumer):
     """
     WebSocket consumer for real-time experiment updates.
+
+    Besides the single-experiment messages, clients can send lists of experiment keys:
+    "subscribe" and "evaluate" reply with one "experiments_state" message, and
+    "unsubscribe" leaves the experiments' groups. Connecting with batch=1 sends the
+    initial state as one "experiments_state" message instead of one message per experiment.
+    Messages with malformed experiment keys are answered with an "error" message.
     """
 
     async def connect(self):
         """
         Called when the websocket is handshaking.
         Validate API key and set up user/project info.
+        All database work of the handshake happens in a single sync-to-async call.
         """
         # Get the API key from the query string
         query_string = self.scope.get('query_string', b'').decode()
@@ -25,40 +33,39 @@ class ExperimentConsumer(AsyncJsonWebsocketConsumer):
             await self.close(code=4000)
             return
 
-        # Validate the API key and get project
-        self.project = await self.get_project(api_key)
-
-        if not self.project:
-            await self.close(code=4001)
-            return
-
         # Extract user identifiers
-        user_id = query_params.get('user_id')
-        device_id = query_params.get('device_id')
-        email = query_params.get('email')
-        external_id = query_params.get('external_id')
+        identifiers = {
+            'id': query_params.get('user_id'),
+            'device_id': query_params.get('device_id'),
+            'email': query_params.get('email'),
+            'external_id': query_params.get('external_id')
+        }
 
-        # Ensure at least one identifier is provided
-        if not any([user_id, device_id, email, external_id]):
-            await self.close(code=4002)
-            return
+        # Get experiment keys from query params or subscribe to all if none provided
+        experiment_keys = query_params.get('experiments', '').split(',')
+        experiment_keys = [key for key in experiment_keys if key]
+
+        batch = query_params.get('batch') in ('1', 'true')
+        # Channel group of every subscribed experiment, by experiment key
+        self.experiment_groups = {}
 
-        # Get or create user
+        # Validate the API key, get or create the user and evaluate the experiments
         try:
-            self.user = await self.get_user(
-                self.project,
-                user_id=user_id,
-                device_id=device_id,
-                email=email,
-                external_id=external_id
-            )
+            project, user, states = await self.handshake(api_key, identifiers, experiment_keys)
         except Exception:
             await self.close(code=4003)
             return
 
-        # Get experiment keys from query params or subscribe to all if none provided
-        experiment_keys = query_params.get('experiments', '').split(',')
-        experiment_keys = [key for key in experiment_keys if key]
+        if not project:
+            await self.close(code=4001)
+            return
+        self.project = project
+
+        # Ensure at least one identifier is provided
+        if not user:
+            await self.close(code=4002)
+            return
+        self.user = user
 
         # Set up channels for user-specific updates
         await self.channel_layer.group_add(
@@ -67,14 +74,7 @@ class ExperimentConsumer(AsyncJsonWebsocketConsumer):
         )
 
         # Set up channels for experiment-specific updates
-        for key in experiment_keys:
-            experiment = await self.get_experiment(self.project, key)
-            if experiment:
-                group_name = f"experiment_{str(experiment.id)}"
-                await self.channel_layer.group_add(
-                    group_name,
-                    self.channel_name
-                )
+        await self.join_experiment_groups(experiment for experiment, _ in states)
 
         # Set up channel for project-wide updates
         await self.channel_layer.group_add(
@@ -86,7 +86,7 @@ class ExperimentConsumer(AsyncJsonWebsocketConsumer):
         await self.accept()
 
         # Send initial state
-        await self.send_initial_state(experiment_keys)
+        await self.send_states(states, batch)
 
     async def disconnect(self, close_code):
         """
@@ -105,36 +105,60 @@ class ExperimentConsumer(AsyncJsonWebsocketConsumer):
                 self.channel_name
             )
 
+        for group_name in getattr(self, 'experiment_groups', {}).values():
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
     async def receive_json(self, content):
         """
         Called when we receive a text frame from the client.
         """
         message_type = content.get('type')
 
-        if message_type == 'subscribe_experiment':
+        if message_type in ('subscribe_experiment', 'unsubscribe_experiment'):
             experiment_key = content.get('experiment_key')
-            if experiment_key:
-                experiment = await self.get_experiment(self.project, experiment_key)
-                if experiment:
-                    group_name = f"experiment_{str(experiment.id)}"
-                    await self.channel_layer.group_add(
-                        group_name,
-                        self.channel_name
-                    )
-                    # Send the current state of this experiment
-                    await self.send_experiment_state(experiment_key)
+            if experiment_key is not None and not isinstance(experiment_key, str):
+                await self.send_error(message_type, "experiment_key must be a string")
+                return
+            experiment_keys = [experiment_key] if experiment_key else []
+        elif message_type in ('subscribe', 'unsubscribe', 'evaluate'):
+            experiment_keys = content.get('experiment_keys') or []
+            if not isinstance(experiment_keys, list) or not all(isinstance(key, str) for key in experiment_keys):
+                await self.send_error(message_type, "experiment_keys must be a list of strings")
+                return
+            experiment_keys = [key for key in experiment_keys if key]
+        else:
+            return
 
-        elif message_type == 'unsubscribe_experiment':
-            experiment_key = content.get('experiment_key')
-            if experiment_key:
-                experiment = await self.get_experiment(self.project, experiment_key)
-                if experiment:
-                    group_name = f"experiment_{str(experiment.id)}"
+        if not experiment_keys:
+            return
+
+        if message_type in ('subscribe_experiment', 'subscribe', 'evaluate'):
+            states = await self.evaluate(experiment_keys)
+            if message_type != 'evaluate':
+                await self.join_experiment_groups(experiment for experiment, _ in states)
+            # Send the current state of the experiments
+            await self.send_states(states, batch=message_type != 'subscribe_experiment')
+
+        elif message_type in ('unsubscribe_experiment', 'unsubscribe'):
+            # Only subscribed experiments have groups to leave, no need to look the keys up
+            for experiment_key in experiment_keys:
+                group_name = self.experiment_groups.pop(experiment_key, None)
+                if group_name is not None:
                     await self.channel_layer.group_discard(
                         group_name,
                         self.channel_name
                     )
 
+    async def send_error(self, message_type, message):
+        """
+        Reply to a message that could not be handled.
+        """
+        await self.send_json({
+            'type': 'error',
+            'request_type': message_type,
+            'message': message
+        })
+
     async def experiment_update(self, event):
         """
         Handler for experiment update events.
@@ -157,84 +181,71 @@ class ExperimentConsumer(AsyncJsonWebsocketConsumer):
             'variant': event['variant']
         })
 
-    @database_sync_to_async
-    def get_project(self, api_key):
+    async def config_changed(self, event):
         """
-        Get project by API key.
+        Handler for project configuration changes.
         """
-        try:
-            return Project.objects.get(api_key=api_key)
-        except Project.DoesNotExist:
-            return None
+        # Clients re-evaluate or refetch their assignments when they see a newer version
+        await self.send_json({
+            'type': 'config_changed',
+            'version': event['version']
+        })
 
     @database_sync_to_async
-    def get_user(self, project, user_id=None, device_id=None, email=None, external_id=None):
+    def handshake(self, api_key, identifiers, experiment_keys):
         """
-        Get or create user based on provided identifiers.
+        Get the project and user, and the user's variants in the given experiments.
+        Returns None for the project if the API key is invalid, and None for the
+        user if no identifier was provided.
         """
-        from experiments.services.variant_service import get_or_create_user
+        project = get_project_by_api_key(api_key)
+        if not project:
+            return None, None, []
 
-        identifiers = {
-            'id': user_id,
-            'device_id': device_id,
-            'email': email,
-            'external_id': external_id
-        }
+        if not any(identifiers.values()):
+            return project, None, []
 
-        return get_or_create_user(project, identifiers)
+        user = get_or_create_user(project, identifiers)
+        return project, user, get_user_variants(project, user, experiment_keys)
 
     @database_sync_to_async
-    def get_experiment(self, project, experiment_key):
+    def evaluate(self, experiment_keys):
         """
-        Get experiment by key.
+        Get or assign the user's variants in the given experiments.
         """
-        return get_experiment_by_key(project, experiment_key)
+        return get_user_variants(self.project, self.user, experiment_keys)
 
-    @database_sync_to_async
-    def get_distribution(self, user, experiment):
+    async def join_experiment_groups(self, experiments):
         """
-        Get distribution for user and experiment.
+        Subscribe to updates of the given experiments.
         """
-        from experiments.services.variant_service import get_or_create_distribution
-        return get_or_create_distribution(user, experiment)
+        for experiment in experiments:
+            group_name = f"experiment_{str(experiment.id)}"
+            self.experiment_groups[experiment.key] = group_name
+            await self.channel_layer.group_add(
+                group_name,
+                self.channel_name
+            )
 
-    async def send_initial_state(self, experiment_keys):
+    async def send_states(self, states, batch=False):
         """
-        Send the initial state of subscribed experiments.
+        Send the current state of experiments, as one message or one message per experiment.
         """
-        for key in experiment_keys:
-            await self.send_experiment_state(key)
+        states = [
+            {'experiment': experiment_data(experiment), 'variant': variant_data(variant)}
+            for experiment, variant in states
+            if variant is not None
+        ]
 
-    async def send_experiment_state(self, experiment_key):
-        """
-        Send the current state of a specific experiment.
-        """
-        experiment = await self.get_experiment(self.project, experiment_key)
-        if not experiment:
+        if batch:
+            await self.send_json({
+                'type': 'experiments_state',
+                'experiments': states
+            })
             return
 
-        distribution = await self.get_distribution(self.user, experiment)
-
-        # Fetch variant data in a sync-to-async wrapper
-        variant = await database_sync_to_async(lambda: distribution.variant)()
-
-        # Format the response
-        experiment_data = {
-            'id': str(experiment.id),
-            'key': experiment.key,
-            'name': experiment.name,
-            'status': experiment.status,
-            'type': experiment.type,
-        }
-
-        variant_data = {
-            'id': str(variant.id),
-            'key': variant.key,
-            'payload': variant.payload
-        }
-
-        await self.send_json({
-            'type': 'experiment_state',
-            'experiment': experiment_data,
-            'variant': variant_data
-        })
\ No newline at end of file
+        for state in states:
+            await self.send_json({
+                'type': 'experiment_state',
+                **state
+            })
@@ -1,24 +1,152 @@
+from typing import Optional
+from urllib.parse import urlencode
+
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from django.http import Http404
+from django.utils.cache import patch_vary_headers
 
 from experiments.authentication import APIKeyAuthentication
-from experiments.models import Experiment
-from experiments.serializers import UserIdentifierSerializer, ExperimentVariantResponseSerializer, UserResponseSerializer
+from experiments.models import ProjectUser
+from experiments.renderers import MessagePackRenderer
+from experiments.serializers import (
+    UserIdentifierSerializer,
+    ExperimentVariantResponseSerializer,
+    UserResponseSerializer,
+    BatchEvaluationSerializer,
+    EventBatchSerializer
+)
+from experiments.services.assignment_token import (
+    ASSIGNMENT_TOKEN_HEADER,
+    AssignmentToken,
+    issue_assignment_token,
+    match_assignment_token
+)
+from experiments.services.bucketing import compile_experiment
+from experiments.services.circuit_breaker import CONNECTION_ERRORS, CircuitOpenError, database_breaker
+from experiments.services.degraded_service import degraded_assignments, degraded_metrics, remember_user
+from experiments.services.event_service import ingest_events
+from experiments.services.experiment_cache import get_project_snapshot
+from experiments.services.user_activity_service import record_user_seen
 from experiments.services.variant_service import (
     get_or_create_user,
-    get_or_create_distribution,
-    get_experiment_by_key
+    get_or_create_users,
+    get_or_create_distributions,
+    get_or_assign_variant,
+    get_experiment_by_key,
+    IDENTIFIER_FIELDS,
+    OPTIONAL_FIELDS
 )
+from experiments.services.version_service import (
+    experiments_etag,
+    get_config_version,
+    get_user_version,
+    match_experiments_etag
+)
+
+
+def user_experiments_data(user, experiments, variants) -> dict:
+    """
+    Format a user and their variants in the given experiments for a response.
+    variants maps (user id, experiment id) pairs to variants, as returned by get_or_create_distributions.
+    """
+    assignments = [
+        {'experiment': experiment, 'variant': variants[(user.id, experiment.id)]}
+        for experiment in experiments
+        if (user.id, experiment.id) in variants
+    ]
+    return {
+        'user': UserResponseSerializer(user).data,
+        'experiments': ExperimentVariantResponseSerializer(assignments, many=True).data
+    }
+
+
+def token_user(token: AssignmentToken, user_data) -> ProjectUser:
+    """The user of an assignment token, with the identifiers and metadata of the request."""
+    return ProjectUser(
+        id=token.user_id,
+        **{field: user_data.get(field) for field in IDENTIFIER_FIELDS + OPTIONAL_FIELDS},
+        properties=user_data.get('properties') or {}
+    )
+
+
+def token_variants(token: AssignmentToken, experiments) -> Optional[dict]:
+    """
+    The variants listed in an assignment token for the given experiments, keyed like
+    get_or_create_distributions. None if the token lacks any of them.
+    """
+    variants = {}
+    for experiment in experiments:
+        variant = experiment.get_variant(token.variant_ids.get(experiment.id))
+        if variant is None:
+            return None
+        variants[(token.user_id, experiment.id)] = variant
+    return variants
+
+
+def user_assignment_token(project, params, user, experiments, variants, config_version, user_version) -> str:
+    """Sign the variants of a user in the given experiments, see assignment_token."""
+    return issue_assignment_token(project.id, params, user.id, config_version, user_version, {
+        experiment.id: variants[(user.id, experiment.id)].id
+        for experiment in experiments
+        if (user.id, experiment.id) in variants
+    })
+
+
+def degraded_response_data(project, user_data, experiment_key=None):
+    """
+    Format the variants of a user computed without the database, for one experiment
+    or for all running experiments. Returns None if they cannot be computed.
+    """
+    result = degraded_assignments(project.id, user_data, experiment_key)
+    if result is None:
+        return None
+
+    user, experiments, variants = result
+    if experiment_key is None:
+        return user_experiments_data(user, experiments, variants)
+
+    experiment = experiments[0]
+    return ExperimentVariantResponseSerializer({
+        'experiment': experiment,
+        'variant': variants[(user.id, experiment.id)]
+    }).data
+
+
+# Marks responses computed without the database
+DEGRADED_HEADERS = {'X-Degraded': 'true'}
+
+DATABASE_UNAVAILABLE = {"error": "Database unavailable"}
+
+
+def query_params_key(query_params) -> str:
+    """The query parameters in a canonical order, so the same parameters identify the same response."""
+    return urlencode(sorted(query_params.lists()), doseq=True)
 
 
 class LibraryAPIView(APIView):
     """
     Base class for library-facing API views.
-    Uses API key authentication.
+    Uses API key authentication, and responds with MessagePack to clients that ask for it.
     """
     authentication_classes = [APIKeyAuthentication]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [MessagePackRenderer]
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # The format depends on the Accept header
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+    def get_representation(self):
+        """The format of the response when it is not JSON, which ETags are specific to."""
+        if isinstance(getattr(self.request, 'accepted_renderer', None), MessagePackRenderer):
+            return MessagePackRenderer.format
+        return None
 
     def get_project(self):
         """
@@ -50,36 +178,71 @@ class ExperimentVariantAPIView(LibraryAPIView):
         user_data = user_serializer.validated_data
 
         try:
-            # Find the experiment
-            experiment = get_experiment_by_key(project, experiment_key)
-            if not experiment:
-                return Response(
-                    {"error": f"Experiment '{experiment_key}' not found"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-
-            # Ensure experiment is running
-            if experiment.status != "running":
-                return Response({
-                    "error": "Experiment is not running",
-                    "status": experiment.status
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            # Get or create user
-            user = get_or_create_user(project, user_data)
-
-            # Get or create distribution
-            distribution = get_or_create_distribution(user, experiment)
+            # Answer from a current assignment token and the cached snapshot, without the database
+            assignment_token = request.headers.get(ASSIGNMENT_TOKEN_HEADER)
+            if assignment_token:
+                params = query_params_key(request.query_params)
+                token = match_assignment_token(project.id, params, assignment_token)
+                experiment = token and get_project_snapshot(project.id, token.config_version).get(experiment_key)
+                variants = experiment and token_variants(token, [experiment])
+                if variants:
+                    record_user_seen(token.user_id)
+                    serializer = ExperimentVariantResponseSerializer({
+                        'experiment': experiment,
+                        'variant': variants[(token.user_id, experiment.id)]
+                    })
+                    return Response(serializer.data)
+
+            # Database work goes through the breaker, which fails fast while the database is down
+            with database_breaker.guard():
+                # Find the experiment in the cached snapshot of running experiments
+                experiment = get_project_snapshot(project.id).get(experiment_key)
+
+                if experiment is None:
+                    # Not cached, look it up to report why
+                    stored_experiment = get_experiment_by_key(project, experiment_key)
+                    if not stored_experiment:
+                        return Response(
+                            {"error": f"Experiment '{experiment_key}' not found"},
+                            status=status.HTTP_404_NOT_FOUND
+                        )
+
+                    # Ensure experiment is running
+                    if stored_experiment.status != "running":
+                        return Response({
+                            "error": "Experiment is not running",
+                            "status": stored_experiment.status
+                        }, status=status.HTTP_400_BAD_REQUEST)
+
+                    # Started after the snapshot was built
+                    experiment = compile_experiment(stored_experiment)
+
+                # Get or create user
+                user = get_or_create_user(project, user_data)
+
+                # Get or assign the user's variant
+                variant = get_or_assign_variant(user, experiment)
+
+            remember_user(project.id, user_data, user.id)
 
             # Prepare response
             response_data = {
                 'experiment': experiment,
-                'variant': distribution.variant
+                'variant': variant
             }
 
             serializer = ExperimentVariantResponseSerializer(response_data)
             return Response(serializer.data)
 
+        except (CircuitOpenError, *CONNECTION_ERRORS):
+            # Serve the variant from the last known configuration, without writes
+            data = degraded_response_data(project, user_data, experiment_key)
+            if data is None:
+                return Response(DATABASE_UNAVAILABLE, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            return Response(data, headers=DEGRADED_HEADERS)
+
+        except ProjectUser.DoesNotExist as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -114,6 +277,8 @@ class UserIdentifyAPIView(LibraryAPIView):
             response_serializer = UserResponseSerializer(user)
             return Response(response_serializer.data)
 
+        except ProjectUser.DoesNotExist as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -125,10 +290,28 @@ class UserExperimentsAPIView(LibraryAPIView):
     """
 
     def get(self, request):
-        """Get all experiments and variants for a user."""
+        """
+        Get all experiments and variants for a user.
+        Supports conditional requests: an If-None-Match header with a current ETag
+        is answered with 304 Not Modified without touching the database.
+        Responses carry an assignment token, a current token sent back in the
+        X-Assignment-Token header is answered from the token without the database.
+        """
         # Get the project from the request
         project = self.get_project()
 
+        params = query_params_key(request.query_params)
+        representation = self.get_representation()
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            match = match_experiments_etag(project.id, params, if_none_match, representation)
+            if match is not None:
+                etag, user_id = match
+                # Still count the poll as activity, without loading the user
+                record_user_seen(user_id)
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
         # Validate user identification data
         user_serializer = UserIdentifierSerializer(data=request.query_params)
         if not user_serializer.is_valid():
@@ -138,39 +321,165 @@ class UserExperimentsAPIView(LibraryAPIView):
         user_data = user_serializer.validated_data
 
         try:
-            # Get or create user
-            user = get_or_create_user(project, user_data)
-
-            # Get all running experiments for this project
-            running_experiments = Experiment.objects.filter(
-                project=project,
-                status='running'
+            # Answer from a current assignment token and the cached snapshot, without the database
+            assignment_token = request.headers.get(ASSIGNMENT_TOKEN_HEADER)
+            token = assignment_token and match_assignment_token(project.id, params, assignment_token)
+            if token:
+                running_experiments = list(get_project_snapshot(project.id, token.config_version).experiments.values())
+                variants = token_variants(token, running_experiments)
+                if variants is not None:
+                    # Count the request as activity, without loading the user
+                    record_user_seen(token.user_id)
+                    return Response(
+                        user_experiments_data(token_user(token, user_data), running_experiments, variants),
+                        headers={
+                            'ETag': experiments_etag(
+                                project.id, token.user_id, token.config_version, token.user_version, params,
+                                representation
+                            ),
+                            ASSIGNMENT_TOKEN_HEADER: assignment_token
+                        }
+                    )
+
+            # Read the config version first, so the response is at least as new as its ETag says
+            config_version = get_config_version(project.id)
+
+            # Database work goes through the breaker, which fails fast while the database is down
+            with database_breaker.guard():
+                # Get or create user
+                user = get_or_create_user(project, user_data)
+                user_version = get_user_version(user.id)
+
+                # Get all running experiments for this project from the cached snapshot
+                running_experiments = list(get_project_snapshot(project.id, config_version).experiments.values())
+
+                # Get or assign the user's variant in every experiment with one read and one insert
+                variants = get_or_create_distributions([user], running_experiments)
+
+            remember_user(project.id, user_data, user.id)
+
+            return Response(
+                user_experiments_data(user, running_experiments, variants),
+                headers={
+                    'ETag': experiments_etag(
+                        project.id, user.id, config_version, user_version, params, representation
+                    ),
+                    ASSIGNMENT_TOKEN_HEADER: user_assignment_token(
+                        project, params, user, running_experiments, variants, config_version, user_version
+                    )
+                }
             )
 
-            # Get or create distributions for each experiment
-            experiments_data = []
-            for experiment in running_experiments:
-                distribution = get_or_create_distribution(user, experiment)
-
-                experiments_data.append({
-                    'experiment': {
-                        'id': str(experiment.id),
-                        'key': experiment.key,
-                        'name': experiment.name
-                    },
-                    'variant': {
-                        'id': str(distribution.variant.id),
-                        'key': distribution.variant.key,
-                        'payload': distribution.variant.payload
-                    }
-                })
-
-            user_serialized_data = UserResponseSerializer(user).data
+        except (CircuitOpenError, *CONNECTION_ERRORS):
+            # Serve the variants from the last known configuration, without writes and without an ETag
+            data = degraded_response_data(project, user_data)
+            if data is None:
+                return Response(DATABASE_UNAVAILABLE, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            return Response(data, headers=DEGRADED_HEADERS)
+
+        except ProjectUser.DoesNotExist as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class BatchEvaluationAPIView(LibraryAPIView):
+    """
+    API endpoint to get the variants of many users at once.
+    This is meant to be used by server-side callers, e.g. email campaigns and server rendering.
+    """
+
+    def post(self, request):
+        """
+        Get or assign the variants of a list of users.
+        Evaluates the given experiment keys, or all running experiments if none are given.
+        """
+        # Get the project from the request
+        project = self.get_project()
+
+        # Validate the users and experiment keys
+        batch_serializer = BatchEvaluationSerializer(data=request.data)
+        if not batch_serializer.is_valid():
+            return Response(batch_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        batch_data = batch_serializer.validated_data
+
+        try:
+            # Find the experiments in the cached snapshot of running experiments
+            snapshot = get_project_snapshot(project.id)
+            experiment_keys = batch_data.get('experiments')
+            experiments, missing_keys = [], []
+            if experiment_keys is None:
+                experiments = list(snapshot.experiments.values())
+            else:
+                for key in dict.fromkeys(experiment_keys):
+                    experiment = snapshot.get(key)
+                    if experiment is None:
+                        missing_keys.append(key)
+                    else:
+                        experiments.append(experiment)
+
+            # Get or create all users, then get or assign all of their variants
+            users = get_or_create_users(project, batch_data['users'])
+            variants = get_or_create_distributions(users, experiments)
 
             return Response({
-                'user': user_serialized_data,
-                'experiments': experiments_data
+                'results': [user_experiments_data(user, experiments, variants) for user in users],
+                # Keys that are unknown or not running
+                'missing_experiments': missing_keys
             })
 
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ProjectUser.DoesNotExist as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class EventIngestionAPIView(LibraryAPIView):
+    """
+    API endpoint to send exposure and conversion events in batches.
+    Events are buffered and written in bulk, so they are accepted before they are stored.
+    """
+
+    def post(self, request):
+        """
+        Record a batch of events.
+        Each event has a name and user identifiers, and optionally an experiment key, a value and a timestamp.
+        """
+        # Get the project from the request
+        project = self.get_project()
+
+        # Validate the events
+        batch_serializer = EventBatchSerializer(data=request.data)
+        if not batch_serializer.is_valid():
+            return Response(batch_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            result = ingest_events(project, batch_serializer.validated_data['events'])
+            return Response(result, status=status.HTTP_202_ACCEPTED)
+
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ProjectUser.DoesNotExist as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ServiceMetricsAPIView(APIView):
+    """
+    API endpoint exposing the state of the database breaker and the degraded
+    responses of the worker that serves the request, for monitoring.
+    Uses admin JWT authentication, like the admin API.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Get the metrics of this worker."""
+        return Response({
+            'database_breaker': database_breaker.metrics(),
+            'degraded': degraded_metrics()
+        })
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from experiments.models import Experiment
+from experiments.services.enrollment_service import rebuild_enrollment_counts
+
+
+class Command(BaseCommand):
+    help = 'Recount the distributions of experiments into their enrollment counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('experiment_ids', nargs='*', help='Experiments to recount, all experiments if omitted')
+
+    def handle(self, *args, **options):
+        experiments = Experiment.objects.order_by('created_at')
+        if options['experiment_ids']:
+            experiments = experiments.filter(id__in=options['experiment_ids'])
+
+        for experiment in experiments:
+            counts = rebuild_enrollment_counts(experiment.id)
+            self.stdout.write(f"Recounted experiment {experiment.id}: {sum(counts.values())} distributions.")
+
+        self.stdout.write(self.style.SUCCESS("Enrollment counters rebuilt."))
@@ -0,0 +1,66 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from experiments.services.recalculation_service import (
+    claim_next_recalculation,
+    fail_stale_recalculations,
+    run_recalculation_job
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run queued distribution recalculations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when no job is due')
+        parser.add_argument('--once', action='store_true', help='Run the jobs that are due and exit')
+
+    def handle(self, *args, **options):
+        poll_interval = options.get('poll_interval')
+        once = options.get('once', False)
+
+        self.stdout.write("Recalculation worker started.")
+
+        try:
+            while True:
+                close_old_connections()
+
+                try:
+                    job = self.run_next()
+                except Exception:
+                    # E.g. the database is restarting, the worker keeps polling
+                    logger.exception("Recalculation worker iteration failed")
+                    job = None
+
+                if job is None:
+                    if once:
+                        break
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write("Recalculation worker stopped.")
+
+    def run_next(self):
+        """Fail abandoned jobs, then claim and run the next due job. Returns the job, None if none was due."""
+        failed = fail_stale_recalculations()
+        if failed:
+            self.stderr.write(f"Marked {failed} abandoned recalculations as failed.")
+
+        job = claim_next_recalculation()
+        if job is None:
+            return None
+
+        job = run_recalculation_job(job)
+        if job.status == 'completed':
+            self.stdout.write(self.style.SUCCESS(
+                f"Recalculated experiment {job.experiment_id}: updated {job.changed} of {job.total} distributions."
+            ))
+        else:
+            self.stderr.write(f"Recalculation of experiment {job.experiment_id} failed: {job.error}")
+        return job
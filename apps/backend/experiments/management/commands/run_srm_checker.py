@@ -0,0 +1,53 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from experiments.services.srm_service import run_srm_sweep
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Check running experiments for sample ratio mismatches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=60.0, help='Seconds between sweeps')
+        parser.add_argument('--once', action='store_true', help='Run one sweep and exit')
+
+    def handle(self, *args, **options):
+        interval = options.get('interval')
+        once = options.get('once', False)
+
+        self.stdout.write("Sample ratio mismatch checker started.")
+
+        try:
+            while True:
+                close_old_connections()
+                started = time.monotonic()
+
+                try:
+                    checks = run_srm_sweep()
+                except Exception:
+                    # E.g. the database is restarting, the next sweep tries again
+                    logger.exception("Sample ratio mismatch sweep failed")
+                else:
+                    mismatches = [check for check in checks if check.mismatch]
+                    for check in mismatches:
+                        self.stderr.write(
+                            f"Sample ratio mismatch in experiment {check.experiment_id}: "
+                            f"p={check.p_value:.3g}, observed {check.observed}"
+                        )
+                    self.stdout.write(
+                        f"Checked {len(checks)} experiments, {len(mismatches)} mismatches "
+                        f"in {time.monotonic() - started:.2f}s."
+                    )
+
+                if once:
+                    break
+                time.sleep(max(interval - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write("Sample ratio mismatch checker stopped.")
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-17 01:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0002_recalculationjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="experiment",
+            name="allocation",
+            field=models.CharField(
+                choices=[("contiguous", "Contiguous"), ("sticky", "Sticky")],
+                default="contiguous",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="experiment",
+            name="bucket_ranges",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.1.6 on 2026-10-17 01:31
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_existing_distributions(apps, schema_editor):
+    Distribution = apps.get_model("experiments", "Distribution")
+    VariantEnrollment = apps.get_model("experiments", "VariantEnrollment")
+
+    counts = (
+        Distribution.objects.order_by()
+        .values_list("experiment_id", "variant_id")
+        .annotate(count=Count("id"))
+    )
+    VariantEnrollment.objects.bulk_create(
+        [
+            VariantEnrollment(
+                experiment_id=experiment_id, variant_id=variant_id, enrolled=count
+            )
+            for experiment_id, variant_id, count in counts
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0003_experiment_allocation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="VariantEnrollment",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("enrolled", models.BigIntegerField(default=0)),
+                (
+                    "experiment",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="enrollments",
+                        to="experiments.experiment",
+                    ),
+                ),
+                (
+                    "variant",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="enrollments",
+                        to="experiments.variant",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("experiment", "variant")},
+            },
+        ),
+        migrations.RunPython(count_existing_distributions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,119 @@
+# Generated by Django 5.1.6 on 2026-10-17 01:33
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+PARTITIONED_TABLE_SQL = """
+CREATE TABLE "experiments_event" (
+    "id" uuid NOT NULL,
+    "name" varchar(255) NOT NULL,
+    "value" double precision NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    "received_at" timestamp with time zone NOT NULL,
+    "experiment_id" uuid NULL,
+    "project_id" uuid NOT NULL,
+    "user_id" uuid NOT NULL,
+    "variant_id" uuid NULL,
+    PRIMARY KEY ("id", "timestamp")
+) PARTITION BY RANGE ("timestamp");
+CREATE INDEX "experiments_event_lookup_idx"
+    ON "experiments_event" ("experiment_id", "name", "timestamp");
+"""
+
+
+def create_event_table(apps, schema_editor):
+    # Partitioned by day on PostgreSQL, the partition key has to be part of the primary key
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(PARTITIONED_TABLE_SQL)
+    else:
+        schema_editor.create_model(apps.get_model("experiments", "Event"))
+
+
+def drop_event_table(apps, schema_editor):
+    schema_editor.delete_model(apps.get_model("experiments", "Event"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0004_variantenrollment"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name="Event",
+                    fields=[
+                        (
+                            "id",
+                            models.UUIDField(
+                                default=uuid.uuid4,
+                                editable=False,
+                                primary_key=True,
+                                serialize=False,
+                            ),
+                        ),
+                        ("name", models.CharField(max_length=255)),
+                        ("value", models.FloatField(blank=True, null=True)),
+                        ("timestamp", models.DateTimeField()),
+                        ("received_at", models.DateTimeField()),
+                        (
+                            "experiment",
+                            models.ForeignKey(
+                                blank=True,
+                                db_constraint=False,
+                                db_index=False,
+                                null=True,
+                                on_delete=django.db.models.deletion.DO_NOTHING,
+                                related_name="events",
+                                to="experiments.experiment",
+                            ),
+                        ),
+                        (
+                            "project",
+                            models.ForeignKey(
+                                db_constraint=False,
+                                db_index=False,
+                                on_delete=django.db.models.deletion.DO_NOTHING,
+                                related_name="events",
+                                to="experiments.project",
+                            ),
+                        ),
+                        (
+                            "user",
+                            models.ForeignKey(
+                                db_constraint=False,
+                                db_index=False,
+                                on_delete=django.db.models.deletion.DO_NOTHING,
+                                related_name="events",
+                                to="experiments.projectuser",
+                            ),
+                        ),
+                        (
+                            "variant",
+                            models.ForeignKey(
+                                blank=True,
+                                db_constraint=False,
+                                db_index=False,
+                                null=True,
+                                on_delete=django.db.models.deletion.DO_NOTHING,
+                                related_name="events",
+                                to="experiments.variant",
+                            ),
+                        ),
+                    ],
+                    options={
+                        "indexes": [
+                            models.Index(
+                                fields=["experiment", "name", "timestamp"],
+                                name="experiments_event_lookup_idx",
+                            )
+                        ],
+                    },
+                ),
+            ],
+        ),
+        migrations.RunPython(create_event_table, drop_event_table),
+    ]
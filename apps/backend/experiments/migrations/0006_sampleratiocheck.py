@@ -0,0 +1,55 @@
+# Generated by Django 5.1.6 on 2026-10-17 01:39
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0005_event"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SampleRatioCheck",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("total", models.BigIntegerField(default=0)),
+                ("chi_square", models.FloatField()),
+                ("p_value", models.FloatField()),
+                ("mismatch", models.BooleanField(default=False)),
+                ("observed", models.JSONField()),
+                ("expected", models.JSONField()),
+                ("checked_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "experiment",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="srm_checks",
+                        to="experiments.experiment",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["experiment", "-checked_at"],
+                        name="experiments_srm_latest_idx",
+                    ),
+                    models.Index(
+                        fields=["checked_at"], name="experiments_srm_checked_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.6 on 2026-10-17 01:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0006_sampleratiocheck"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="experiment",
+            name="assignment",
+            field=models.CharField(
+                choices=[
+                    ("stored", "Stored"),
+                    ("deferred", "Deferred"),
+                    ("stateless", "Stateless"),
+                ],
+                default="stored",
+                max_length=20,
+            ),
+        ),
+    ]
@@ -149,6 +149,20 @@ class Experiment(models.Model):
         ("toggle", "Toggle"),
         ("multiple_variant", "Multiple Variant"),
     ]
+    ALLOCATION_CHOICES = [
+        # Buckets are split into contiguous ranges in variant order, any rollout change can move every range
+        ("contiguous", "Contiguous"),
+        # Each variant keeps its bucket ranges, rollout changes only move the buckets needed
+        ("sticky", "Sticky"),
+    ]
+    ASSIGNMENT_CHOICES = [
+        # Every first assignment is written as a distribution
+        ("stored", "Stored"),
+        # Variants are computed from the bucket ranges, first assignments are written in background batches
+        ("deferred", "Deferred"),
+        # Variants are computed from the bucket ranges and never written, only existing distributions are read
+        ("stateless", "Stateless"),
+    ]
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     key = models.CharField(max_length=255)
@@ -156,6 +170,10 @@ class Experiment(models.Model):
     description = models.TextField(blank=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="draft")
     type = models.CharField(max_length=20, choices=TYPE_CHOICES, default="toggle")
+    allocation = models.CharField(max_length=20, choices=ALLOCATION_CHOICES, default="contiguous")
+    assignment = models.CharField(max_length=20, choices=ASSIGNMENT_CHOICES, default="stored")
+    # Sticky allocation only: [start, end, variant_id] bucket ranges owned by each variant
+    bucket_ranges = models.JSONField(null=True, blank=True)
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="experiments")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -250,4 +268,129 @@ class Distribution(models.Model):
         unique_together = [["user", "experiment"]]
 
     def __str__(self):
-        return f"{self.user} -> {self.experiment.name}: {self.variant.key}"
\ No newline at end of file
+        return f"{self.user} -> {self.experiment.name}: {self.variant.key}"
+
+
+class VariantEnrollment(models.Model):
+    """
+    Number of users distributed to a variant, kept up to date with every
+    distribution write so stats do not have to count distributions
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE, related_name="enrollments")
+    variant = models.ForeignKey(Variant, on_delete=models.CASCADE, related_name="enrollments")
+    enrolled = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [["experiment", "variant"]]
+
+    def __str__(self):
+        return f"{self.experiment.name} - {self.variant.key}: {self.enrolled}"
+
+
+class Event(models.Model):
+    """
+    An exposure or conversion event sent by the library. Append-only.
+
+    On PostgreSQL the table is partitioned by day of the event timestamp, see
+    event_service. The foreign keys have no database constraints so inserts stay
+    cheap, and events are kept when their user or experiment is deleted.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    project = models.ForeignKey(
+        Project, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, related_name="events"
+    )
+    user = models.ForeignKey(
+        ProjectUser, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, related_name="events"
+    )
+    experiment = models.ForeignKey(
+        Experiment, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        null=True, blank=True, related_name="events"
+    )
+    # The user's variant in the experiment when the event was received
+    variant = models.ForeignKey(
+        Variant, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        null=True, blank=True, related_name="events"
+    )
+    name = models.CharField(max_length=255)
+    value = models.FloatField(null=True, blank=True)
+    timestamp = models.DateTimeField()
+    received_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["experiment", "name", "timestamp"], name="experiments_event_lookup_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} at {self.timestamp}"
+
+
+class RecalculationJob(models.Model):
+    """
+    A queued recalculation of an experiment's distributions, run by the recalculation worker
+    """
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("completed", "Completed"),
+        ("failed", "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE, related_name="recalculation_jobs")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    # Debounce: the job is not picked up before this time, later edits push it back
+    run_after = models.DateTimeField()
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    total = models.PositiveIntegerField(default=0)
+    changed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # At most one queued and one running recalculation per experiment
+        constraints = [
+            models.UniqueConstraint(
+                fields=['experiment'],
+                condition=models.Q(status='pending'),
+                name='unique_pending_recalculation_per_experiment'
+            ),
+            models.UniqueConstraint(
+                fields=['experiment'],
+                condition=models.Q(status='running'),
+                name='unique_running_recalculation_per_experiment'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.experiment.name} - {self.status}"
+
+
+class SampleRatioCheck(models.Model):
+    """
+    A sample ratio mismatch check of a running experiment: the observed enrollment
+    of its variants compared to the split of its buckets, see srm_service
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE, related_name="srm_checks")
+    total = models.BigIntegerField(default=0)
+    chi_square = models.FloatField()
+    p_value = models.FloatField()
+    # Whether the split differs from the expected one, only set from SRM_MIN_SAMPLE users
+    mismatch = models.BooleanField(default=False)
+    # Enrolled users and expected share of users per variant key
+    observed = models.JSONField()
+    expected = models.JSONField()
+    checked_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["experiment", "-checked_at"], name="experiments_srm_latest_idx"),
+            models.Index(fields=["checked_at"], name="experiments_srm_checked_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.experiment.name} - p={self.p_value:.4g} at {self.checked_at}"
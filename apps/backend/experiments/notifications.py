@@ -0,0 +1,127 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Tuple
+
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+# Per-thread flag set while distributions are rewritten in bulk
+_suppressed = threading.local()
+
+
+def experiment_data(experiment) -> Dict[str, Any]:
+    """
+    Format an experiment (model or compiled) for WebSocket messages.
+    """
+    return {
+        'id': str(experiment.id),
+        'key': experiment.key,
+        'name': experiment.name,
+        'status': experiment.status,
+        'type': experiment.type,
+    }
+
+
+def variant_data(variant) -> Dict[str, Any]:
+    """
+    Format a variant (model or compiled) for WebSocket messages.
+    """
+    return {
+        'id': str(variant.id),
+        'key': variant.key,
+        'payload': variant.payload
+    }
+
+
+def _distribution_update_message(experiment, variant) -> Dict[str, Any]:
+    return {
+        'type': 'distribution_update',
+        'experiment': experiment_data(experiment),
+        'variant': variant_data(variant)
+    }
+
+
+def send_distribution_update(user_id, experiment, variant) -> None:
+    """
+    Notify a user's channel group that they were distributed to a variant.
+    """
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        f"user_{str(user_id)}",
+        _distribution_update_message(experiment, variant)
+    )
+
+
+async def asend_distribution_update(user_id, experiment, variant) -> None:
+    """
+    Async version of send_distribution_update, for use inside an event loop.
+    """
+    channel_layer = get_channel_layer()
+    await channel_layer.group_send(
+        f"user_{str(user_id)}",
+        _distribution_update_message(experiment, variant)
+    )
+
+
+def notify_distribution_changes(experiment, changes: Iterable[Tuple[Any, Any]]) -> None:
+    """
+    Notify every user whose variant changed.
+
+    Args:
+        experiment: The compiled experiment the changes belong to.
+        changes: (user_id, variant_id) pairs with the users' new variants.
+    """
+    if experiment.status != "running":
+        return
+
+    for user_id, variant_id in changes:
+        variant = experiment.get_variant(variant_id)
+        if variant is not None:
+            send_distribution_update(user_id, experiment, variant)
+
+
+async def anotify_distribution_changes(experiment, changes: Iterable[Tuple[Any, Any]]) -> None:
+    """
+    Async version of notify_distribution_changes, for use inside an event loop.
+    """
+    if experiment.status != "running":
+        return
+
+    for user_id, variant_id in changes:
+        variant = experiment.get_variant(variant_id)
+        if variant is not None:
+            await asend_distribution_update(user_id, experiment, variant)
+
+
+def send_config_changed(project_id, version: int) -> None:
+    """
+    Notify a project's channel group that its configuration changed.
+    Clients re-evaluate or refetch their assignments when the version is newer than theirs.
+    """
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        f"project_{str(project_id)}",
+        {
+            'type': 'config_changed',
+            'version': version
+        }
+    )
+
+
+@contextmanager
+def distribution_notifications_suppressed():
+    """
+    Suppress per-distribution notifications in this thread, e.g. while recalculating.
+    The config_changed message sent afterwards covers all of the changes.
+    """
+    previous = getattr(_suppressed, 'active', False)
+    _suppressed.active = True
+    try:
+        yield
+    finally:
+        _suppressed.active = previous
+
+
+def distribution_notifications_enabled() -> bool:
+    """Whether per-distribution notifications are sent in this thread."""
+    return not getattr(_suppressed, 'active', False)
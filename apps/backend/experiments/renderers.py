@@ -0,0 +1,112 @@
+"""
+MessagePack encoding of the library API responses.
+
+Clients that send Accept: application/msgpack get the responses of the library
+endpoints as MessagePack, with assignments as dense arrays instead of nested maps
+and ids as 16 byte binaries instead of strings:
+
+- a user is [id, device_id, email, external_id, latest_current_url, latest_os,
+  latest_os_version, latest_device_type, properties]
+- an assignment is [experiment id, experiment key, experiment name, variant id,
+  variant key, variant payload]
+
+User experiments responses are {"user": user, "experiments": [assignment, ...]},
+variant responses are a single assignment and batch evaluation results are lists
+of user experiments responses. Other responses, e.g. errors, keep their JSON shape.
+"""
+from typing import Any, List, Optional
+from uuid import UUID
+
+import msgpack
+from rest_framework.renderers import BaseRenderer
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+USER_FIELDS = [
+    'id', 'device_id', 'email', 'external_id', 'latest_current_url',
+    'latest_os', 'latest_os_version', 'latest_device_type', 'properties'
+]
+
+
+def _id_bytes(value: Optional[str]):
+    try:
+        return UUID(value).bytes if value else None
+    except ValueError:
+        return value
+
+
+def compact_user(user: dict) -> List[Any]:
+    """A user as a dense array, in the order of USER_FIELDS."""
+    return [_id_bytes(user.get('id'))] + [user.get(field) for field in USER_FIELDS[1:]]
+
+
+def compact_assignment(assignment: dict) -> List[Any]:
+    """An experiment and variant as a dense array."""
+    experiment, variant = assignment['experiment'], assignment['variant']
+    return [
+        _id_bytes(experiment['id']), experiment['key'], experiment['name'],
+        _id_bytes(variant['id']), variant['key'], variant['payload']
+    ]
+
+
+def compact_response(data):
+    """Convert the response data of a library endpoint to its compact form."""
+    if not isinstance(data, dict):
+        return data
+    if 'user' in data and 'experiments' in data:
+        return {
+            'user': compact_user(data['user']),
+            'experiments': [compact_assignment(assignment) for assignment in data['experiments']]
+        }
+    if 'experiment' in data and 'variant' in data:
+        return compact_assignment(data)
+    if 'results' in data:
+        return {**data, 'results': [compact_response(result) for result in data['results']]}
+    return data
+
+
+def pack_response(data) -> bytes:
+    """Encode the response data of a library endpoint as compact MessagePack."""
+    return msgpack.packb(compact_response(data), use_bin_type=True, default=str)
+
+
+def accepts_msgpack(accept: Optional[str]) -> bool:
+    """
+    Whether an Accept header prefers MessagePack: it names application/msgpack
+    with a quality at least as high as the one of JSON.
+    """
+    if not accept:
+        return False
+
+    msgpack_quality, json_quality = 0.0, 0.0
+    for media_range in accept.split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        media_type = media_type.lower()
+        if media_type == MSGPACK_MEDIA_TYPE:
+            msgpack_quality = max(msgpack_quality, quality)
+        elif media_type == 'application/json':
+            json_quality = max(json_quality, quality)
+
+    return msgpack_quality > 0 and msgpack_quality >= json_quality
+
+
+class MessagePackRenderer(BaseRenderer):
+    """Renders the responses of the library views as compact MessagePack."""
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return pack_response(data)
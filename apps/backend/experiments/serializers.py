@@ -1,7 +1,17 @@
 import secrets
-
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.validators import validate_email
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from django.utils.timezone import is_aware, make_aware
 from rest_framework import serializers
-from experiments.models import Project, Experiment, Variant, ProjectUser, Distribution, AdminUser
+from experiments.models import (
+    Project, Experiment, Variant, ProjectUser, Distribution, AdminUser, RecalculationJob, SampleRatioCheck
+)
+from experiments.services.recalculation_service import get_recalculation_progress
 
 
 class AdminUserSerializer(serializers.ModelSerializer):
@@ -60,7 +70,7 @@ class ExperimentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Experiment
         fields = [
-            'id', 'key', 'name', 'description', 'status', 'type',
+            'id', 'key', 'name', 'description', 'status', 'type', 'allocation', 'assignment',
             'project', 'variants', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
@@ -93,6 +103,28 @@ class DistributionSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
 
 
+class RecalculationJobSerializer(serializers.ModelSerializer):
+    processed = serializers.SerializerMethodField()
+
+    class Meta:
+        model = RecalculationJob
+        fields = [
+            'id', 'experiment', 'status', 'run_after', 'started_at', 'finished_at',
+            'total', 'processed', 'changed', 'error', 'created_at', 'updated_at'
+        ]
+        read_only_fields = fields
+
+    def get_processed(self, obj):
+        return get_recalculation_progress(obj)
+
+
+class SampleRatioCheckSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SampleRatioCheck
+        fields = ['id', 'total', 'chi_square', 'p_value', 'mismatch', 'observed', 'expected', 'checked_at']
+        read_only_fields = fields
+
+
 class ExperimentVariantResponseSerializer(serializers.Serializer):
     """Serializer for experiment variant response"""
     experiment = serializers.SerializerMethodField()
@@ -151,6 +183,138 @@ class UserIdentifierSerializer(UserResponseSerializer, serializers.Serializer):
         return data
 
 
+class BatchEvaluationSerializer(serializers.Serializer):
+    """
+    Serializer for evaluating experiments for many users at once.
+    All running experiments are evaluated if no experiment keys are given.
+    """
+    users = UserIdentifierSerializer(many=True, allow_empty=False)
+    experiments = serializers.ListField(child=serializers.CharField(), required=False)
+
+    def validate_users(self, users):
+        """Limit the number of users evaluated per request."""
+        max_users = getattr(settings, 'BATCH_EVALUATION_MAX_USERS', 1000)
+        if len(users) > max_users:
+            raise serializers.ValidationError(f"At most {max_users} users can be evaluated per request")
+        return users
+
+
+class EventListField(serializers.Field):
+    """
+    Field for a list of exposure or conversion events.
+
+    Each event has a name and user identifiers like in UserIdentifierSerializer,
+    and optionally an experiment key, a numeric value and an ISO 8601 timestamp.
+    Events are validated in one pass instead of with a nested serializer per event,
+    which would cost more than storing them. Errors are reported per event, like
+    a nested serializer with many=True does.
+    """
+    IDENTIFIER_FIELDS = ['id', 'device_id', 'email', 'external_id']
+
+    default_error_messages = {
+        'not_a_list': 'Expected a list of events but got type "{input_type}".',
+        'empty': 'This list may not be empty.',
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not data:
+            self.fail('empty')
+
+        events, errors = [], []
+        for item in data:
+            event, event_errors = self.validate_event(item)
+            events.append(event)
+            errors.append(event_errors)
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return events
+
+    def validate_event(self, item):
+        """Validate one event, returning the event and a dict of errors."""
+        if not isinstance(item, dict):
+            return None, {'non_field_errors': [f'Invalid data. Expected a dictionary, but got {type(item).__name__}.']}
+
+        event, errors = {}, {}
+
+        name = item.get('name')
+        if not isinstance(name, str) or not name.strip():
+            errors['name'] = ['This field is required.']
+        elif len(name) > 255:
+            errors['name'] = ['Ensure this field has no more than 255 characters.']
+        else:
+            event['name'] = name.strip()
+
+        experiment = item.get('experiment')
+        if experiment is not None:
+            if not isinstance(experiment, str) or len(experiment) > 255:
+                errors['experiment'] = ['Must be an experiment key.']
+            else:
+                event['experiment'] = experiment
+
+        value = item.get('value')
+        if value is not None:
+            try:
+                event['value'] = float(value)
+            except (TypeError, ValueError):
+                errors['value'] = ['A valid number is required.']
+
+        timestamp = item.get('timestamp')
+        if timestamp is not None:
+            try:
+                parsed = parse_datetime(timestamp) if isinstance(timestamp, str) else None
+            except ValueError:
+                # Well formed but not a valid date, e.g. month 13
+                parsed = None
+            if parsed is None:
+                errors['timestamp'] = ['Datetime has wrong format. Use ISO 8601.']
+            else:
+                parsed = parsed if is_aware(parsed) else make_aware(parsed)
+                # Bounded, every distinct day gets a partition of the event table
+                now = timezone.now()
+                max_age = timedelta(seconds=getattr(settings, 'EVENT_TIMESTAMP_MAX_AGE', 7 * 24 * 60 * 60))
+                max_skew = timedelta(seconds=getattr(settings, 'EVENT_TIMESTAMP_MAX_SKEW', 60 * 60))
+                if not now - max_age <= parsed <= now + max_skew:
+                    errors['timestamp'] = ['Datetime is too far from the current time.']
+                else:
+                    event['timestamp'] = parsed
+
+        for field in self.IDENTIFIER_FIELDS:
+            identifier = item.get(field)
+            if identifier is None or identifier == '':
+                continue
+            if not isinstance(identifier, (str, int)) or isinstance(identifier, bool):
+                errors[field] = ['Not a valid string.']
+                continue
+            identifier = str(identifier)
+            if field == 'email':
+                try:
+                    validate_email(identifier)
+                except DjangoValidationError:
+                    errors[field] = ['Enter a valid email address.']
+                    continue
+            event[field] = identifier
+
+        if not any(event.get(field) for field in self.IDENTIFIER_FIELDS) and not errors:
+            errors['non_field_errors'] = ["At least one identifier (device_id, email, or external_id) must be provided"]
+
+        return event, errors
+
+
+class EventBatchSerializer(serializers.Serializer):
+    """Serializer for a batch of events sent by the library."""
+    events = EventListField()
+
+    def validate_events(self, events):
+        """Limit the number of events per request."""
+        max_events = getattr(settings, 'EVENT_BATCH_MAX_EVENTS', 1000)
+        if len(events) > max_events:
+            raise serializers.ValidationError(f"At most {max_events} events can be sent per request")
+        return events
+
+
 class BulkVariantUpdateSerializer(serializers.Serializer):
     """Serializer for bulk updating variants of an experiment."""
     variants = serializers.ListField(
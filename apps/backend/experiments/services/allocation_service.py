@@ -0,0 +1,123 @@
+"""
+Maintenance of sticky bucket allocations and previews of rollout changes.
+
+Experiments with sticky allocation store the bucket ranges owned by each variant.
+When rollouts change, the ranges are rebalanced so only the buckets needed to
+reach the new rollouts change owner, which keeps most users on their variant.
+"""
+from typing import Any, Dict, List
+
+from ..models import Experiment
+from .bucketing import (
+    HASH_BUCKETS,
+    contiguous_owners,
+    owners_to_ranges,
+    ranges_to_owners,
+    rebalance_owners
+)
+from .enrollment_service import get_enrolled_total
+from .experiment_cache import invalidate_project_snapshot
+from .version_service import bump_config_version
+
+
+def _ordered_variants(experiment: Experiment):
+    variants = sorted(experiment.variants.all(), key=lambda variant: variant.id)
+    return [str(variant.id) for variant in variants], [variant.rollout for variant in variants]
+
+
+def current_owners(experiment: Experiment) -> List:
+    """
+    Owner of every bucket as the experiment assigns users right now.
+    Sticky experiments without stored ranges still assign contiguously.
+    """
+    if experiment.allocation == 'sticky' and experiment.bucket_ranges:
+        return ranges_to_owners(experiment.bucket_ranges)
+    return contiguous_owners(*_ordered_variants(experiment))
+
+
+def rebalance_sticky_allocation(experiment: Experiment) -> int:
+    """
+    Rebalance the stored bucket ranges of a sticky experiment after its variants changed.
+
+    The first rebalance stores the current contiguous allocation unchanged, so
+    switching an experiment to sticky allocation does not move any user.
+
+    Returns:
+        int: The number of buckets that moved between variants.
+    """
+    if experiment.allocation != 'sticky':
+        return 0
+
+    variant_ids, rollouts = _ordered_variants(experiment)
+
+    if experiment.bucket_ranges:
+        owners, moved = rebalance_owners(ranges_to_owners(experiment.bucket_ranges), variant_ids, rollouts)
+    else:
+        owners, moved = contiguous_owners(variant_ids, rollouts), 0
+
+    bucket_ranges = owners_to_ranges(owners)
+    if bucket_ranges != experiment.bucket_ranges:
+        # Update without save() to leave other fields and the Experiment signals alone
+        Experiment.objects.filter(id=experiment.id).update(bucket_ranges=bucket_ranges)
+        experiment.bucket_ranges = bucket_ranges
+        invalidate_project_snapshot(experiment.project_id)
+        bump_config_version(experiment.project_id)
+
+    return moved
+
+
+def sync_experiment_allocation(experiment: Experiment) -> bool:
+    """
+    Bring the stored bucket ranges in line with the experiment's allocation mode.
+
+    Returns:
+        bool: True if assignments changed and distributions need recalculating,
+            which happens when a sticky experiment goes back to contiguous allocation.
+    """
+    if experiment.allocation == 'sticky':
+        if not experiment.bucket_ranges:
+            rebalance_sticky_allocation(experiment)
+        return False
+
+    if experiment.bucket_ranges is not None:
+        Experiment.objects.filter(id=experiment.id).update(bucket_ranges=None)
+        experiment.bucket_ranges = None
+        invalidate_project_snapshot(experiment.project_id)
+        bump_config_version(experiment.project_id)
+        return True
+
+    return False
+
+
+def preview_rollout_change(experiment: Experiment, rollouts: Dict[str, float]) -> Dict[str, Any]:
+    """
+    Estimate how many users a rollout change would move to another variant.
+
+    Args:
+        experiment: The experiment to preview the change for.
+        rollouts: New rollout per variant id, variants not listed keep their rollout.
+
+    Returns:
+        dict: The number and fraction of buckets that would change variant, and
+            the estimated number of enrolled users in them.
+    """
+    variant_ids, current_rollouts = _ordered_variants(experiment)
+    new_rollouts = [float(rollouts.get(variant_id, rollout)) for variant_id, rollout in zip(variant_ids, current_rollouts)]
+
+    owners = current_owners(experiment)
+    if experiment.allocation == 'sticky':
+        _, moved = rebalance_owners(owners, variant_ids, new_rollouts)
+    else:
+        new_owners = contiguous_owners(variant_ids, new_rollouts)
+        moved = sum(1 for old, new in zip(owners, new_owners) if old is not None and old != new)
+
+    moved_fraction = moved / HASH_BUCKETS
+    enrolled = get_enrolled_total(experiment.id)
+
+    return {
+        'allocation': experiment.allocation,
+        'moved_buckets': moved,
+        'moved_fraction': round(moved_fraction, 4),
+        'enrolled_users': enrolled,
+        'estimated_moved_users': round(enrolled * moved_fraction),
+    }
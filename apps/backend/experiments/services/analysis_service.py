@@ -0,0 +1,270 @@
+"""
+Analysis of an experiment's variants over an event metric.
+
+Every distributed user gets a metric value from their events after they were
+distributed, and a covariate from their events before, for CUPED. The database
+reduces these per-user values to sufficient statistics per variant (count, sums,
+sums of squares and cross products) in one statement, so only one row per variant
+leaves it. Means, variances, lift, confidence intervals, two-sample z-tests and
+the CUPED adjustment are then computed with NumPy across all variants at once.
+
+Results are cached per experiment. The cache key contains the project's event
+version and the enrollment counters, so new events, new enrollments and
+recalculations all lead to a fresh analysis.
+"""
+import hashlib
+import math
+from statistics import NormalDist
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from ..models import Distribution, Event, Experiment
+from .enrollment_service import get_enrollment_counts
+from .version_service import get_event_version
+
+# How a user's events become their metric value
+AGGREGATIONS = {
+    # Sum of the event values, events without a value count as 1
+    'sum': "COALESCE(SUM(CASE WHEN {window} THEN COALESCE(e.value, 1) END), 0)",
+    # Number of events
+    'count': "COUNT(CASE WHEN {window} THEN 1 END)",
+    # 1 if the user has any event, else 0
+    'conversion': "COALESCE(MAX(CASE WHEN {window} THEN 1 ELSE 0 END), 0)",
+}
+
+# Columns of the per-variant statistics: n, sum y, sum y^2, sum x, sum x^2, sum xy
+MOMENT_COLUMNS = 6
+
+
+def fetch_variant_moments(experiment: Experiment, metric: str, aggregation: str) -> Dict[Any, np.ndarray]:
+    """
+    Compute the sufficient statistics of the metric (y) and its pre-distribution
+    covariate (x) for every variant of an experiment, in one statement.
+
+    Returns:
+        dict: [n, sum y, sum y^2, sum x, sum x^2, sum xy] per variant id.
+    """
+    quote = connection.ops.quote_name
+    post = AGGREGATIONS[aggregation].format(window="e.timestamp >= d.created_at")
+    pre = AGGREGATIONS[aggregation].format(window="e.timestamp < d.created_at")
+
+    sql = f"""
+        SELECT variant_id, COUNT(*), SUM(y), SUM(y * y), SUM(x), SUM(x * x), SUM(x * y)
+        FROM (
+            SELECT d.variant_id AS variant_id, {post} * 1.0 AS y, {pre} * 1.0 AS x
+            FROM {quote(Distribution._meta.db_table)} AS d
+            LEFT JOIN {quote(Event._meta.db_table)} AS e
+                ON e.user_id = d.user_id AND e.project_id = %s AND e.name = %s
+            WHERE d.experiment_id = %s
+            GROUP BY d.id, d.variant_id
+        ) AS per_user
+        GROUP BY variant_id
+    """
+    uuid_field = Distribution._meta.get_field('id')
+    params = [
+        uuid_field.get_db_prep_value(experiment.project_id, connection),
+        metric,
+        uuid_field.get_db_prep_value(experiment.id, connection),
+    ]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    variant_id_field = Distribution._meta.get_field('variant')
+    return {
+        variant_id_field.to_python(row[0]): np.asarray(row[1:], dtype=np.float64)
+        for row in rows
+    }
+
+
+def _or_none(values: np.ndarray) -> List[Optional[float]]:
+    """Convert an array to floats for JSON, with None for undefined values."""
+    return [float(value) if np.isfinite(value) else None for value in values]
+
+
+def analyze_moments(moments: np.ndarray, control: int, confidence: float = 0.95, cuped: bool = True) -> Dict[str, Any]:
+    """
+    Compare every variant against the control from their sufficient statistics.
+
+    Args:
+        moments: Array of shape (variants, 6) with n, sum y, sum y^2, sum x, sum x^2
+            and sum xy per variant, see fetch_variant_moments.
+        control: Row of the control variant.
+        confidence: Confidence level of the intervals.
+        cuped: Whether to adjust the metric with its pre-distribution covariate.
+
+    Returns:
+        dict: Arrays over the variants (means, variances, lift, intervals, z-scores
+            and p-values), and the CUPED coefficient and variance reduction.
+    """
+    n, sy, syy, sx, sxx, sxy = moments.T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_y = sy / n
+        mean_x = sx / n
+        # Sample variances and covariance per variant
+        var_y = (syy - n * mean_y ** 2) / (n - 1)
+        var_x = (sxx - n * mean_x ** 2) / (n - 1)
+        cov_xy = (sxy - n * mean_x * mean_y) / (n - 1)
+
+        # CUPED: theta is estimated on all users, so it does not depend on the variant
+        total_n, total_sy, total_syy, total_sx, total_sxx, total_sxy = moments.sum(axis=0)
+        pooled_var_x = (total_sxx - total_sx ** 2 / total_n) / (total_n - 1)
+        pooled_cov = (total_sxy - total_sx * total_sy / total_n) / (total_n - 1)
+        theta = pooled_cov / pooled_var_x if cuped and pooled_var_x > 0 else 0.0
+
+        mean = mean_y - theta * (mean_x - total_sx / total_n)
+        var = np.maximum(var_y - 2 * theta * cov_xy + theta ** 2 * var_x, 0)
+
+        pooled_var_y = (total_syy - total_sy ** 2 / total_n) / (total_n - 1)
+        pooled_var = pooled_var_y - 2 * theta * pooled_cov + theta ** 2 * pooled_var_x
+        variance_reduction = 1 - pooled_var / pooled_var_y if pooled_var_y > 0 else 0.0
+
+        # Two-sample z-test of every variant against the control, with unpooled variances
+        se2_variant = var / n
+        se2_control = se2_variant[control]
+        difference = mean - mean[control]
+        se = np.sqrt(se2_variant + se2_control)
+        z = difference / se
+        p_value = np.array([math.erfc(abs(value) / math.sqrt(2)) if np.isfinite(value) else np.nan for value in z])
+
+        critical = NormalDist().inv_cdf(0.5 + confidence / 2)
+        # Relative lift, with its standard error from the delta method
+        relative = difference / mean[control]
+        relative_se = np.sqrt(se2_variant / mean[control] ** 2 + mean ** 2 * se2_control / mean[control] ** 4)
+
+    return {
+        'n': n,
+        'mean': mean,
+        'unadjusted_mean': mean_y,
+        'std': np.sqrt(var),
+        'difference': difference,
+        'difference_ci': (difference - critical * se, difference + critical * se),
+        'relative_lift': relative,
+        'relative_lift_ci': (relative - critical * relative_se, relative + critical * relative_se),
+        'z': z,
+        'p_value': p_value,
+        'theta': float(theta),
+        'variance_reduction': float(variance_reduction) if np.isfinite(variance_reduction) else 0.0,
+    }
+
+
+def analyze_experiment(
+    experiment: Experiment,
+    metric: str,
+    aggregation: str = 'sum',
+    control_key: Optional[str] = None,
+    confidence: float = 0.95,
+    cuped: bool = True
+) -> Dict[str, Any]:
+    """
+    Analyze an experiment over an event metric.
+
+    Args:
+        experiment: The experiment to analyze.
+        metric: Name of the events the metric is computed from.
+        aggregation: "sum", "count" or "conversion", see AGGREGATIONS.
+        control_key: Key of the variant the others are compared against, defaults
+            to "control" if the experiment has one, else its first variant.
+        confidence: Confidence level of the intervals, between 0 and 1.
+        cuped: Whether to apply CUPED variance reduction.
+
+    Returns:
+        dict: The analysis settings, the CUPED adjustment and the results per variant.
+
+    Raises:
+        ValueError: If an argument is invalid.
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{aggregation}', use one of: {', '.join(AGGREGATIONS)}")
+    if not 0 < confidence < 1:
+        raise ValueError("Confidence must be between 0 and 1")
+
+    variants = sorted(experiment.variants.all(), key=lambda variant: variant.created_at)
+    if not variants:
+        raise ValueError("The experiment has no variants")
+
+    keys = [variant.key for variant in variants]
+    if control_key is None:
+        control_key = 'control' if 'control' in keys else keys[0]
+    if control_key not in keys:
+        raise ValueError(f"Unknown control variant '{control_key}'")
+    control = keys.index(control_key)
+
+    variant_moments = fetch_variant_moments(experiment, metric, aggregation)
+    empty = np.zeros(MOMENT_COLUMNS)
+    moments = np.stack([variant_moments.get(variant.id, empty) for variant in variants])
+    results = analyze_moments(moments, control, confidence, cuped)
+
+    columns = {
+        name: _or_none(results[name])
+        for name in ['mean', 'unadjusted_mean', 'std', 'difference', 'relative_lift', 'z', 'p_value']
+    }
+    intervals = {
+        name: list(zip(_or_none(results[name][0]), _or_none(results[name][1])))
+        for name in ['difference_ci', 'relative_lift_ci']
+    }
+
+    variant_results = []
+    for index, variant in enumerate(variants):
+        result = {
+            'id': str(variant.id),
+            'key': variant.key,
+            'users': int(results['n'][index]),
+            'mean': columns['mean'][index],
+            'unadjusted_mean': columns['unadjusted_mean'][index],
+            'std': columns['std'][index],
+        }
+        if index != control:
+            p_value = columns['p_value'][index]
+            result['comparison'] = {
+                'difference': columns['difference'][index],
+                'difference_ci': intervals['difference_ci'][index],
+                'relative_lift': columns['relative_lift'][index],
+                'relative_lift_ci': intervals['relative_lift_ci'][index],
+                'z': columns['z'][index],
+                'p_value': p_value,
+                'significant': p_value is not None and p_value < 1 - confidence,
+            }
+        variant_results.append(result)
+
+    return {
+        'metric': metric,
+        'aggregation': aggregation,
+        'confidence': confidence,
+        'control': control_key,
+        'cuped': {
+            'applied': results['theta'] != 0,
+            'theta': results['theta'],
+            'variance_reduction': results['variance_reduction'],
+        },
+        'variants': variant_results,
+    }
+
+
+def _analysis_cache_key(experiment: Experiment, params: Dict[str, Any]) -> str:
+    # Changes with new events, new enrollments, recalculations and variant changes
+    counts = sorted((str(variant_id), enrolled) for variant_id, enrolled in get_enrollment_counts(experiment.id).items())
+    variants = sorted((str(variant.id), variant.key) for variant in experiment.variants.all())
+    combined = f"{get_event_version(experiment.project_id)}:{counts}:{variants}:{sorted(params.items())}"
+    return f"experiment_analysis:{experiment.id}:{hashlib.sha256(combined.encode()).hexdigest()}"
+
+
+def get_experiment_analysis(experiment: Experiment, **params) -> Dict[str, Any]:
+    """
+    Cached version of analyze_experiment, with the same arguments.
+
+    Raises:
+        ValueError: If an argument is invalid.
+    """
+    key = _analysis_cache_key(experiment, params)
+    analysis = cache.get(key)
+    if analysis is None:
+        analysis = analyze_experiment(experiment, **params)
+        cache.set(key, analysis, timeout=getattr(settings, 'ANALYSIS_CACHE_TTL', 3600))
+    return analysis
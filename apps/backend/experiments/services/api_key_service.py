@@ -0,0 +1,230 @@
+"""
+Resolution of API keys to projects, shared by the middleware, DRF authentication
+and the WebSocket consumer.
+
+Results, including unknown keys, are kept in a per-worker LRU cache with a TTL.
+With API_KEY_CACHE_REDIS enabled, the default Django cache (Redis) is used as a
+second tier shared by all workers. Entries are dropped when a project is saved,
+deleted or gets a new API key. Expired entries are kept until they are replaced,
+and used while the database breaker is open or the database is unavailable.
+
+Invalidations bump a generation in the default cache. Workers check it at most
+every API_KEY_CACHE_SYNC_INTERVAL seconds and drop their entries when it changed,
+so a revoked key stops working in every worker within that interval.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+
+from ..models import Project
+from .circuit_breaker import CircuitOpenError, database_breaker
+
+logger = logging.getLogger(__name__)
+
+# Marks a key as not cached, as opposed to cached as unknown (None)
+_MISSING = object()
+# Stored in the shared cache for unknown keys, since None means a cache miss there
+_NOT_FOUND = 'not_found'
+
+_GENERATION_KEY = 'api_key_cache_generation'
+
+_lock = threading.Lock()
+_entries: 'OrderedDict[str, Tuple[float, Optional[Project]]]' = OrderedDict()
+# The generation the worker's entries belong to, and when it was last checked
+_generation = None
+_generation_checked_at = float('-inf')
+
+
+def _shared_cache_key(api_key: str) -> str:
+    # Hashed so API keys do not show up in Redis key names
+    return f"api_key_project:{hashlib.sha256(api_key.encode()).hexdigest()}"
+
+
+def _ttl(project: Optional[Project]) -> float:
+    if project is None:
+        return getattr(settings, 'API_KEY_CACHE_NEGATIVE_TTL', 30)
+    return getattr(settings, 'API_KEY_CACHE_TTL', 60)
+
+
+def _generation_due() -> bool:
+    global _generation_checked_at
+    now = time.monotonic()
+    with _lock:
+        if now - _generation_checked_at < getattr(settings, 'API_KEY_CACHE_SYNC_INTERVAL', 1):
+            return False
+        _generation_checked_at = now
+        return True
+
+
+def _apply_generation(generation) -> None:
+    global _generation
+    with _lock:
+        if generation != _generation:
+            # Another worker invalidated a key
+            _entries.clear()
+            _generation = generation
+
+
+def _sync_generation() -> None:
+    if _generation_due():
+        try:
+            generation = cache.get(_GENERATION_KEY)
+        except Exception:
+            # Keep serving the worker's entries while the cache is unavailable
+            logger.warning("Could not check the API key cache generation", exc_info=True)
+            return
+        _apply_generation(generation)
+
+
+async def _async_generation() -> None:
+    if _generation_due():
+        try:
+            generation = await cache.aget(_GENERATION_KEY)
+        except Exception:
+            logger.warning("Could not check the API key cache generation", exc_info=True)
+            return
+        _apply_generation(generation)
+
+
+def _bump_generation() -> None:
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:
+        # Missing or evicted, start from the clock so an old generation is not reused
+        cache.set(_GENERATION_KEY, time.time_ns(), timeout=None)
+
+
+def _local_get(api_key: str, allow_expired: bool = False):
+    with _lock:
+        entry = _entries.get(api_key)
+        if entry is None:
+            return _MISSING
+
+        expires_at, project = entry
+        if expires_at <= time.monotonic() and not allow_expired:
+            return _MISSING
+
+        _entries.move_to_end(api_key)
+        return project
+
+
+def _local_set(api_key: str, project: Optional[Project]) -> None:
+    max_size = getattr(settings, 'API_KEY_CACHE_SIZE', 1024)
+    with _lock:
+        _entries[api_key] = (time.monotonic() + _ttl(project), project)
+        _entries.move_to_end(api_key)
+        while len(_entries) > max_size:
+            _entries.popitem(last=False)
+
+
+def get_project_by_api_key(api_key: Optional[str]) -> Optional[Project]:
+    """
+    Get the project an API key belongs to.
+
+    Returns:
+        Project or None: The project, or None if the key is unknown.
+    """
+    if not api_key:
+        return None
+
+    _sync_generation()
+    project = _local_get(api_key)
+    if project is not _MISSING:
+        return project
+
+    use_shared_cache = getattr(settings, 'API_KEY_CACHE_REDIS', False)
+    if use_shared_cache:
+        cached = cache.get(_shared_cache_key(api_key))
+        if cached is not None:
+            project = None if cached == _NOT_FOUND else cached
+            _local_set(api_key, project)
+            return project
+
+    try:
+        with database_breaker.guard():
+            project = Project.objects.filter(api_key=api_key).first()
+    except (CircuitOpenError, DatabaseError):
+        # Keep serving the project last known for the key while the database is unavailable
+        project = _local_get(api_key, allow_expired=True)
+        if project is _MISSING:
+            raise
+        return project
+
+    _local_set(api_key, project)
+    if use_shared_cache:
+        cache.set(_shared_cache_key(api_key), project if project else _NOT_FOUND, timeout=_ttl(project))
+
+    return project
+
+
+async def aget_project_by_api_key(api_key: Optional[str]) -> Optional[Project]:
+    """
+    Async version of get_project_by_api_key. Keys cached by the worker are
+    resolved without leaving the event loop.
+    """
+    if not api_key:
+        return None
+
+    await _async_generation()
+    project = _local_get(api_key)
+    if project is not _MISSING:
+        return project
+
+    use_shared_cache = getattr(settings, 'API_KEY_CACHE_REDIS', False)
+    if use_shared_cache:
+        cached = await cache.aget(_shared_cache_key(api_key))
+        if cached is not None:
+            project = None if cached == _NOT_FOUND else cached
+            _local_set(api_key, project)
+            return project
+
+    try:
+        with database_breaker.guard():
+            project = await Project.objects.filter(api_key=api_key).afirst()
+    except (CircuitOpenError, DatabaseError):
+        # Keep serving the project last known for the key while the database is unavailable
+        project = _local_get(api_key, allow_expired=True)
+        if project is _MISSING:
+            raise
+        return project
+
+    _local_set(api_key, project)
+    if use_shared_cache:
+        await cache.aset(_shared_cache_key(api_key), project if project else _NOT_FOUND, timeout=_ttl(project))
+
+    return project
+
+
+def invalidate_api_key(api_key: Optional[str]) -> None:
+    """Drop the cached project of an API key, in every worker."""
+    if not api_key:
+        return
+
+    with _lock:
+        _entries.pop(api_key, None)
+
+    if getattr(settings, 'API_KEY_CACHE_REDIS', False):
+        cache.delete(_shared_cache_key(api_key))
+
+    # Other workers drop their entries at their next generation check
+    _bump_generation()
+
+
+def invalidate_project(project: Project) -> None:
+    """
+    Drop every cached entry of a project, including entries for its previous API keys
+    in this worker. Previous keys in the shared cache must be dropped with invalidate_api_key.
+    """
+    with _lock:
+        for api_key, (_, cached) in list(_entries.items()):
+            if cached is not None and cached.pk == project.pk:
+                del _entries[api_key]
+
+    invalidate_api_key(project.api_key)
@@ -0,0 +1,129 @@
+"""
+Redis store of user assignments, in front of the Distribution table.
+
+Every user has a hash, assignments:{user_id}, mapping experiment ids to variant
+ids. Library lookups read the hashes of their users with one pipelined round
+trip and only read distributions for the pairs the store is missing, which are
+then copied into it. New assignments are written to the hashes first and queued
+in the assignments:pending set, which the assignment flusher (see
+variant_service.AssignmentBuffer) writes to the Distribution table in batches.
+
+Entries are updated when a recalculation moves users and when a distribution is
+saved or deleted one by one. Entries whose variant was deleted are ignored by
+the callers and reconciled with the database.
+
+Enabled with the ASSIGNMENT_STORE setting, which needs django_redis as the default cache.
+"""
+from itertools import islice
+from typing import Dict, Iterable, List, Mapping, Set, Tuple
+from uuid import UUID
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# (user id, experiment id)
+AssignmentPair = Tuple[UUID, UUID]
+
+PENDING_KEY = 'assignments:pending'
+
+# Commands per pipeline when many entries are written at once
+PIPELINE_BATCH_SIZE = 1000
+
+
+def is_store_enabled() -> bool:
+    """Whether assignments are served from the Redis store."""
+    return (
+        getattr(settings, 'ASSIGNMENT_STORE', False)
+        and settings.CACHES['default']['BACKEND'].startswith('django_redis.')
+    )
+
+
+def _user_key(user_id) -> str:
+    return f"assignments:{user_id}"
+
+
+def _ttl() -> int:
+    return getattr(settings, 'ASSIGNMENT_STORE_TTL', 7 * 24 * 60 * 60)
+
+
+def _by_user(pairs: Iterable[AssignmentPair]) -> Dict[UUID, List[UUID]]:
+    users: Dict[UUID, List[UUID]] = {}
+    for user_id, experiment_id in pairs:
+        users.setdefault(user_id, []).append(experiment_id)
+    return users
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def get_assignments(user_ids: Iterable[UUID], experiment_ids: List[UUID]) -> Dict[AssignmentPair, UUID]:
+    """
+    Read the stored variants of some users in some experiments, in one round trip.
+
+    Returns:
+        dict: The variant id of every (user id, experiment id) pair in the store.
+    """
+    user_ids = list(user_ids)
+    if not user_ids or not experiment_ids:
+        return {}
+
+    fields = [str(experiment_id) for experiment_id in experiment_ids]
+    pipeline = get_redis_connection('default').pipeline(transaction=False)
+    for user_id in user_ids:
+        pipeline.hmget(_user_key(user_id), fields)
+
+    assignments = {}
+    for user_id, values in zip(user_ids, pipeline.execute()):
+        for experiment_id, value in zip(experiment_ids, values):
+            if value is not None:
+                assignments[(user_id, experiment_id)] = UUID(value.decode())
+    return assignments
+
+
+def set_assignments(assignments: Mapping[AssignmentPair, UUID]) -> None:
+    """Write the variants of some (user id, experiment id) pairs to the store."""
+    users: Dict[UUID, Dict[str, str]] = {}
+    for (user_id, experiment_id), variant_id in assignments.items():
+        users.setdefault(user_id, {})[str(experiment_id)] = str(variant_id)
+
+    redis = get_redis_connection('default')
+    ttl = _ttl()
+    for batch in _batches(users.items(), PIPELINE_BATCH_SIZE):
+        pipeline = redis.pipeline(transaction=False)
+        for user_id, mapping in batch:
+            pipeline.hset(_user_key(user_id), mapping=mapping)
+            pipeline.expire(_user_key(user_id), ttl)
+        pipeline.execute()
+
+
+def delete_assignments(pairs: Iterable[AssignmentPair]) -> None:
+    """Remove (user id, experiment id) pairs from the store, so they are read from the database again."""
+    redis = get_redis_connection('default')
+    for batch in _batches(_by_user(pairs).items(), PIPELINE_BATCH_SIZE):
+        pipeline = redis.pipeline(transaction=False)
+        for user_id, experiment_ids in batch:
+            pipeline.hdel(_user_key(user_id), *[str(experiment_id) for experiment_id in experiment_ids])
+        pipeline.execute()
+
+
+def queue_pending(pairs: Iterable[AssignmentPair]) -> None:
+    """Queue (user id, experiment id) pairs whose distribution still has to be written."""
+    members = [f"{user_id}:{experiment_id}" for user_id, experiment_id in pairs]
+    if members:
+        get_redis_connection('default').sadd(PENDING_KEY, *members)
+
+
+def pop_pending(count: int) -> Set[AssignmentPair]:
+    """
+    Take up to count queued pairs. Every pair is taken by one worker only, callers
+    that fail to write them should queue them again.
+    """
+    members = get_redis_connection('default').spop(PENDING_KEY, count) or []
+    pairs = set()
+    for member in members:
+        user_id, experiment_id = member.decode().split(':')
+        pairs.add((UUID(user_id), UUID(experiment_id)))
+    return pairs
@@ -0,0 +1,130 @@
+"""
+Signed assignment tokens for the library API.
+
+User experiments responses carry a token in the X-Assignment-Token header listing
+the user's id, the config and user versions and the variant of every running
+experiment. Clients send it back with later requests, which are then answered from
+the token and the cached snapshot of the project's experiments, without resolving
+the user or reading distributions.
+
+Tokens are signed with the SECRET_KEY (HMAC-SHA256, see django.core.signing),
+bound to the project and the request parameters they were issued for, and only
+accepted while the config and user versions are unchanged and they are younger than
+ASSIGNMENT_TOKEN_MAX_AGE seconds. Anything else falls back to the full lookup.
+"""
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, Mapping, Optional
+from uuid import UUID
+
+from django.conf import settings
+from django.core import signing
+
+from .version_service import aget_versions, get_versions
+
+ASSIGNMENT_TOKEN_HEADER = 'X-Assignment-Token'
+
+_SALT = 'experiments.assignment_token'
+
+
+@dataclass(frozen=True)
+class AssignmentToken:
+    """The contents of a valid assignment token."""
+    user_id: UUID
+    config_version: int
+    user_version: int
+    # Experiment id -> variant id
+    variant_ids: Dict[UUID, UUID]
+
+
+def _salt(project_id) -> str:
+    return f"{_SALT}:{project_id}"
+
+
+def _params_digest(params: str) -> str:
+    return hashlib.sha256(params.encode()).hexdigest()[:16]
+
+
+def issue_assignment_token(
+    project_id,
+    params: str,
+    user_id: UUID,
+    config_version: int,
+    user_version: int,
+    variant_ids: Mapping[UUID, UUID]
+) -> str:
+    """
+    Sign an assignment token.
+
+    Args:
+        project_id: The project the token is valid for.
+        params: The request parameters the token is valid for, see query_params_key.
+        user_id: The id of the user.
+        config_version: The config version the variants were assigned at.
+        user_version: The user version the variants were assigned at.
+        variant_ids: The variant id of the user in every running experiment, by experiment id.
+
+    Returns:
+        str: The signed token.
+    """
+    payload = [
+        user_id.hex,
+        config_version,
+        user_version,
+        _params_digest(params),
+        {experiment_id.hex: variant_id.hex for experiment_id, variant_id in variant_ids.items()}
+    ]
+    return signing.dumps(payload, salt=_salt(project_id), compress=True)
+
+
+def load_assignment_token(project_id, params: str, token: str) -> Optional[AssignmentToken]:
+    """
+    Check the signature, age and request parameters of a token, without checking its versions.
+
+    Returns:
+        AssignmentToken or None: The token's contents, or None if it is not valid for the request.
+    """
+    try:
+        payload = signing.loads(
+            token,
+            salt=_salt(project_id),
+            max_age=getattr(settings, 'ASSIGNMENT_TOKEN_MAX_AGE', 24 * 60 * 60)
+        )
+        user_id, config_version, user_version, params_digest, variant_ids = payload
+        if params_digest != _params_digest(params):
+            return None
+        return AssignmentToken(
+            user_id=UUID(user_id),
+            config_version=config_version,
+            user_version=user_version,
+            variant_ids={UUID(experiment_id): UUID(variant_id) for experiment_id, variant_id in variant_ids.items()}
+        )
+    except (signing.BadSignature, TypeError, ValueError, AttributeError):
+        return None
+
+
+def match_assignment_token(project_id, params: str, token: str) -> Optional[AssignmentToken]:
+    """
+    Check a token against the request and the current config and user versions.
+
+    Returns:
+        AssignmentToken or None: The token's contents, or None if it is not valid or not current.
+    """
+    assignment = load_assignment_token(project_id, params, token)
+    if assignment is None:
+        return None
+
+    if get_versions(project_id, assignment.user_id) != (assignment.config_version, assignment.user_version):
+        return None
+    return assignment
+
+
+async def amatch_assignment_token(project_id, params: str, token: str) -> Optional[AssignmentToken]:
+    """Async version of match_assignment_token."""
+    assignment = load_assignment_token(project_id, params, token)
+    if assignment is None:
+        return None
+
+    if await aget_versions(project_id, assignment.user_id) != (assignment.config_version, assignment.user_version):
+        return None
+    return assignment
@@ -0,0 +1,289 @@
+"""
+Deterministic bucketing of users into experiment variants.
+
+Nothing in this module touches the database: experiments are compiled into
+immutable objects that can be cached per worker and shared between threads.
+"""
+import hashlib
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+# Number of hash buckets a user can fall into for a given experiment
+HASH_BUCKETS = 10000
+
+
+def get_hash_bucket(user_id: str, experiment_id: str) -> int:
+    """
+    Create a deterministic bucket between 0 and HASH_BUCKETS - 1 based on user_id and experiment_id.
+    """
+    combined = f"{user_id}:{experiment_id}"
+    hash_digest = hashlib.md5(combined.encode()).digest()
+    return int.from_bytes(hash_digest, 'big') % HASH_BUCKETS
+
+
+def get_hash_number(user_id: str, experiment_id: str) -> float:
+    """
+    Create a deterministic hash between 0 and 1 based on user_id and experiment_id.
+    This ensures consistent variant assignment for the same user-experiment pair.
+    """
+    return get_hash_bucket(user_id, experiment_id) / HASH_BUCKETS
+
+
+def _bucket_bound(boundary: float) -> int:
+    """
+    Return the smallest bucket whose hash number is greater than or equal to the boundary.
+    Buckets below the returned value fall strictly before the boundary.
+    """
+    bucket = min(max(int(boundary * HASH_BUCKETS), 0), HASH_BUCKETS)
+    while bucket < HASH_BUCKETS and bucket / HASH_BUCKETS < boundary:
+        bucket += 1
+    while bucket > 0 and (bucket - 1) / HASH_BUCKETS >= boundary:
+        bucket -= 1
+    return bucket
+
+
+def contiguous_ranges(rollouts: List[float]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """
+    Split the bucket space into contiguous ranges proportional to the rollouts.
+
+    Rollouts are normalized so they sum to 1, in the order they are given.
+    Returns the exclusive upper bucket of every range and the index of the
+    variant that owns it.
+    """
+    total_rollout = sum(rollouts)
+    if total_rollout <= 0:
+        return (), ()
+
+    nonzero = [index for index, rollout in enumerate(rollouts) if rollout > 0]
+    if len(nonzero) == 1:
+        return (HASH_BUCKETS,), (nonzero[0],)
+
+    bounds = []
+    accumulated = 0
+    for rollout in rollouts:
+        accumulated += rollout / total_rollout
+        bounds.append(_bucket_bound(accumulated))
+
+    return tuple(bounds), tuple(range(len(rollouts)))
+
+
+def range_bucket_counts(bounds: Sequence[int], range_variants: Sequence[int], variant_count: int) -> List[int]:
+    """
+    Count the buckets each variant owns given range bounds, as CompiledExperiment.assign_bucket
+    assigns them: buckets past the last boundary fall back to the last variant.
+    """
+    counts = [0] * variant_count
+    start = 0
+    for end, index in zip(bounds, range_variants):
+        counts[index] += max(end - start, 0)
+        start = max(start, end)
+    if bounds and start < HASH_BUCKETS:
+        counts[-1] += HASH_BUCKETS - start
+    return counts
+
+
+def allocation_targets(rollouts: List[float]) -> List[int]:
+    """
+    Split HASH_BUCKETS into per-variant bucket counts proportional to the rollouts.
+    The counts are those of contiguous_ranges, so moving an experiment between
+    contiguous and sticky allocation does not change any variant's share.
+    """
+    return range_bucket_counts(*contiguous_ranges(rollouts), len(rollouts))
+
+
+def ranges_to_owners(ranges: Iterable[Sequence]) -> List[Optional[str]]:
+    """Expand [start, end, owner] ranges into the owner of every bucket."""
+    owners = [None] * HASH_BUCKETS
+    for start, end, owner in ranges:
+        owners[start:end] = [owner] * (end - start)
+    return owners
+
+
+def owners_to_ranges(owners: List[Optional[str]]) -> List[list]:
+    """Compress the owner of every bucket into [start, end, owner] ranges, skipping unowned buckets."""
+    ranges = []
+    for bucket, owner in enumerate(owners):
+        if ranges and ranges[-1][2] == owner and ranges[-1][1] == bucket:
+            ranges[-1][1] = bucket + 1
+        elif owner is not None:
+            ranges.append([bucket, bucket + 1, owner])
+    return ranges
+
+
+def contiguous_owners(variant_ids: List[str], rollouts: List[float]) -> List[Optional[str]]:
+    """Owner of every bucket under contiguous allocation, variants given in id order."""
+    bounds, range_variants = contiguous_ranges(rollouts)
+    ranges = []
+    start = 0
+    for end, index in zip(bounds, range_variants):
+        if end > start:
+            ranges.append((start, end, variant_ids[index]))
+        start = max(start, end)
+    if bounds and start < HASH_BUCKETS:
+        # Buckets past the last boundary fall back to the last variant
+        ranges.append((start, HASH_BUCKETS, variant_ids[-1]))
+    return ranges_to_owners(ranges)
+
+
+def rebalance_owners(
+    owners: List[Optional[str]],
+    variant_ids: List[str],
+    rollouts: List[float]
+) -> Tuple[List[Optional[str]], int]:
+    """
+    Move the fewest buckets needed for each variant to own its share of the rollout.
+
+    Variants above their target release their highest buckets, and variants below it
+    take the lowest free buckets. Buckets of variants that no longer exist are free.
+
+    Returns:
+        tuple: The new owner of every bucket, and how many buckets moved between
+            existing variants (the fraction of enrolled users that change variant).
+    """
+    targets = dict(zip(variant_ids, allocation_targets(rollouts)))
+    new_owners = [owner if owner in targets else None for owner in owners]
+
+    counts = dict.fromkeys(variant_ids, 0)
+    for owner in new_owners:
+        if owner is not None:
+            counts[owner] += 1
+
+    # Release excess buckets, starting from the top of the bucket space
+    excess = {variant_id: counts[variant_id] - targets[variant_id] for variant_id in variant_ids}
+    for bucket in range(HASH_BUCKETS - 1, -1, -1):
+        owner = new_owners[bucket]
+        if owner is not None and excess[owner] > 0:
+            new_owners[bucket] = None
+            excess[owner] -= 1
+            counts[owner] -= 1
+
+    # Hand free buckets to the variants below their target, starting from the bottom
+    free_buckets = (bucket for bucket in range(HASH_BUCKETS) if new_owners[bucket] is None)
+    for variant_id in variant_ids:
+        for _ in range(targets[variant_id] - counts[variant_id]):
+            new_owners[next(free_buckets)] = variant_id
+
+    moved = sum(
+        1 for old, new in zip(owners, new_owners)
+        if old in targets and old != new
+    )
+    return new_owners, moved
+
+
+@dataclass(frozen=True)
+class CompiledVariant:
+    """Read-only copy of a variant's configuration."""
+    id: UUID
+    key: str
+    payload: Any
+    rollout: float
+
+
+@dataclass(frozen=True)
+class CompiledExperiment:
+    """
+    Read-only copy of an experiment with its bucket boundaries precomputed.
+    Assigning a user only needs a hash and a binary search over the boundaries.
+    """
+    id: UUID
+    key: str
+    name: str
+    status: str
+    type: str
+    project_id: UUID
+    variants: Tuple[CompiledVariant, ...]
+    bounds: Tuple[int, ...]
+    range_variants: Tuple[int, ...]
+    # How assignments are persisted: "stored", "deferred" or "stateless", see Experiment.assignment
+    assignment: str = 'stored'
+
+    def get_variant(self, variant_id) -> Optional[CompiledVariant]:
+        """Find a variant of this experiment by its id."""
+        for variant in self.variants:
+            if variant.id == variant_id or str(variant.id) == str(variant_id):
+                return variant
+        return None
+
+    def assign_bucket(self, bucket: int) -> CompiledVariant:
+        """Return the variant that owns the given hash bucket."""
+        if not self.variants:
+            raise ValueError(f"Experiment {self.key} has no variants")
+        if not self.bounds:
+            raise ValueError(f"Experiment {self.key} has no variants with a positive rollout")
+
+        index = bisect_right(self.bounds, bucket)
+        if index >= len(self.bounds):
+            # Fallback to the last variant if something goes wrong
+            return self.variants[-1]
+        return self.variants[self.range_variants[index]]
+
+    def assign(self, user_id) -> CompiledVariant:
+        """Deterministically assign a user to a variant of this experiment."""
+        return self.assign_bucket(get_hash_bucket(str(user_id), str(self.id)))
+
+
+def _sticky_ranges(bucket_ranges, variants: Tuple[CompiledVariant, ...]):
+    """
+    Convert stored [start, end, variant_id] ranges into bounds and range variants.
+    Returns (None, None) if the ranges do not cover every bucket with an existing
+    variant, so the caller can fall back to contiguous allocation until they are rebalanced.
+    """
+    indexes = {str(variant.id): index for index, variant in enumerate(variants)}
+    bounds = []
+    range_variants = []
+    expected_start = 0
+
+    for start, end, variant_id in bucket_ranges:
+        if start != expected_start or str(variant_id) not in indexes:
+            return None, None
+        bounds.append(end)
+        range_variants.append(indexes[str(variant_id)])
+        expected_start = end
+
+    if expected_start != HASH_BUCKETS:
+        return None, None
+    return tuple(bounds), tuple(range_variants)
+
+
+def compile_experiment(experiment, variants: Optional[Iterable] = None) -> CompiledExperiment:
+    """
+    Compile an experiment and its variants into a CompiledExperiment.
+
+    Variants are ordered by id, so boundaries match the historical assignment order.
+    Experiments with sticky allocation use their stored bucket ranges instead.
+    If variants are not given, they are read from experiment.variants (which uses
+    the prefetch cache when the experiment was loaded with prefetch_related).
+    """
+    if variants is None:
+        variants = experiment.variants.all()
+
+    ordered = sorted(variants, key=lambda variant: variant.id)
+    compiled_variants = tuple(
+        CompiledVariant(
+            id=variant.id,
+            key=variant.key,
+            payload=variant.payload,
+            rollout=variant.rollout
+        )
+        for variant in ordered
+    )
+    bounds, range_variants = None, None
+    if getattr(experiment, 'allocation', 'contiguous') == 'sticky' and experiment.bucket_ranges:
+        bounds, range_variants = _sticky_ranges(experiment.bucket_ranges, compiled_variants)
+    if bounds is None:
+        bounds, range_variants = contiguous_ranges([variant.rollout for variant in compiled_variants])
+
+    return CompiledExperiment(
+        id=experiment.id,
+        key=experiment.key,
+        name=experiment.name,
+        status=experiment.status,
+        type=experiment.type,
+        project_id=experiment.project_id,
+        variants=compiled_variants,
+        bounds=bounds,
+        range_variants=range_variants,
+        assignment=getattr(experiment, 'assignment', 'stored')
+    )
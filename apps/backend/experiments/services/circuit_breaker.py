@@ -0,0 +1,141 @@
+"""
+Circuit breaker around the database work of the library endpoints.
+
+Every worker has one breaker for the database. It counts calls that failed to
+reach the database (CONNECTION_ERRORS), and calls slower than DB_BREAKER_SLOW_CALL_SECONDS, over the last DB_BREAKER_WINDOW_SECONDS.
+When DB_BREAKER_FAILURE_THRESHOLD of them add up, the breaker opens: calls are
+rejected right away and the library endpoints serve degraded responses (see
+degraded_service) instead of waiting on the database. After DB_BREAKER_RESET_SECONDS
+one call is let through; the breaker closes if it succeeds and opens again otherwise.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Errors of an unavailable database. Errors of a query's data, like IntegrityError,
+# say nothing about the database's health and are left to the caller
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the database while the breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Counts failures over a rolling window and rejects calls while too many happened.
+    Thread-safe, shared by all requests of a worker.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = deque()
+        self._opened_at = 0.0
+        self._probing = False
+        # Counters exposed as metrics
+        self._trips = 0
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= getattr(settings, 'DB_BREAKER_RESET_SECONDS', 5):
+            self._state = HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may be attempted. In the half open state only one call is let through."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._rejected += 1
+            return False
+
+    def record_success(self, duration: float) -> None:
+        """Record a call that succeeded, slow calls count as failures."""
+        if duration >= getattr(settings, 'DB_BREAKER_SLOW_CALL_SECONDS', 1.0):
+            self.record_failure()
+            return
+
+        with self._lock:
+            if self._state != CLOSED:
+                self._state = CLOSED
+                self._failures.clear()
+            self._probing = False
+
+    def record_failure(self) -> None:
+        """Record a failed call, opening the breaker if there were too many."""
+        now = time.monotonic()
+        window = getattr(settings, 'DB_BREAKER_WINDOW_SECONDS', 10)
+        threshold = getattr(settings, 'DB_BREAKER_FAILURE_THRESHOLD', 5)
+
+        with self._lock:
+            self._failures.append(now)
+            while self._failures and self._failures[0] <= now - window:
+                self._failures.popleft()
+
+            if self._state == HALF_OPEN or (self._state == CLOSED and len(self._failures) >= threshold):
+                self._state = OPEN
+                self._opened_at = now
+                self._trips += 1
+            self._probing = False
+
+    @contextmanager
+    def guard(self):
+        """
+        Run a block of database work through the breaker.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, without running the block.
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"The {self.name} circuit breaker is open")
+
+        started = time.monotonic()
+        try:
+            yield
+        except CONNECTION_ERRORS:
+            self.record_failure()
+            raise
+        except BaseException:
+            # Not the database's availability, only release the probe
+            with self._lock:
+                self._probing = False
+            raise
+        self.record_success(time.monotonic() - started)
+
+    def metrics(self) -> Dict[str, Any]:
+        """The breaker's state and counters."""
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            window = getattr(settings, 'DB_BREAKER_WINDOW_SECONDS', 10)
+            return {
+                'state': state,
+                'open': state != CLOSED,
+                'recent_failures': sum(1 for failed_at in self._failures if failed_at > now - window),
+                'trips': self._trips,
+                'rejected_calls': self._rejected,
+                'open_seconds': round(now - self._opened_at, 3) if state != CLOSED else 0,
+            }
+
+
+database_breaker = CircuitBreaker('database')
@@ -0,0 +1,251 @@
+"""
+Serving of the library endpoints while the database is unavailable.
+
+When the database breaker is open, or a request's database work fails, variants
+are computed from the last snapshot of the project's running experiments this
+worker built, with the same hashing as normal serving. Nothing is written.
+
+Hashing needs the user's id. It is taken from the request, or from the per-worker
+cache of users served before. Other users get no degraded response, a variant
+hashed from anything else than their id would change once the database is back.
+With the assignment store, stored variants are read from Redis, so known users
+keep their assignment.
+
+The user and distribution writes that were skipped are kept per worker and
+backfilled once the breaker lets calls through again.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+
+from ..models import Project, ProjectUser
+from .assignment_store import get_assignments, is_store_enabled
+from .bucketing import CompiledExperiment, CompiledVariant
+from .circuit_breaker import CONNECTION_ERRORS, CircuitOpenError, database_breaker
+from .experiment_cache import get_last_known_snapshot, get_project_snapshot
+from .variant_service import IDENTIFIER_FIELDS, OPTIONAL_FIELDS, get_or_create_distributions, get_or_create_user
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# (project id, identifier field, value) -> user id, of users served before
+_known_users: 'OrderedDict[Tuple[Any, str, Any], Any]' = OrderedDict()
+# (project id, identifier data) -> experiment ids the user was served without writes
+_skipped_writes: 'OrderedDict[Tuple, Tuple[Dict[str, Any], set]]' = OrderedDict()
+_backfiller = None
+# Counters exposed as metrics
+_degraded_responses = 0
+_dropped_writes = 0
+
+
+def remember_user(project_id, identifier_data: Dict[str, Any], user_id) -> None:
+    """Remember the id of a user by their identifiers, for hashing while the database is unavailable."""
+    max_size = getattr(settings, 'DEGRADED_USER_CACHE_SIZE', 10000)
+    with _lock:
+        for field in IDENTIFIER_FIELDS:
+            value = identifier_data.get(field)
+            if value:
+                key = (project_id, field, value)
+                _known_users[key] = user_id
+                _known_users.move_to_end(key)
+        while len(_known_users) > max_size:
+            _known_users.popitem(last=False)
+
+
+def _user_id(project_id, identifier_data: Dict[str, Any]) -> Optional[UUID]:
+    """The user's id, from the request or the users served before. None if it is unknown."""
+    if identifier_data.get('id'):
+        # Hashed as the normal path does, with the canonical form of the UUID
+        try:
+            return ProjectUser._meta.get_field('id').to_python(identifier_data['id'])
+        except ValidationError:
+            return None
+
+    with _lock:
+        for field in IDENTIFIER_FIELDS:
+            user_id = _known_users.get((project_id, field, identifier_data.get(field)))
+            if user_id is not None:
+                return user_id
+    return None
+
+
+def _record_skipped_write(project_id, identifier_data: Dict[str, Any], experiment_ids) -> None:
+    global _backfiller, _degraded_responses, _dropped_writes
+    key = (project_id, tuple(identifier_data.get(field) for field in ['id'] + IDENTIFIER_FIELDS))
+    max_size = getattr(settings, 'DEGRADED_MAX_SKIPPED_WRITES', 10000)
+
+    with _lock:
+        _degraded_responses += 1
+        if key in _skipped_writes:
+            data, pending_experiment_ids = _skipped_writes[key]
+            data.update(identifier_data)
+            pending_experiment_ids.update(experiment_ids)
+        else:
+            _skipped_writes[key] = (dict(identifier_data), set(experiment_ids))
+        while len(_skipped_writes) > max_size:
+            _skipped_writes.popitem(last=False)
+            _dropped_writes += 1
+
+        if _backfiller is None:
+            _backfiller = threading.Thread(target=_run_backfiller, name='degraded-backfill', daemon=True)
+            _backfiller.start()
+
+
+def degraded_assignments(
+    project_id,
+    identifier_data: Dict[str, Any],
+    experiment_key: Optional[str] = None
+) -> Optional[Tuple[ProjectUser, List[CompiledExperiment], Dict]]:
+    """
+    Assign a user without the database, in one running experiment or in all of them.
+
+    Args:
+        project_id: The project's id.
+        identifier_data: Validated user identification data.
+        experiment_key: The experiment to assign the user in, all running experiments if None.
+
+    Returns:
+        tuple: An unsaved user, the experiments and the variant for every (user id,
+            experiment id) pair, like get_or_create_distributions. None if the worker
+            has no configuration for the project, cannot assign users in the experiment
+            or does not know the user's id.
+    """
+    snapshot = get_last_known_snapshot(project_id)
+    if snapshot is None:
+        return None
+
+    if experiment_key is None:
+        experiments = list(snapshot.experiments.values())
+    else:
+        experiment = snapshot.get(experiment_key)
+        if experiment is None or not experiment.bounds:
+            return None
+        experiments = [experiment]
+    experiments = [experiment for experiment in experiments if experiment.bounds]
+
+    user_id = _user_id(project_id, identifier_data)
+    if user_id is None:
+        return None
+
+    user = ProjectUser(
+        id=user_id,
+        project_id=project_id,
+        **{field: identifier_data.get(field) for field in IDENTIFIER_FIELDS + OPTIONAL_FIELDS},
+        properties=identifier_data.get('properties') or {}
+    )
+
+    stored = {}
+    if is_store_enabled():
+        try:
+            stored = get_assignments([user_id], [experiment.id for experiment in experiments])
+        except Exception:
+            logger.warning("Assignment store unavailable while serving degraded assignments", exc_info=True)
+
+    variants: Dict[Tuple[Any, Any], CompiledVariant] = {}
+    for experiment in experiments:
+        variant = experiment.get_variant(stored.get((user_id, experiment.id)))
+        variants[(user.id, experiment.id)] = variant or experiment.assign(user_id)
+
+    _record_skipped_write(project_id, identifier_data, [experiment.id for experiment in experiments])
+    return user, experiments, variants
+
+
+def _backfill_user(project: Project, identifier_data: Dict[str, Any], experiment_ids) -> None:
+    user = get_or_create_user(project, identifier_data)
+    experiments = [
+        experiment for experiment in get_project_snapshot(project.id).experiments.values()
+        if experiment.id in experiment_ids
+    ]
+    get_or_create_distributions([user], experiments)
+
+
+def backfill_skipped_writes() -> int:
+    """
+    Create the users and distributions skipped while serving degraded responses.
+    Returns the number of users backfilled.
+
+    Every user goes through the breaker on its own, so a large backfill is not
+    taken for one slow call. Writes that fail for another reason than an unavailable
+    database, e.g. an unknown user id or an integrity error, are logged and dropped.
+
+    Raises:
+        CircuitOpenError: If the database breaker is open, the writes are kept.
+    """
+    global _dropped_writes
+    with _lock:
+        pending = list(_skipped_writes.items())
+        _skipped_writes.clear()
+
+    if not pending:
+        return 0
+
+    done = 0
+    projects = None
+    try:
+        for (project_id, _), (identifier_data, experiment_ids) in pending:
+            with database_breaker.guard():
+                if projects is None:
+                    projects = Project.objects.in_bulk({project_id for (project_id, _), _ in pending})
+                project = projects.get(project_id)
+                if project is not None:
+                    try:
+                        _backfill_user(project, identifier_data, experiment_ids)
+                    except CONNECTION_ERRORS:
+                        raise
+                    except Exception:
+                        logger.warning(
+                            "Dropping a write skipped in degraded mode for project %s: %s",
+                            project_id, identifier_data, exc_info=True
+                        )
+                        with _lock:
+                            _dropped_writes += 1
+            done += 1
+    except Exception:
+        # Keep the writes that were not done, in front of the ones recorded meanwhile
+        with _lock:
+            remaining = OrderedDict(pending[done:])
+            remaining.update(_skipped_writes)
+            _skipped_writes.clear()
+            _skipped_writes.update(remaining)
+        raise
+
+    return done
+
+
+def _run_backfiller() -> None:
+    global _backfiller
+    interval = getattr(settings, 'DEGRADED_BACKFILL_INTERVAL', 5)
+
+    while True:
+        time.sleep(interval)
+        try:
+            # Goes through the breaker, once it lets a call through the backfill is its probe
+            backfill_skipped_writes()
+        except CircuitOpenError:
+            pass
+        except Exception:
+            logger.exception("Failed to backfill writes skipped in degraded mode")
+        finally:
+            close_old_connections()
+
+        with _lock:
+            if not _skipped_writes:
+                _backfiller = None
+                return
+
+
+def degraded_metrics() -> Dict[str, Any]:
+    """Counters of the degraded responses served by this worker."""
+    with _lock:
+        return {
+            'degraded_responses': _degraded_responses,
+            'skipped_writes_pending': len(_skipped_writes),
+            'skipped_writes_dropped': _dropped_writes,
+        }
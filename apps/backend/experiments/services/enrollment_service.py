@@ -0,0 +1,133 @@
+"""
+Per-variant enrollment counters.
+
+Every write that creates, moves or deletes distributions updates the
+VariantEnrollment rows of the affected variants in the same transaction, so
+distribution stats read one row per variant instead of counting distributions.
+"""
+import uuid
+from collections import Counter
+from typing import Dict, Iterable, Mapping, Tuple
+from uuid import UUID
+
+from django.db import connection, transaction
+from django.db.models import Count, F
+
+from ..models import Distribution, VariantEnrollment
+
+
+def enrollment_upsert_sql(source: str) -> str:
+    """
+    SQL adding the rows of source, a relation with experiment_id and variant_id
+    columns, to the enrollment counters. Meant to be used in a WITH clause after
+    the statement inserting the distributions, so both happen in one statement.
+    Requires PostgreSQL.
+    """
+    table = connection.ops.quote_name(VariantEnrollment._meta.db_table)
+    return f"""
+        INSERT INTO {table} (id, experiment_id, variant_id, enrolled)
+        SELECT gen_random_uuid(), experiment_id, variant_id, COUNT(*)
+        FROM {source}
+        GROUP BY experiment_id, variant_id
+        ON CONFLICT (experiment_id, variant_id)
+        DO UPDATE SET enrolled = {table}.enrolled + EXCLUDED.enrolled
+    """
+
+
+def update_enrollment_counts(deltas: Mapping[Tuple[UUID, UUID], int]) -> None:
+    """
+    Add to the enrollment counters of some variants.
+
+    Args:
+        deltas: The change of the count for every (experiment id, variant id) pair.
+            The variants must exist.
+    """
+    deltas = {pair: delta for pair, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    table = connection.ops.quote_name(VariantEnrollment._meta.db_table)
+    values = ', '.join(['(%s, %s, %s, %s)'] * len(deltas))
+    sql = f"""
+        INSERT INTO {table} (id, experiment_id, variant_id, enrolled)
+        VALUES {values}
+        ON CONFLICT (experiment_id, variant_id)
+        DO UPDATE SET enrolled = {table}.enrolled + EXCLUDED.enrolled
+    """
+
+    field = VariantEnrollment._meta.get_field('id')
+    params = []
+    # Sorted, so concurrent updates lock the counter rows in the same order
+    for (experiment_id, variant_id), delta in sorted(deltas.items(), key=lambda item: (str(item[0][0]), str(item[0][1]))):
+        params.extend([
+            field.get_db_prep_value(uuid.uuid4(), connection),
+            field.get_db_prep_value(experiment_id, connection),
+            field.get_db_prep_value(variant_id, connection),
+            delta
+        ])
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def count_distributions(distributions: Iterable[Distribution]) -> Counter:
+    """Count distributions by (experiment id, variant id), for update_enrollment_counts."""
+    return Counter((distribution.experiment_id, distribution.variant_id) for distribution in distributions)
+
+
+def remove_enrollment(experiment_id, variant_id) -> None:
+    """
+    Decrement the counter of a variant after one of its distributions was deleted.
+    Nothing happens if the counter is gone, e.g. with its variant.
+    """
+    VariantEnrollment.objects.filter(
+        experiment_id=experiment_id,
+        variant_id=variant_id
+    ).update(enrolled=F('enrolled') - 1)
+
+
+def get_enrollment_counts(experiment_id) -> Dict[UUID, int]:
+    """Get the number of users distributed to each variant of an experiment."""
+    return dict(
+        VariantEnrollment.objects.filter(experiment_id=experiment_id).values_list('variant_id', 'enrolled')
+    )
+
+
+def get_enrolled_total(experiment_id) -> int:
+    """Get the number of users distributed in an experiment."""
+    return sum(get_enrollment_counts(experiment_id).values())
+
+
+def rebuild_enrollment_counts(experiment_id) -> Dict[UUID, int]:
+    """
+    Recount the distributions of an experiment and overwrite its counters.
+
+    Only needed after distributions were written outside of the services, e.g.
+    with manual SQL. The existing counters are locked while counting, so
+    assignments made meanwhile wait and are counted once.
+
+    Returns:
+        dict: The number of users distributed to each variant.
+    """
+    with transaction.atomic():
+        counters = VariantEnrollment.objects.select_for_update().filter(experiment_id=experiment_id)
+        stale_variant_ids = set(counters.values_list('variant_id', flat=True))
+
+        counts = dict(
+            Distribution.objects.filter(
+                experiment_id=experiment_id
+            ).order_by().values_list('variant_id').annotate(count=Count('id'))
+        )
+
+        counters.filter(variant_id__in=stale_variant_ids - counts.keys()).update(enrolled=0)
+        VariantEnrollment.objects.bulk_create(
+            [
+                VariantEnrollment(experiment_id=experiment_id, variant_id=variant_id, enrolled=count)
+                for variant_id, count in counts.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['experiment', 'variant'],
+            update_fields=['enrolled']
+        )
+
+    return counts
@@ -0,0 +1,395 @@
+"""
+Ingestion of exposure and conversion events.
+
+A batch of events is resolved in one pass: users through get_or_create_users,
+experiments through the cached project snapshot and the users' variants with one
+distribution query, or computed for stateless and deferred experiments. The resulting rows are appended to a per-process buffer,
+which a background thread writes every EVENT_FLUSH_INTERVAL seconds with one
+COPY on PostgreSQL, or bulk_create batches elsewhere.
+
+On PostgreSQL the event table is partitioned by day of the event timestamp.
+Missing partitions are created before a flush writes to them.
+"""
+import atexit
+import csv
+import io
+import logging
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, InterfaceError, OperationalError, close_old_connections, connection, transaction
+from django.utils import timezone
+
+from ..models import Distribution, Event, Experiment, Project
+from .assignment_store import get_assignments, is_store_enabled
+from .bucketing import CompiledExperiment, compile_experiment
+from .experiment_cache import get_project_snapshot
+from .variant_service import IDENTIFIER_FIELDS, get_or_create_users
+from .version_service import bump_event_version
+
+logger = logging.getLogger(__name__)
+
+# Columns of a buffered event row, in COPY order
+EVENT_COLUMNS = [
+    'id', 'project_id', 'user_id', 'experiment_id', 'variant_id',
+    'name', 'value', 'timestamp', 'received_at'
+]
+
+# SQLSTATEs of a partition created concurrently: duplicate_table, and unique_violation
+# on the system catalogs
+_DUPLICATE_TABLE_CODES = {'42P07', '23505'}
+
+# Days whose partition this process created or found
+_known_partitions: Set[date] = set()
+
+EventRow = Tuple[uuid.UUID, uuid.UUID, uuid.UUID, Optional[uuid.UUID], Optional[uuid.UUID],
+                 str, Optional[float], datetime, datetime]
+
+
+def _partition_name(day: date) -> str:
+    return f"{Event._meta.db_table}_p{day:%Y%m%d}"
+
+
+def ensure_event_partitions(days: Set[date]) -> None:
+    """
+    Create the daily partitions of the event table for the given days (UTC).
+    Only needed on PostgreSQL, where an event without a partition cannot be inserted.
+    """
+    table = connection.ops.quote_name(Event._meta.db_table)
+    for day in sorted(days - _known_partitions):
+        start = datetime.combine(day, datetime.min.time(), tzinfo=dt_timezone.utc)
+        sql = f"""
+            CREATE TABLE IF NOT EXISTS {connection.ops.quote_name(_partition_name(day))}
+            PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)
+        """
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [start, start + timedelta(days=1)])
+        except DatabaseError as e:
+            # Created concurrently by another worker, IF NOT EXISTS can still race on the catalog
+            if getattr(e.__cause__, 'pgcode', None) not in _DUPLICATE_TABLE_CODES:
+                raise
+            logger.debug("Event partition for %s already exists", day)
+        # Not before the partition is committed, a rolled back one has to be created again
+        transaction.on_commit(partial(_known_partitions.add, day))
+
+
+def _copy_events(rows: Sequence[EventRow]) -> None:
+    """Write event rows with a single COPY statement. Requires PostgreSQL."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        # Unquoted empty fields are NULL in COPY's csv format
+        writer.writerow(['' if value is None else value for value in row])
+
+    table = connection.ops.quote_name(Event._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(column) for column in EVENT_COLUMNS)
+    sql = f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)"
+
+    with connection.cursor() as cursor:
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, 'copy_expert'):
+            # psycopg2
+            buffer.seek(0)
+            raw_cursor.copy_expert(sql, buffer)
+        else:
+            # psycopg 3
+            with raw_cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+
+
+def write_events(rows: Sequence[EventRow]) -> int:
+    """
+    Write event rows, with COPY on PostgreSQL and bulk_create batches elsewhere,
+    and bump the event version of their projects. Returns the number of events written.
+    """
+    if not rows:
+        return 0
+
+    if connection.vendor != 'postgresql':
+        Event.objects.bulk_create(
+            [Event(**dict(zip(EVENT_COLUMNS, row))) for row in rows],
+            batch_size=getattr(settings, 'EVENT_BATCH_SIZE', 5000)
+        )
+    else:
+        ensure_event_partitions({row[7].astimezone(dt_timezone.utc).date() for row in rows})
+        _copy_events(rows)
+
+    # Cached analyses of the projects' experiments are stale now
+    for project_id in {row[1] for row in rows}:
+        bump_event_version(project_id)
+
+    return len(rows)
+
+
+class EventBuffer:
+    """
+    Collects event rows and writes them in batches of EVENT_BATCH_SIZE.
+
+    At most EVENT_MAX_PENDING rows are buffered, the oldest ones are dropped when
+    the buffer is full. A batch that fails because the database is unreachable is
+    kept for the next flush. A batch that keeps failing for other reasons is written
+    row by row after EVENT_MAX_FLUSH_ATTEMPTS attempts and the rows that still fail
+    are dropped, so one bad row does not hold back the events recorded after it.
+    Like the user activity buffer, events are lost if the process is killed before a flush.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Flushes run one at a time, so failed attempts are counted for the same first batch
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending: List[EventRow] = []
+        self._attempts = 0
+        self._flusher = None
+        # Events dropped by this buffer, because it was full or their rows could not be written
+        self.dropped = 0
+
+    def record(self, rows: List[EventRow]) -> None:
+        """
+        Buffer event rows. Never writes them itself, a full batch wakes the flusher.
+        """
+        with self._lock:
+            self._pending.extend(rows)
+            self._drop_excess()
+            pending_count = len(self._pending)
+
+        self._start_flusher()
+        if pending_count >= getattr(settings, 'EVENT_BATCH_SIZE', 5000):
+            self._wake.set()
+
+    def flush(self) -> int:
+        """
+        Write all buffered events. Returns the number of events written.
+
+        Raises:
+            Exception: If a batch could not be written. It is kept with the
+                following ones for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+
+            written = 0
+            batch_size = getattr(settings, 'EVENT_BATCH_SIZE', 5000)
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                try:
+                    written += self._write_batch(batch)
+                except Exception:
+                    # Put the unwritten events back in front of the ones recorded meanwhile
+                    with self._lock:
+                        self._pending[:0] = batch + pending[start + batch_size:]
+                        self._drop_excess()
+                    raise
+            return written
+
+    def _write_batch(self, batch: List[EventRow]) -> int:
+        """
+        Write a batch, or its rows one by one once it failed EVENT_MAX_FLUSH_ATTEMPTS times.
+        Rows written one by one are removed from the batch.
+        """
+        try:
+            written = write_events(batch)
+        except (OperationalError, InterfaceError):
+            # The database is unreachable, that is no reason to give up on the batch
+            raise
+        except Exception:
+            with self._lock:
+                self._attempts += 1
+                attempts = self._attempts
+            if attempts < getattr(settings, 'EVENT_MAX_FLUSH_ATTEMPTS', 5):
+                raise
+            logger.exception("Failed to write a batch of %d events %d times, writing them one by one", len(batch), attempts)
+            written = self._write_rows(batch)
+
+        with self._lock:
+            self._attempts = 0
+        return written
+
+    def _write_rows(self, batch: List[EventRow]) -> int:
+        written = 0
+        while batch:
+            try:
+                written += write_events(batch[:1])
+            except (OperationalError, InterfaceError):
+                raise
+            except Exception:
+                with self._lock:
+                    self.dropped += 1
+                logger.exception("Dropped event %s that could not be written (%d dropped in total)", batch[0][0], self.dropped)
+            del batch[0]
+        return written
+
+    def _drop_excess(self) -> None:
+        """Drop the oldest rows beyond EVENT_MAX_PENDING. Called with the lock held."""
+        excess = len(self._pending) - getattr(settings, 'EVENT_MAX_PENDING', 50000)
+        if excess <= 0:
+            return
+
+        del self._pending[:excess]
+        # The first batch is a different one now
+        self._attempts = 0
+        self.dropped += excess
+        logger.warning("Event buffer is full, dropped the %d oldest events (%d dropped in total)", excess, self.dropped)
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='event-flusher', daemon=True)
+            self._flusher.start()
+            # Registered once per buffer, by the thread that started the flusher
+            atexit.register(self._flush_at_exit)
+
+    def _flush_at_exit(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to flush buffered events at exit")
+
+    def _run_flusher(self) -> None:
+        interval = getattr(settings, 'EVENT_FLUSH_INTERVAL', 1)
+
+        while True:
+            # Woken early by record when a full batch is buffered
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered events")
+            finally:
+                close_old_connections()
+
+
+event_buffer = EventBuffer()
+
+
+_IDENTITY_FIELDS = ['id'] + IDENTIFIER_FIELDS
+
+
+def _identity(event: Dict[str, Any]) -> Tuple:
+    return tuple(event.get(field) for field in _IDENTITY_FIELDS)
+
+
+def _experiments(project: Project, keys: Set[str]) -> Dict[str, CompiledExperiment]:
+    """The project's compiled experiments with the given keys, running ones from the snapshot."""
+    snapshot = get_project_snapshot(project.id)
+    experiments = {key: snapshot.get(key) for key in keys if snapshot.get(key) is not None}
+
+    missing_keys = keys - experiments.keys()
+    if missing_keys:
+        # Events may arrive after an experiment was completed
+        stored_experiments = Experiment.objects.filter(project=project, key__in=missing_keys).prefetch_related('variants')
+        for experiment in stored_experiments:
+            experiments[experiment.key] = compile_experiment(experiment)
+    return experiments
+
+
+def _variant_ids(
+    user_ids: Set[uuid.UUID],
+    experiments: List[CompiledExperiment]
+) -> Dict[Tuple[uuid.UUID, uuid.UUID], uuid.UUID]:
+    """
+    Find the variants the library serves the users, without assigning them.
+
+    Stored variants come from the assignment store, when enabled, and from the
+    distributions. The variants of stateless experiments, and of deferred ones
+    whose distribution is not written yet, are computed like the library does.
+    """
+    variant_ids = {}
+    if is_store_enabled():
+        variant_ids.update(get_assignments(
+            user_ids, [experiment.id for experiment in experiments if experiment.assignment != 'stateless']
+        ))
+
+    if len(variant_ids) < len(user_ids) * len(experiments):
+        for user_id, experiment_id, variant_id in Distribution.objects.filter(
+            user_id__in=user_ids,
+            experiment_id__in=[experiment.id for experiment in experiments]
+        ).values_list('user_id', 'experiment_id', 'variant_id'):
+            variant_ids.setdefault((user_id, experiment_id), variant_id)
+
+    for experiment in experiments:
+        # Users of stored experiments have no variant until they are assigned one
+        if experiment.assignment == 'stored' or not experiment.bounds:
+            continue
+        for user_id in user_ids:
+            if (user_id, experiment.id) not in variant_ids:
+                variant_ids[(user_id, experiment.id)] = experiment.assign(user_id).id
+
+    return variant_ids
+
+
+def ingest_events(project: Project, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Resolve a batch of events and buffer them for writing.
+
+    Every distinct user is resolved once, through get_or_create_users, and the
+    users' variants are resolved like the library serves them, see _variant_ids.
+    Events do not assign users, an event of a user who was never assigned a
+    variant of a stored experiment is stored without one.
+
+    Args:
+        project: The project the events belong to.
+        events: Validated events, see EventListField.
+
+    Returns:
+        dict: The number of accepted events, and the experiment keys that were not found.
+    """
+    received_at = timezone.now()
+
+    # Resolve every distinct user once, by identifiers only
+    event_identities = [_identity(event) for event in events]
+    identities = list(dict.fromkeys(event_identities))
+    users = get_or_create_users(project, [
+        {field: value for field, value in zip(_IDENTITY_FIELDS, identity) if value}
+        for identity in identities
+    ])
+    user_ids = {identity: user.id for identity, user in zip(identities, users)}
+
+    experiment_keys = {event['experiment'] for event in events if event.get('experiment')}
+    experiments = _experiments(project, experiment_keys) if experiment_keys else {}
+    experiment_ids = {key: experiment.id for key, experiment in experiments.items()}
+    variant_ids = _variant_ids(set(user_ids.values()), list(experiments.values())) if experiments else {}
+
+    rows = []
+    for event, identity in zip(events, event_identities):
+        user_id = user_ids[identity]
+        experiment_id = experiment_ids.get(event.get('experiment'))
+        rows.append((
+            uuid.uuid4(),
+            project.id,
+            user_id,
+            experiment_id,
+            variant_ids.get((user_id, experiment_id)),
+            event['name'],
+            event.get('value'),
+            event.get('timestamp') or received_at,
+            received_at
+        ))
+
+    if getattr(settings, 'EVENT_BUFFER', True):
+        event_buffer.record(rows)
+    else:
+        write_events(rows)
+
+    return {
+        'accepted': len(rows),
+        'missing_experiments': sorted(experiment_keys - experiment_ids.keys())
+    }
+
+
+def flush_events() -> int:
+    """Write all buffered events now. Returns the number of events written."""
+    return event_buffer.flush()
@@ -0,0 +1,188 @@
+"""
+Per-worker cache of compiled running experiments, grouped by project.
+
+Snapshots are immutable and rebuilt lazily: saving or deleting an Experiment or
+Variant drops the affected snapshot (see experiments.signals), and every snapshot
+expires after EXPERIMENT_SNAPSHOT_TTL seconds so changes made by other workers
+are picked up as well. Callers that know the project's current config version
+(see version_service) get a snapshot rebuilt as soon as the version moves on.
+The last snapshot of every project is also kept past expiry and invalidation,
+for serving while the database is unavailable (see degraded_service).
+"""
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional
+
+from django.conf import settings
+
+from ..models import Experiment
+from .bucketing import CompiledExperiment, compile_experiment
+
+_lock = threading.Lock()
+_snapshots: Dict[str, 'ProjectSnapshot'] = {}
+# Last snapshot built for every project, kept through invalidations for degraded serving
+_last_known: Dict[str, 'ProjectSnapshot'] = {}
+# Bumped on every invalidation so snapshots built from stale reads are not stored
+_generation = 0
+
+
+@dataclass(frozen=True)
+class ProjectSnapshot:
+    """Compiled running experiments of a project, keyed by experiment key."""
+    project_id: str
+    experiments: Mapping[str, CompiledExperiment]
+    built_at: float
+    # Config version the snapshot was built at, if known
+    version: Optional[int] = None
+
+    def get(self, experiment_key: str) -> Optional[CompiledExperiment]:
+        return self.experiments.get(experiment_key)
+
+    def get_by_id(self, experiment_id) -> Optional[CompiledExperiment]:
+        for experiment in self.experiments.values():
+            if str(experiment.id) == str(experiment_id):
+                return experiment
+        return None
+
+
+def _snapshot_ttl() -> float:
+    return getattr(settings, 'EXPERIMENT_SNAPSHOT_TTL', 30)
+
+
+def _compile_snapshot(project_id, experiments, version: Optional[int]) -> ProjectSnapshot:
+    compiled = {experiment.key: compile_experiment(experiment) for experiment in experiments}
+    return ProjectSnapshot(
+        project_id=str(project_id),
+        experiments=MappingProxyType(compiled),
+        built_at=time.monotonic(),
+        version=version
+    )
+
+
+def _running_experiments(project_id):
+    return Experiment.objects.filter(
+        project_id=project_id,
+        status='running'
+    ).prefetch_related('variants')
+
+
+def build_project_snapshot(project_id, version: Optional[int] = None) -> ProjectSnapshot:
+    """
+    Load and compile all running experiments of a project.
+    Costs two queries: one for the experiments and one for their variants.
+    """
+    return _compile_snapshot(project_id, _running_experiments(project_id), version)
+
+
+async def abuild_project_snapshot(project_id, version: Optional[int] = None) -> ProjectSnapshot:
+    """Async version of build_project_snapshot."""
+    experiments = [experiment async for experiment in _running_experiments(project_id)]
+    return _compile_snapshot(project_id, experiments, version)
+
+
+def _cached_snapshot(key: str, version: Optional[int]):
+    """Return the cached snapshot if it is still valid, and the current generation."""
+    with _lock:
+        snapshot = _snapshots.get(key)
+        generation = _generation
+
+    if (
+        snapshot is not None
+        and time.monotonic() - snapshot.built_at < _snapshot_ttl()
+        and (version is None or snapshot.version == version)
+    ):
+        return snapshot, generation
+    return None, generation
+
+
+def _store_snapshot(key: str, snapshot: ProjectSnapshot, generation: int) -> None:
+    with _lock:
+        # Only store the snapshot if nothing was invalidated while it was being built
+        if generation == _generation:
+            _snapshots[key] = snapshot
+        _last_known[key] = snapshot
+
+
+def get_project_snapshot(project_id, version: Optional[int] = None) -> ProjectSnapshot:
+    """
+    Get the cached snapshot for a project, building it if it is missing or expired.
+
+    If the project's current config version is given, a snapshot built at another
+    version is rebuilt as well. The version must be read before calling this, so
+    the snapshot is never older than the version it is tagged with.
+    """
+    key = str(project_id)
+    snapshot, generation = _cached_snapshot(key, version)
+    if snapshot is not None:
+        return snapshot
+
+    snapshot = build_project_snapshot(project_id, version)
+    _store_snapshot(key, snapshot, generation)
+    return snapshot
+
+
+async def aget_project_snapshot(project_id, version: Optional[int] = None) -> ProjectSnapshot:
+    """Async version of get_project_snapshot."""
+    key = str(project_id)
+    snapshot, generation = _cached_snapshot(key, version)
+    if snapshot is not None:
+        return snapshot
+
+    snapshot = await abuild_project_snapshot(project_id, version)
+    _store_snapshot(key, snapshot, generation)
+    return snapshot
+
+
+def find_cached_experiment(experiment_id) -> Optional[CompiledExperiment]:
+    """
+    Find a running experiment in the snapshots cached by this worker, without
+    building any. None if no current snapshot contains it.
+    """
+    with _lock:
+        snapshots = list(_snapshots.values())
+
+    now = time.monotonic()
+    for snapshot in snapshots:
+        if now - snapshot.built_at < _snapshot_ttl():
+            experiment = snapshot.get_by_id(experiment_id)
+            if experiment is not None:
+                return experiment
+    return None
+
+
+def get_last_known_snapshot(project_id) -> Optional[ProjectSnapshot]:
+    """
+    Get the last snapshot this worker built for a project, however old, without
+    touching the database. Used to serve assignments while the database is unavailable.
+    """
+    with _lock:
+        return _last_known.get(str(project_id))
+
+
+def invalidate_project_snapshot(project_id) -> None:
+    """Drop the cached snapshot of a project."""
+    global _generation
+    with _lock:
+        _generation += 1
+        _snapshots.pop(str(project_id), None)
+
+
+def invalidate_experiment_snapshots(experiment_id) -> None:
+    """Drop every cached snapshot that contains the given experiment."""
+    global _generation
+    with _lock:
+        _generation += 1
+        for key, snapshot in list(_snapshots.items()):
+            if snapshot.get_by_id(experiment_id) is not None:
+                del _snapshots[key]
+
+
+def clear_snapshots() -> None:
+    """Drop all cached snapshots."""
+    global _generation
+    with _lock:
+        _generation += 1
+        _snapshots.clear()
+        _last_known.clear()
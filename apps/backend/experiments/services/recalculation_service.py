@@ -0,0 +1,415 @@
+"""
+Recalculation of stored distributions after an experiment's variants change.
+
+Two engines are available:
+- "bulk" streams (distribution_id, user_id, variant_id) tuples in chunks,
+  buckets them with NumPy and writes changes back with bulk_update.
+- "sql" computes the buckets inside PostgreSQL and reassigns every
+  distribution of the experiment in a single UPDATE statement.
+
+Recalculations triggered by variant changes are queued as RecalculationJob rows,
+debounced per experiment and run by the run_recalculation_worker command.
+"""
+import hashlib
+from collections import Counter
+from datetime import timedelta
+from itertools import islice
+from typing import Callable, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from ..models import Experiment, Distribution, RecalculationJob
+from ..notifications import distribution_notifications_suppressed, notify_distribution_changes
+from .assignment_store import is_store_enabled, set_assignments
+from .bucketing import HASH_BUCKETS, CompiledExperiment, compile_experiment
+from .enrollment_service import get_enrolled_total, update_enrollment_counts
+from .version_service import bump_config_version
+
+# (user_id, new variant_id) of a distribution whose variant changed
+DistributionChange = Tuple[UUID, UUID]
+
+
+# Bucket of a distribution computed in SQL, equivalent to bucketing.get_hash_bucket.
+# "h" is md5(user_id || ':' || experiment_id); its 128-bit value is reduced modulo
+# HASH_BUCKETS one 32-bit word at a time so the arithmetic fits in a bigint.
+# The modulo operator is escaped as %% because the statement is run with parameters.
+_BUCKET_SQL = """
+    ((((((('x' || substr(h, 1, 8))::bit(32)::bigint %% {buckets}) * 4294967296
+        + ('x' || substr(h, 9, 8))::bit(32)::bigint) %% {buckets}) * 4294967296
+        + ('x' || substr(h, 17, 8))::bit(32)::bigint) %% {buckets}) * 4294967296
+        + ('x' || substr(h, 25, 8))::bit(32)::bigint) %% {buckets}
+""".format(buckets=HASH_BUCKETS)
+
+
+def _chunk_size() -> int:
+    return getattr(settings, 'RECALCULATION_CHUNK_SIZE', 5000)
+
+
+def get_hash_buckets(user_ids: Iterable, experiment_id) -> np.ndarray:
+    """
+    Compute the hash bucket of many users at once.
+    Gives the same buckets as bucketing.get_hash_bucket.
+    """
+    suffix = f":{experiment_id}".encode()
+    digests = b''.join(hashlib.md5(str(user_id).encode() + suffix).digest() for user_id in user_ids)
+
+    # Reduce each 128-bit digest modulo HASH_BUCKETS one 32-bit word at a time
+    words = np.frombuffer(digests, dtype='>u4').reshape(-1, 4).astype(np.uint64)
+    buckets = np.zeros(len(words), dtype=np.uint64)
+    for column in range(4):
+        buckets = (buckets * np.uint64(1 << 32) + words[:, column]) % np.uint64(HASH_BUCKETS)
+
+    return buckets.astype(np.int64)
+
+
+def assign_buckets(experiment: CompiledExperiment, buckets: np.ndarray) -> np.ndarray:
+    """
+    Map hash buckets to indexes into experiment.variants.
+    Vectorized equivalent of CompiledExperiment.assign_bucket.
+    """
+    bounds = np.asarray(experiment.bounds, dtype=np.int64)
+    # Buckets past the last boundary fall back to the last variant
+    range_variants = np.asarray(experiment.range_variants + (len(experiment.variants) - 1,), dtype=np.int64)
+    return range_variants[np.searchsorted(bounds, buckets, side='right')]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def recalculate_distributions_bulk(
+    experiment: CompiledExperiment,
+    chunk_size: Optional[int] = None,
+    progress: Optional[Callable[[int], None]] = None
+) -> List[DistributionChange]:
+    """
+    Reassign every distribution of an experiment in batches, and move the
+    reassigned users between the variants' enrollment counters.
+
+    Args:
+        experiment: The compiled experiment to recalculate.
+        chunk_size: Number of distributions fetched, bucketed and written per batch.
+        progress: Optional callback receiving the number of distributions processed so far.
+
+    Returns:
+        list: (user_id, variant_id) pairs for the distributions that changed.
+    """
+    if not experiment.bounds:
+        # No variant can receive users, keep the current assignments
+        return []
+
+    chunk_size = chunk_size or _chunk_size()
+    variant_ids = [variant.id for variant in experiment.variants]
+    variant_indexes = {variant_id: index for index, variant_id in enumerate(variant_ids)}
+
+    rows = Distribution.objects.filter(
+        experiment_id=experiment.id
+    ).values_list('id', 'user_id', 'variant_id').iterator(chunk_size=chunk_size)
+
+    changes = []
+    deltas = Counter()
+    processed = 0
+
+    for chunk in _chunks(rows, chunk_size):
+        buckets = get_hash_buckets((user_id for _, user_id, _ in chunk), experiment.id)
+        expected = assign_buckets(experiment, buckets)
+        current = np.fromiter(
+            (variant_indexes.get(variant_id, -1) for _, _, variant_id in chunk),
+            dtype=np.int64,
+            count=len(chunk)
+        )
+
+        now = timezone.now()
+        updates = []
+        for position in np.flatnonzero(expected != current):
+            distribution_id, user_id, previous_variant_id = chunk[position]
+            variant_id = variant_ids[expected[position]]
+            updates.append(Distribution(id=distribution_id, variant_id=variant_id, updated_at=now))
+            changes.append((user_id, variant_id))
+            deltas[(experiment.id, previous_variant_id)] -= 1
+            deltas[(experiment.id, variant_id)] += 1
+
+        if updates:
+            Distribution.objects.bulk_update(updates, ['variant', 'updated_at'])
+
+        processed += len(chunk)
+        if progress:
+            progress(processed)
+
+    update_enrollment_counts(deltas)
+    return changes
+
+
+def recalculate_distributions_sql(experiment: CompiledExperiment) -> List[DistributionChange]:
+    """
+    Reassign every distribution of an experiment with one set-based UPDATE.
+
+    The bucket ranges of the compiled experiment are sent as a VALUES list and
+    joined against buckets computed by PostgreSQL, so no rows leave the database
+    except the ones that changed. Their previous variants are returned as well,
+    to move the users between the variants' enrollment counters.
+
+    Returns:
+        list: (user_id, variant_id) pairs for the distributions that changed.
+    """
+    if connection.vendor != 'postgresql':
+        raise ValueError("SQL recalculation requires PostgreSQL")
+
+    if not experiment.bounds:
+        # No variant can receive users, keep the current assignments
+        return []
+
+    # (lower bucket, upper bucket, variant id) for every non-empty range
+    ranges = []
+    lower = 0
+    for upper, variant_index in zip(experiment.bounds, experiment.range_variants):
+        if upper > lower:
+            ranges.append((lower, upper, str(experiment.variants[variant_index].id)))
+        lower = max(lower, upper)
+    if lower < HASH_BUCKETS:
+        # Buckets past the last boundary fall back to the last variant
+        ranges.append((lower, HASH_BUCKETS, str(experiment.variants[-1].id)))
+
+    table = connection.ops.quote_name(Distribution._meta.db_table)
+    values = ', '.join(['(%s, %s, %s::uuid)'] * len(ranges))
+    sql = f"""
+        UPDATE {table} AS d
+        SET variant_id = r.variant_id, updated_at = %s
+        FROM (
+            SELECT id, previous_variant_id, {_BUCKET_SQL} AS bucket
+            FROM (
+                SELECT id, variant_id AS previous_variant_id, md5(user_id::text || ':' || experiment_id::text) AS h
+                FROM {table}
+                WHERE experiment_id = %s
+            ) AS hashed
+        ) AS b
+        JOIN (VALUES {values}) AS r(lower_bucket, upper_bucket, variant_id)
+            ON b.bucket >= r.lower_bucket AND b.bucket < r.upper_bucket
+        WHERE d.id = b.id AND d.variant_id <> r.variant_id
+        RETURNING d.user_id, d.variant_id, b.previous_variant_id
+    """
+    params = [timezone.now(), experiment.id]
+    for range_values in ranges:
+        params.extend(range_values)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    deltas = Counter()
+    for _, variant_id, previous_variant_id in rows:
+        deltas[(experiment.id, previous_variant_id)] -= 1
+        deltas[(experiment.id, variant_id)] += 1
+    update_enrollment_counts(deltas)
+
+    return [(user_id, variant_id) for user_id, variant_id, _ in rows]
+
+
+RECALCULATION_ENGINES = {
+    'bulk': recalculate_distributions_bulk,
+    'sql': recalculate_distributions_sql,
+}
+
+
+def recalculate_experiment_distributions(
+    experiment: Experiment,
+    mode: Optional[str] = None,
+    progress: Optional[Callable[[int], None]] = None
+) -> int:
+    """
+    Recalculate all distributions for an experiment when variant rollouts change.
+    Returns the number of distributions that were updated.
+
+    Args:
+        experiment: The experiment to recalculate.
+        mode: "bulk" or "sql", defaults to the RECALCULATION_MODE setting.
+        progress: Optional callback receiving the number of distributions processed
+            so far. Only the bulk engine reports progress.
+    """
+    mode = mode or getattr(settings, 'RECALCULATION_MODE', 'bulk')
+    if mode not in RECALCULATION_ENGINES:
+        raise ValueError(f"Unknown recalculation mode '{mode}'")
+
+    compiled = compile_experiment(experiment)
+
+    with transaction.atomic(), distribution_notifications_suppressed():
+        if mode == 'bulk':
+            changes = recalculate_distributions_bulk(compiled, progress=progress)
+        else:
+            changes = RECALCULATION_ENGINES[mode](compiled)
+
+        if changes and is_store_enabled():
+            # Neither engine sends post_save, so move the users in the assignment store explicitly
+            transaction.on_commit(lambda: set_assignments({
+                (user_id, compiled.id): variant_id for user_id, variant_id in changes
+            }))
+        if getattr(settings, 'DISTRIBUTION_PUSH_MODE', 'config') == 'user':
+            # Neither engine sends post_save, so notify the moved users explicitly
+            transaction.on_commit(lambda: notify_distribution_changes(compiled, changes))
+        # Pushes config_changed to the project, and responses served while the
+        # recalculation ran may hold the old assignments
+        transaction.on_commit(lambda: bump_config_version(compiled.project_id))
+
+    return len(changes)
+
+
+def _progress_cache_key(job_id) -> str:
+    return f"recalculation_job:{job_id}:processed"
+
+
+def get_recalculation_progress(job: RecalculationJob) -> int:
+    """
+    Get the number of distributions a job has processed.
+    Running jobs report progress through the cache, since their writes are not committed yet.
+    """
+    if job.status == 'running':
+        return cache.get(_progress_cache_key(job.id), 0)
+    if job.status == 'completed':
+        return job.total
+    return 0
+
+
+def enqueue_recalculation(experiment_id, delay: Optional[float] = None) -> RecalculationJob:
+    """
+    Queue a recalculation of an experiment's distributions.
+
+    If a recalculation is already queued for the experiment, it is postponed
+    instead of queueing another one, so a burst of edits results in a single run.
+
+    Args:
+        experiment_id: The experiment to recalculate.
+        delay: Seconds to wait for further edits, defaults to RECALCULATION_DEBOUNCE_SECONDS.
+    """
+    if delay is None:
+        delay = getattr(settings, 'RECALCULATION_DEBOUNCE_SECONDS', 5)
+    run_after = timezone.now() + timedelta(seconds=delay)
+
+    pending = RecalculationJob.objects.filter(experiment_id=experiment_id, status='pending')
+    if pending.update(run_after=run_after, updated_at=timezone.now()):
+        job = pending.first()
+        # Unless a worker claimed it in the meantime
+        if job is not None:
+            return job
+
+    try:
+        with transaction.atomic():
+            return RecalculationJob.objects.create(experiment_id=experiment_id, run_after=run_after)
+    except IntegrityError:
+        # Queued concurrently by another request
+        pending.update(run_after=run_after, updated_at=timezone.now())
+        return pending.first()
+
+
+def fail_stale_recalculations() -> int:
+    """
+    Mark running jobs older than RECALCULATION_JOB_TIMEOUT seconds as failed,
+    so a crashed worker does not block its experiment forever.
+
+    A worker keeps its job locked until the recalculation commits (see
+    run_recalculation_job), so locked jobs are still running and are skipped.
+    The lock of a crashed worker is released with its connection.
+
+    Returns the number of jobs that were failed.
+    """
+    timeout = getattr(settings, 'RECALCULATION_JOB_TIMEOUT', 3600)
+    now = timezone.now()
+    with transaction.atomic():
+        stale_ids = list(RecalculationJob.objects.select_for_update(skip_locked=True).filter(
+            status='running',
+            started_at__lt=now - timedelta(seconds=timeout)
+        ).values_list('id', flat=True))
+        return RecalculationJob.objects.filter(id__in=stale_ids).update(
+            status='failed', error='Timed out', finished_at=now, updated_at=now
+        )
+
+
+def claim_next_recalculation() -> Optional[RecalculationJob]:
+    """
+    Claim the next due job whose experiment has no recalculation running.
+    Safe to call from several workers at once.
+    """
+    now = timezone.now()
+    running = RecalculationJob.objects.filter(status='running').values('experiment_id')
+
+    try:
+        with transaction.atomic():
+            job = RecalculationJob.objects.select_for_update(skip_locked=True).filter(
+                status='pending',
+                run_after__lte=now
+            ).exclude(
+                experiment_id__in=running
+            ).order_by('run_after').first()
+
+            if job is None:
+                return None
+
+            job.status = 'running'
+            job.started_at = now
+            job.save(update_fields=['status', 'started_at', 'updated_at'])
+            return job
+    except IntegrityError:
+        # Another worker started a recalculation of the same experiment
+        return None
+
+
+def _record_outcome(job: RecalculationJob) -> None:
+    job.finished_at = timezone.now()
+    # Update rather than save, the job is gone if its experiment was deleted meanwhile,
+    # and only while it is running, a job failed as stale has its outcome already
+    RecalculationJob.objects.filter(pk=job.pk, status='running').update(
+        status=job.status,
+        changed=job.changed,
+        error=job.error,
+        finished_at=job.finished_at,
+        updated_at=job.finished_at
+    )
+
+
+def run_recalculation_job(job: RecalculationJob) -> RecalculationJob:
+    """
+    Run a claimed job and record its outcome.
+
+    The job's row is locked while the distributions are recalculated and its
+    outcome is committed together with them, so fail_stale_recalculations cannot
+    fail it midway and let another job of the experiment run concurrently.
+    A job that was failed before it was locked is not run.
+    """
+    progress_key = _progress_cache_key(job.id)
+
+    try:
+        experiment = Experiment.objects.get(id=job.experiment_id)
+
+        # Rollouts only matter while the experiment is running
+        if experiment.status == 'running':
+            # Written first, so the job's progress can be followed against it
+            job.total = get_enrolled_total(experiment.id)
+            RecalculationJob.objects.filter(pk=job.pk).update(total=job.total, updated_at=timezone.now())
+
+        with transaction.atomic():
+            if not RecalculationJob.objects.select_for_update().filter(pk=job.pk, status='running').exists():
+                # Failed as stale, or deleted with its experiment
+                return RecalculationJob.objects.filter(pk=job.pk).first() or job
+
+            if experiment.status == 'running':
+                job.changed = recalculate_experiment_distributions(
+                    experiment,
+                    progress=lambda processed: cache.set(progress_key, processed, timeout=None)
+                )
+
+            job.status = 'completed'
+            _record_outcome(job)
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e)
+        _record_outcome(job)
+    finally:
+        cache.delete(progress_key)
+
+    return job
@@ -0,0 +1,154 @@
+"""
+Sample ratio mismatch (SRM) detection.
+
+A sweep checks every running experiment at once: the enrolled users per variant
+come from the enrollment counters in one query, and the expected split from the
+bucket ranges of the compiled experiments, so the cost of a sweep depends on the
+number of variants and not on the number of distributions. Every check is stored
+as a SampleRatioCheck row, which keeps the history of an experiment's split.
+
+Experiments with a queued or running recalculation are skipped, their
+distributions do not match the current rollouts until it has finished. So are
+stateless experiments, which have no enrollment to compare.
+"""
+import math
+from datetime import timedelta
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from ..models import Experiment, RecalculationJob, SampleRatioCheck, VariantEnrollment
+from .bucketing import HASH_BUCKETS, CompiledExperiment, compile_experiment, range_bucket_counts
+
+
+def chi_square_sf(statistic: float, degrees_of_freedom: int) -> float:
+    """
+    Probability that a chi-square variable with an integer number of degrees of
+    freedom is greater than the statistic (the p-value of a chi-square test).
+    """
+    if degrees_of_freedom < 1:
+        return 1.0
+    if statistic <= 0:
+        return 1.0
+
+    half = statistic / 2
+    # Closed forms of the regularized upper incomplete gamma function for integer
+    # and half-integer shapes, summed term by term
+    if degrees_of_freedom % 2 == 0:
+        term = math.exp(-half)
+        total = term
+        for i in range(1, degrees_of_freedom // 2):
+            term *= half / i
+            total += term
+    else:
+        total = math.erfc(math.sqrt(half))
+        term = math.exp(-half) * 2 * math.sqrt(half / math.pi)
+        for i in range(1, (degrees_of_freedom + 1) // 2):
+            total += term
+            term *= half / (i + 0.5)
+    return min(max(total, 0.0), 1.0)
+
+
+def expected_shares(experiment: CompiledExperiment) -> List[float]:
+    """
+    Share of the hash buckets owned by each variant of a compiled experiment,
+    in the order of experiment.variants.
+    """
+    buckets = range_bucket_counts(experiment.bounds, experiment.range_variants, len(experiment.variants))
+    return [count / HASH_BUCKETS for count in buckets]
+
+
+def srm_test(observed: List[int], shares: List[float]) -> Tuple[float, float]:
+    """
+    Pearson's chi-square goodness of fit test of the observed counts against the
+    expected shares.
+
+    Users in a variant without a share cannot be explained by any split, the
+    p-value is then 0.
+
+    Returns:
+        tuple: The chi-square statistic and its p-value.
+    """
+    total = sum(observed)
+    if total == 0:
+        return 0.0, 1.0
+
+    statistic = 0.0
+    degrees_of_freedom = -1
+    for count, share in zip(observed, shares):
+        if share > 0:
+            expected = total * share
+            statistic += (count - expected) ** 2 / expected
+            degrees_of_freedom += 1
+        elif count > 0:
+            return statistic, 0.0
+
+    return statistic, chi_square_sf(statistic, degrees_of_freedom)
+
+
+def check_experiments(experiments: List[Experiment]) -> List[SampleRatioCheck]:
+    """
+    Check the split of some experiments, with one query for all their enrollment counters.
+    The experiments' variants should be prefetched. The checks are not saved.
+    """
+    counts: Dict[Tuple, int] = {
+        (experiment_id, variant_id): enrolled
+        for experiment_id, variant_id, enrolled in VariantEnrollment.objects.filter(
+            experiment__in=experiments
+        ).values_list('experiment_id', 'variant_id', 'enrolled')
+    }
+    min_sample = getattr(settings, 'SRM_MIN_SAMPLE', 100)
+    threshold = getattr(settings, 'SRM_P_VALUE_THRESHOLD', 0.001)
+
+    checks = []
+    for experiment in experiments:
+        compiled = compile_experiment(experiment)
+        if not compiled.variants:
+            continue
+
+        observed = [counts.get((experiment.id, variant.id), 0) for variant in compiled.variants]
+        shares = expected_shares(compiled)
+        chi_square, p_value = srm_test(observed, shares)
+        total = sum(observed)
+
+        checks.append(SampleRatioCheck(
+            experiment=experiment,
+            total=total,
+            chi_square=chi_square,
+            p_value=p_value,
+            mismatch=total >= min_sample and p_value < threshold,
+            observed={variant.key: count for variant, count in zip(compiled.variants, observed)},
+            expected={variant.key: share for variant, share in zip(compiled.variants, shares)}
+        ))
+    return checks
+
+
+def run_srm_sweep() -> List[SampleRatioCheck]:
+    """
+    Check every running experiment and store the results. Checks older than
+    SRM_HISTORY_DAYS are deleted.
+
+    Returns:
+        list: The stored checks.
+    """
+    recalculating = RecalculationJob.objects.filter(status__in=['pending', 'running']).values('experiment_id')
+    experiments = list(
+        Experiment.objects.filter(status='running')
+        .exclude(assignment='stateless')
+        .exclude(id__in=recalculating)
+        .prefetch_related('variants')
+    )
+
+    checks = SampleRatioCheck.objects.bulk_create(check_experiments(experiments)) if experiments else []
+
+    history_days = getattr(settings, 'SRM_HISTORY_DAYS', 30)
+    SampleRatioCheck.objects.filter(checked_at__lt=timezone.now() - timedelta(days=history_days)).delete()
+
+    return checks
+
+
+def get_srm_history(experiment: Experiment, limit: int = 20) -> List[SampleRatioCheck]:
+    """The most recent checks of an experiment, newest first."""
+    return list(SampleRatioCheck.objects.filter(experiment=experiment).order_by('-checked_at')[:limit])
+
@@ -0,0 +1,203 @@
+"""
+Write-behind buffer for ProjectUser activity (last_seen and device metadata).
+
+Library calls record activity in memory instead of saving the user. A background
+thread flushes the buffer every USER_ACTIVITY_FLUSH_INTERVAL seconds with one
+bulk_update per batch, and whatever is left is flushed when the process exits.
+"""
+import atexit
+import logging
+import threading
+from itertools import islice
+from typing import Any, Dict, Iterable, List
+from uuid import UUID
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from ..models import ProjectUser
+from .version_service import bump_user_version
+
+logger = logging.getLogger(__name__)
+
+
+class UserActivityBuffer:
+    """
+    Collects pending field updates per user and writes them in batches.
+    Later updates of the same user overwrite earlier ones before they are written.
+    At most USER_ACTIVITY_MAX_PENDING users are buffered, the updates of the
+    users buffered first are dropped when the buffer is full.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending: Dict[UUID, Dict[str, Any]] = {}
+        self._flusher = None
+        # Users whose updates were dropped because the buffer was full
+        self.dropped = 0
+
+    def record(self, user: ProjectUser, fields: Iterable[str] = ()) -> None:
+        """
+        Buffer the user's last_seen and the current value of the given fields.
+        Never writes them itself, a full batch wakes the flusher.
+        """
+        values = {'last_seen': timezone.now()}
+        for field in fields:
+            values[field] = getattr(user, field)
+        user.last_seen = values['last_seen']
+
+        with self._lock:
+            self._pending.setdefault(user.id, {}).update(values)
+            self._drop_excess()
+            pending_count = len(self._pending)
+
+        self._start_flusher()
+        if pending_count >= getattr(settings, 'USER_ACTIVITY_BATCH_SIZE', 1000):
+            self._wake.set()
+
+    async def arecord(self, user: ProjectUser, fields: Iterable[str] = ()) -> None:
+        """Async version of record, which does not block either."""
+        self.record(user, fields)
+
+    def _drop_excess(self) -> None:
+        """Drop the users buffered first beyond USER_ACTIVITY_MAX_PENDING. Called with the lock held."""
+        excess = len(self._pending) - getattr(settings, 'USER_ACTIVITY_MAX_PENDING', 10000)
+        if excess <= 0:
+            return
+
+        for user_id in list(islice(self._pending, excess)):
+            del self._pending[user_id]
+        self.dropped += excess
+        logger.warning("User activity buffer is full, dropped the updates of %d users (%d dropped in total)", excess, self.dropped)
+
+    def flush(self) -> int:
+        """
+        Write all buffered updates. Returns the number of users updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        # bulk_update needs the same fields for every row, so group users by updated fields
+        groups: Dict[frozenset, List[ProjectUser]] = {}
+        for user_id, values in pending.items():
+            groups.setdefault(frozenset(values), []).append(ProjectUser(id=user_id, **values))
+
+        try:
+            for fields, users in groups.items():
+                ProjectUser.objects.bulk_update(
+                    users,
+                    sorted(fields),
+                    batch_size=getattr(settings, 'USER_ACTIVITY_BATCH_SIZE', 1000)
+                )
+        except Exception:
+            # Put the updates back unless newer ones were recorded meanwhile
+            with self._lock:
+                self._pending = {
+                    user_id: {**pending.get(user_id, {}), **self._pending.get(user_id, {})}
+                    for user_id in [*pending, *self._pending]
+                }
+                self._drop_excess()
+            raise
+
+        # Responses include the metadata fields, but not last_seen
+        for user_id, values in pending.items():
+            if len(values) > 1:
+                bump_user_version(user_id)
+
+        return len(pending)
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='user-activity-flusher', daemon=True)
+            self._flusher.start()
+            # Registered once per buffer, by the thread that started the flusher
+            atexit.register(self._flush_at_exit)
+
+    def _flush_at_exit(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to flush buffered user activity at exit")
+
+    def _run_flusher(self) -> None:
+        interval = getattr(settings, 'USER_ACTIVITY_FLUSH_INTERVAL', 5)
+
+        while True:
+            # Woken early by record when a full batch is buffered
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered user activity")
+            finally:
+                close_old_connections()
+
+
+user_activity_buffer = UserActivityBuffer()
+
+
+def record_user_activity(user: ProjectUser, fields: Iterable[str] = ()) -> None:
+    """
+    Record that a user was seen, along with changed metadata fields.
+
+    Buffered for a periodic batched write unless USER_ACTIVITY_BUFFER is disabled,
+    in which case the user is saved right away.
+    """
+    fields = list(fields)
+
+    if not getattr(settings, 'USER_ACTIVITY_BUFFER', True):
+        user.save(update_fields=fields + ['last_seen'])
+        return
+
+    user_activity_buffer.record(user, fields)
+
+
+async def arecord_user_activity(user: ProjectUser, fields: Iterable[str] = ()) -> None:
+    """Async version of record_user_activity."""
+    fields = list(fields)
+
+    if not getattr(settings, 'USER_ACTIVITY_BUFFER', True):
+        await user.asave(update_fields=fields + ['last_seen'])
+        return
+
+    await user_activity_buffer.arecord(user, fields)
+
+
+def record_user_seen(user_id) -> None:
+    """
+    Record that a user was seen, by id, without loading the user.
+
+    Buffered like record_user_activity, or written with an update by id
+    when USER_ACTIVITY_BUFFER is disabled.
+    """
+    if not getattr(settings, 'USER_ACTIVITY_BUFFER', True):
+        ProjectUser.objects.filter(id=user_id).update(last_seen=timezone.now())
+        return
+
+    # Only the id is buffered, the instance is never saved
+    user_activity_buffer.record(ProjectUser(id=user_id))
+
+
+async def arecord_user_seen(user_id) -> None:
+    """Async version of record_user_seen."""
+    if not getattr(settings, 'USER_ACTIVITY_BUFFER', True):
+        await ProjectUser.objects.filter(id=user_id).aupdate(last_seen=timezone.now())
+        return
+
+    await user_activity_buffer.arecord(ProjectUser(id=user_id))
+
+
+def flush_user_activity() -> int:
+    """Write all buffered user activity now. Returns the number of users updated."""
+    return user_activity_buffer.flush()
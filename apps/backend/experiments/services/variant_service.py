@@ -1,62 +1,49 @@
-from typing import Optional, Dict, Any, List
-import hashlib
-from django.db import transaction
+from typing import Optional, Dict, Any, List, Tuple, Union
+import atexit
+import logging
+import threading
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
 from django.db.models import Q
+from django.utils import timezone
 
 from ..models import ProjectUser, Experiment, Variant, Distribution, Project
+from ..notifications import anotify_distribution_changes, notify_distribution_changes, send_distribution_update
+from .assignment_store import (
+    delete_assignments,
+    get_assignments,
+    is_store_enabled,
+    pop_pending,
+    queue_pending,
+    set_assignments
+)
+from .bucketing import CompiledExperiment, CompiledVariant, compile_experiment
+from .enrollment_service import count_distributions, enrollment_upsert_sql, get_enrollment_counts, update_enrollment_counts
+from .experiment_cache import get_project_snapshot
+from .user_activity_service import arecord_user_activity, record_user_activity
 
+logger = logging.getLogger(__name__)
 
-def get_hash_number(user_id: str, experiment_id: str) -> float:
-    """
-    Create a deterministic hash between 0 and 1 based on user_id and experiment_id.
-    This ensures consistent variant assignment for the same user-experiment pair.
-    """
-    combined = f"{user_id}:{experiment_id}"
-    hash_digest = hashlib.md5(combined.encode()).hexdigest()
-    hash_int = int(hash_digest, 16)
-    return (hash_int % 10000) / 10000  # Value between 0 and 1
+IDENTIFIER_FIELDS = ['device_id', 'email', 'external_id']
+OPTIONAL_FIELDS = ['latest_current_url', 'latest_os', 'latest_os_version', 'latest_device_type']
+# Distributions per INSERT statement, keeps the parameters well below PostgreSQL's limit
+DISTRIBUTION_INSERT_BATCH_SIZE = 1000
 
 
 def assign_variant(user: ProjectUser, experiment: Experiment) -> Variant:
     """
     Assign a variant to a user for a specific experiment based on rollout percentages.
     """
-    variants = list(experiment.variants.all().order_by('id'))
-
-    if not variants:
-        raise ValueError(f"Experiment {experiment.key} has no variants")
+    variants = list(experiment.variants.all())
+    compiled = compile_experiment(experiment, variants)
 
-    # Calculate total rollout percentage
-    total_rollout = sum(variant.rollout for variant in variants)
-    print(f"Total Rollout: {total_rollout}")
-
-    nonzero_variants = [variant for variant in variants if variant.rollout > 0]
-    if len(nonzero_variants) == 1:
-        print(f"Only one active variant: {nonzero_variants[0].id}")
-        return nonzero_variants[0]
-
-    # Normalize rollout percentages if they don't sum to 1
-    normalized_variants = []
-    accumulated = 0
-
-    for variant in variants:
-        normalized_rollout = variant.rollout / total_rollout
-        normalized_variants.append((variant, accumulated, accumulated + normalized_rollout))
-        accumulated += normalized_rollout
-
-    # Get a deterministic value between 0 and 1 for this user-experiment pair
-    hash_value = get_hash_number(str(user.id), str(experiment.id))
-    print(f"Hash value for user {user.id}: {hash_value}")
-
-    # Find which variant's range contains this hash value
-    for variant, range_start, range_end in normalized_variants:
-        print(f"Checking variant {variant.id}: range ({range_start}, {range_end})")
-        if range_start <= hash_value < range_end:
-            print(f"User assigned to Variant {variant.id}")
-            return variant
-
-    # Fallback to the last variant if something goes wrong
-    return variants[-1]
+    # Find which variant's bucket range contains this user-experiment pair
+    assigned = compiled.assign(user.id)
+    return next(variant for variant in variants if variant.id == assigned.id)
 
 
 def merge_users(users: List[ProjectUser]) -> ProjectUser:
@@ -76,7 +63,7 @@ def merge_users(users: List[ProjectUser]) -> ProjectUser:
             primary_user.external_id = user.external_id
 
         # Merge optional fields
-        for field in ['latest_current_url', 'latest_os', 'latest_os_version', 'latest_device_type']:
+        for field in OPTIONAL_FIELDS:
             if getattr(user, field, None) and not getattr(primary_user, field, None):
                 setattr(primary_user, field, getattr(user, field))
 
@@ -90,10 +77,155 @@ def merge_users(users: List[ProjectUser]) -> ProjectUser:
     return primary_user
 
 
+def _new_user_data(project: Project, identifier_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Field values for a user created from the provided identifiers."""
+    user_data = {
+        'project': project,
+        'device_id': identifier_data.get('device_id'),
+        'email': identifier_data.get('email'),
+        'external_id': identifier_data.get('external_id'),
+    }
+
+    # Add optional fields if provided
+    for field in OPTIONAL_FIELDS:
+        if field in identifier_data:
+            user_data[field] = identifier_data[field]
+
+    # Merge properties if provided
+    user_data['properties'] = identifier_data.get('properties') or {}
+    return user_data
+
+
+def _find_or_insert_users(
+    project: Project,
+    lookup: Dict[str, Any],
+    identifier_data: Dict[str, Any]
+) -> Tuple[List[ProjectUser], bool]:
+    """
+    Find the users matching any of the identifiers, creating one if none match.
+
+    On PostgreSQL the lookup and the insert run as one statement. The insert uses
+    ON CONFLICT DO NOTHING, so concurrent identify calls for the same new user
+    cannot violate the unique_*_per_project constraints.
+
+    Returns:
+        tuple: The matching (or created) users and whether a user was created.
+    """
+    query = Q()
+    for field, value in lookup.items():
+        query |= Q(**{field: value})
+    matching = ProjectUser.objects.filter(Q(project=project) & query)
+
+    can_create = any(identifier_data.get(field) for field in IDENTIFIER_FIELDS)
+
+    if connection.vendor != 'postgresql' or not can_create:
+        users = list(matching)
+        if users or not can_create:
+            return users, False
+        try:
+            with transaction.atomic():
+                return [ProjectUser.objects.create(**_new_user_data(project, identifier_data))], True
+        except IntegrityError:
+            # Created concurrently by another request, query again past the cached empty result
+            return list(matching.all()), False
+
+    opts = ProjectUser._meta
+    table = connection.ops.quote_name(opts.db_table)
+    now = timezone.now()
+    new_user = ProjectUser(id=uuid.uuid4(), first_seen=now, last_seen=now, **_new_user_data(project, identifier_data))
+
+    # Explicit casts, since the values are selected rather than inserted with VALUES
+    insert_fields = list(opts.concrete_fields)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in insert_fields)
+    placeholders = ', '.join(f"%s::{field.db_type(connection)}" for field in insert_fields)
+    insert_params = [field.get_db_prep_save(getattr(new_user, field.attname), connection) for field in insert_fields]
+
+    conditions = ' OR '.join(f"{connection.ops.quote_name(opts.get_field(field).column)} = %s" for field in lookup)
+    lookup_params = [opts.get_field(field).get_db_prep_value(value, connection) for field, value in lookup.items()]
+
+    sql = f"""
+        WITH existing AS (
+            SELECT * FROM {table} WHERE project_id = %s AND ({conditions})
+        ), inserted AS (
+            INSERT INTO {table} ({columns})
+            SELECT {placeholders}
+            WHERE NOT EXISTS (SELECT 1 FROM existing)
+            ON CONFLICT DO NOTHING
+            RETURNING *
+        )
+        SELECT *, FALSE AS created FROM existing
+        UNION ALL
+        SELECT *, TRUE AS created FROM inserted
+    """
+    users = list(ProjectUser.objects.raw(sql, [project.id, *lookup_params, *insert_params]))
+
+    if not users:
+        # Created concurrently after the statement started, so it was not visible to it
+        return list(matching), False
+
+    return users, any(user.created for user in users)
+
+
+def _apply_identifier_data(user: ProjectUser, identifier_data: Dict[str, Any]) -> List[str]:
+    """
+    Update a user with the provided identifiers and metadata.
+    Returns the names of the fields whose value actually changed.
+    """
+    changed = []
+
+    # Update missing identifiers
+    for field in IDENTIFIER_FIELDS:
+        value = identifier_data.get(field)
+        if value and not getattr(user, field):
+            setattr(user, field, value)
+            changed.append(field)
+
+    # Update optional fields if provided
+    for field in OPTIONAL_FIELDS:
+        if field in identifier_data and getattr(user, field) != identifier_data[field]:
+            setattr(user, field, identifier_data[field])
+            changed.append(field)
+
+    # Merge properties
+    if 'properties' in identifier_data:
+        properties = {**user.properties, **(identifier_data.get('properties') or {})}
+        if properties != user.properties:
+            user.properties = properties
+            changed.append('properties')
+
+    return changed
+
+
+def _user_lookup(identifier_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Identifiers to look existing users up by.
+
+    Raises:
+        ValueError: If no identifier is provided.
+    """
+    user_id = identifier_data.get("id")
+
+    # Ensure at least one identifier is provided
+    if not any([user_id] + [identifier_data.get(field) for field in IDENTIFIER_FIELDS]):
+        raise ValueError("At least one identifier (device_id, email, or external_id) must be provided")
+
+    lookup = {}
+    if user_id:
+        lookup['id'] = ProjectUser._meta.get_field('id').to_python(user_id)
+    for field in IDENTIFIER_FIELDS:
+        if identifier_data.get(field):
+            lookup[field] = identifier_data[field]
+    return lookup
+
+
 def get_or_create_user(project: Project, identifier_data: Dict[str, Any]) -> ProjectUser:
     """
     Get or create a user based on the provided identifiers.
 
+    Existing users are only written when an identifier or property changes, and then
+    only the changed fields are updated. last_seen and device metadata are buffered
+    and written in batches (see user_activity_service).
+
     Args:
         project: The project the user belongs to.
         identifier_data: Dictionary containing user identifiers (device_id, email, external_id).
@@ -103,138 +235,793 @@ def get_or_create_user(project: Project, identifier_data: Dict[str, Any]) -> Pro
 
     Raises:
         ValueError: If no valid identifier is provided or if multiple users match different identifiers.
+        ProjectUser.DoesNotExist: If only a user id is provided and no user has it.
     """
-    user_id = identifier_data.get("id")
-    device_id = identifier_data.get('device_id')
-    email = identifier_data.get('email')
-    external_id = identifier_data.get('external_id')
+    lookup = _user_lookup(identifier_data)
+    can_create = any(identifier_data.get(field) for field in IDENTIFIER_FIELDS)
 
-    # Ensure at least one identifier is provided
-    if not any([user_id, device_id, email, external_id]):
-        raise ValueError("At least one identifier (device_id, email, or external_id) must be provided")
+    for attempt in range(2):
+        retry = attempt == 0
+        matching_users, created = _find_or_insert_users(project, lookup, identifier_data)
 
-    # Build query to find existing users
-    query = Q(project=project)
-    conditions = []
-    if user_id:
-        conditions.append(Q(id=user_id))
-    if device_id:
-        conditions.append(Q(device_id=device_id))
-    if email:
-        conditions.append(Q(email=email))
-    if external_id:
-        conditions.append(Q(external_id=external_id))
-
-    # Combine conditions with OR
-    query &= conditions[0]
-    for condition in conditions[1:]:
-        query |= condition
-
-    # Fetch matching users
-    matching_users = list(ProjectUser.objects.filter(query))
-
-    optional_fields = ['latest_current_url', 'latest_os', 'latest_os_version', 'latest_device_type']
-
-    if not matching_users:
-        # No matching user found, create a new one
-        user_data = {
-            'project': project,
-            'device_id': device_id,
-            'email': email,
-            'external_id': external_id,
-        }
+        if not matching_users:
+            if retry and can_create:
+                # Deleted or merged concurrently, resolve again
+                continue
+            # Only a user id was given, there is nothing to create the user from
+            raise ProjectUser.DoesNotExist(f"User {lookup['id']} not found")
 
-        # Add optional fields if provided
-        for field in optional_fields:
-            if field in identifier_data:
-                user_data[field] = identifier_data[field]
+        if created:
+            return matching_users[0]
 
-        # Merge properties if provided
-        user_data['properties'] = identifier_data.get('properties', {})
+        try:
+            if len(matching_users) > 1:
+                with transaction.atomic():
+                    return merge_users(matching_users)
 
-        return ProjectUser.objects.create(**user_data)
+            # Exactly one user found, update fields if necessary
+            user = matching_users[0]
+            changed = _apply_identifier_data(user, identifier_data)
+            if any(field not in OPTIONAL_FIELDS for field in changed):
+                with transaction.atomic():
+                    user.save(update_fields=changed + ['last_seen'])
+            else:
+                # Only activity changed, write it behind in a batch
+                record_user_activity(user, changed)
+            return user
+        except IntegrityError:
+            # An identifier was claimed concurrently by another user, resolve again
+            if not retry:
+                raise
 
-    elif len(matching_users) == 1:
-        # Exactly one user found, update fields if necessary
+
+async def aget_or_create_user(project: Project, identifier_data: Dict[str, Any]) -> ProjectUser:
+    """
+    Async version of get_or_create_user.
+
+    Users found by a single lookup whose identifiers do not change are resolved
+    with the async ORM. Creating, merging and updating identifiers need transactions,
+    which the async ORM does not support, so those run get_or_create_user in a thread.
+    """
+    lookup = _user_lookup(identifier_data)
+
+    query = Q()
+    for field, value in lookup.items():
+        query |= Q(**{field: value})
+    matching_users = [user async for user in ProjectUser.objects.filter(Q(project=project) & query)]
+
+    if len(matching_users) == 1:
         user = matching_users[0]
-        updated = False
-
-        # Update missing identifiers
-        if device_id and not user.device_id:
-            user.device_id = device_id
-            updated = True
-        if email and not user.email:
-            user.email = email
-            updated = True
-        if external_id and not user.external_id:
-            user.external_id = external_id
-            updated = True
-
-        # Update optional fields if provided
-        for field in optional_fields:
-            if field in identifier_data:
-                setattr(user, field, identifier_data[field])
-                updated = True
+        changed = _apply_identifier_data(user, identifier_data)
+        if all(field in OPTIONAL_FIELDS for field in changed):
+            # Only activity changed, write it behind in a batch
+            await arecord_user_activity(user, changed)
+            return user
 
-        # Merge properties
-        if 'properties' in identifier_data:
-            user.properties = {**user.properties, **identifier_data.get('properties', {})}
-            updated = True
+    return await sync_to_async(get_or_create_user)(project, identifier_data)
 
-        if updated:
-            user.save()
 
-        return user
-    else:
-        return merge_users(matching_users)
+def get_or_create_users(project: Project, identifier_list: List[Dict[str, Any]]) -> List[ProjectUser]:
+    """
+    Get or create the users for a list of identifier dicts.
+
+    Existing users are looked up with one query and new users are inserted with one
+    bulk_create. Entries matching several users, changing an identifier that is
+    taken, or sharing an identifier with another new user go through get_or_create_user.
+
+    Args:
+        project: The project the users belong to.
+        identifier_list: Dictionaries containing user identifiers, as for get_or_create_user.
+
+    Returns:
+        list: The user of every entry, in the same order. Entries identifying the
+            same user get the same instance.
+
+    Raises:
+        ValueError: If an entry has no valid identifier.
+        ProjectUser.DoesNotExist: If an entry only has a user id and no user has it.
+    """
+    lookups = [_user_lookup(identifier_data) for identifier_data in identifier_list]
+    lookup_fields = ['id'] + IDENTIFIER_FIELDS
+
+    query = Q()
+    for field in lookup_fields:
+        values = {lookup[field] for lookup in lookups if field in lookup}
+        if values:
+            query |= Q(**{f"{field}__in": values})
+
+    # Index the existing users by every identifier they have
+    known_users = {}
+    for user in ProjectUser.objects.filter(Q(project=project) & query):
+        for field in lookup_fields:
+            value = getattr(user, field)
+            if value:
+                known_users[(field, value)] = user
+
+    users: List[Optional[ProjectUser]] = [None] * len(identifier_list)
+    new_users: Dict[int, ProjectUser] = {}
+    new_identifiers = set()
+    fallback = []
+
+    for position, (identifier_data, lookup) in enumerate(zip(identifier_list, lookups)):
+        matching_users = {
+            user.id: user
+            for user in (known_users.get(item) for item in lookup.items())
+            if user is not None
+        }
+        identifiers = {(field, value) for field, value in lookup.items() if field != 'id'}
+
+        if len(matching_users) == 1:
+            user = next(iter(matching_users.values()))
+            changed = _apply_identifier_data(user, identifier_data)
+            if any(field not in OPTIONAL_FIELDS for field in changed):
+                try:
+                    with transaction.atomic():
+                        user.save(update_fields=changed + ['last_seen'])
+                except IntegrityError:
+                    fallback.append(position)
+                    continue
+            else:
+                record_user_activity(user, changed)
+            users[position] = user
+        elif not matching_users and identifiers and not identifiers & new_identifiers:
+            new_users[position] = ProjectUser(**_new_user_data(project, identifier_data))
+            new_identifiers |= identifiers
+        else:
+            fallback.append(position)
+
+    if new_users:
+        try:
+            with transaction.atomic():
+                ProjectUser.objects.bulk_create(new_users.values())
+            for position, user in new_users.items():
+                users[position] = user
+        except IntegrityError:
+            # Some were created concurrently, resolve them one by one
+            fallback.extend(new_users)
+
+    for position in sorted(fallback):
+        users[position] = get_or_create_user(project, identifier_list[position])
+
+    return users
+
+
+def _insert_distribution(user: ProjectUser, experiment: CompiledExperiment) -> Tuple[Distribution, bool]:
+    """
+    Insert the user's distribution unless one already exists, racing safely with
+    concurrent inserts on the (user, experiment) unique constraint.
+
+    On PostgreSQL this is a single INSERT ... ON CONFLICT DO NOTHING statement that
+    also counts the new distribution in the variant's enrollment counter, and
+    returns the existing row when the insert was skipped. Elsewhere the
+    distribution_saved_enrollment signal counts it.
+
+    Returns:
+        tuple: The distribution (with user, experiment and variant ids set) and whether it was created.
+    """
+    variant = experiment.assign(user.id)
+
+    if connection.vendor != 'postgresql':
+        return Distribution.objects.get_or_create(
+            user=user,
+            experiment_id=experiment.id,
+            defaults={'variant_id': variant.id}
+        )
+
+    table = connection.ops.quote_name(Distribution._meta.db_table)
+    now = timezone.now()
+    sql = f"""
+        WITH inserted AS (
+            INSERT INTO {table} (id, user_id, experiment_id, variant_id, created_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (user_id, experiment_id) DO NOTHING
+            RETURNING id, experiment_id, variant_id, created_at, updated_at
+        ), counted AS ({enrollment_upsert_sql('inserted')})
+        SELECT id, variant_id, created_at, updated_at, TRUE FROM inserted
+        UNION ALL
+        SELECT id, variant_id, created_at, updated_at, FALSE FROM {table}
+        WHERE user_id = %s AND experiment_id = %s AND NOT EXISTS (SELECT 1 FROM inserted)
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [uuid.uuid4(), user.id, experiment.id, variant.id, now, now, user.id, experiment.id])
+        row = cursor.fetchone()
+
+    if row is None:
+        # Inserted concurrently after the statement started, so it was not visible to it
+        return Distribution.objects.get(user=user, experiment_id=experiment.id), False
+
+    distribution_id, variant_id, created_at, updated_at, created = row
+    distribution = Distribution(
+        id=distribution_id,
+        user=user,
+        experiment_id=experiment.id,
+        variant_id=variant_id,
+        created_at=created_at,
+        updated_at=updated_at
+    )
+    distribution._state.adding = False
+
+    if created and experiment.status == "running":
+        # The raw insert does not send post_save, notify the user like distribution_saved_websocket does
+        send_distribution_update(user.id, experiment, variant)
+
+    return distribution, created
 
 
 def get_or_create_distribution(user: ProjectUser, experiment: Experiment) -> Distribution:
     """
     Get existing distribution or create a new one if it doesn't exist.
+    Uses the experiment's prefetched variants when they were loaded with prefetch_related.
     """
-    try:
-        # Try to get existing distribution
-        return Distribution.objects.get(user=user, experiment=experiment)
-    except Distribution.DoesNotExist:
-        # Assign a variant and create distribution
-        variant = assign_variant(user, experiment)
-        distribution = Distribution(user=user, experiment=experiment, variant=variant)
-        distribution.save()
-        return distribution
+    variants = list(experiment.variants.all())
+    distribution, _ = _insert_distribution(user, compile_experiment(experiment, variants))
+
+    distribution.experiment = experiment
+    variant = next((variant for variant in variants if variant.id == distribution.variant_id), None)
+    if variant is not None:
+        distribution.variant = variant
+    return distribution
 
 
-def recalculate_experiment_distributions(experiment: Experiment) -> int:
+def get_or_assign_variant(user: ProjectUser, experiment: CompiledExperiment) -> Union[CompiledVariant, Variant]:
     """
-    Recalculate all distributions for an experiment when variant rollouts change.
-    Returns the number of distributions that were updated.
+    Get the variant a user is distributed to, assigning one if needed.
+
+    Works on a compiled experiment, so the experiment configuration is not read
+    from the database. Creates the distribution row on first assignment, unless
+    the experiment's assignment is deferred or stateless. With the assignment
+    store, assigned users are served from Redis in one round trip.
+    """
+    if experiment.assignment != 'stateless' and is_store_enabled():
+        variant = get_or_create_distributions([user], [experiment]).get((user.id, experiment.id))
+        if variant is not None:
+            return variant
+
+    if experiment.assignment == 'stored':
+        distribution, _ = _insert_distribution(user, experiment)
+        variant_id = distribution.variant_id
+    else:
+        variant_id = Distribution.objects.filter(
+            user=user,
+            experiment_id=experiment.id
+        ).values_list('variant_id', flat=True).first()
+        if variant_id is None:
+            if experiment.assignment == 'deferred':
+                assignment_buffer.record([(user.id, experiment.id)])
+            return experiment.assign(user.id)
+
+    variant = experiment.get_variant(variant_id)
+    if variant is None:
+        # The compiled experiment is older than the distribution
+        variant = Variant.objects.get(id=variant_id)
+    return variant
+
+
+def _existing_distributions(user_ids, experiments: List[CompiledExperiment]):
+    return Distribution.objects.filter(
+        user_id__in=user_ids,
+        experiment_id__in=[experiment.id for experiment in experiments]
+    ).values_list('user_id', 'experiment_id', 'variant_id')
+
+
+def _assign_missing(
+    user_ids,
+    experiments: List[CompiledExperiment],
+    variant_ids: Dict[Tuple[uuid.UUID, uuid.UUID], uuid.UUID]
+) -> List[Distribution]:
+    """Assign every (user, experiment) pair without a variant id, returning the distributions to insert."""
+    new_distributions = []
+    for experiment in experiments:
+        for user_id in user_ids:
+            if (user_id, experiment.id) not in variant_ids:
+                variant = experiment.assign(user_id)
+                variant_ids[(user_id, experiment.id)] = variant.id
+                new_distributions.append(Distribution(user_id=user_id, experiment_id=experiment.id, variant_id=variant.id))
+    return new_distributions
+
+
+def _insert_distributions(new_distributions: List[Distribution]) -> List[Distribution]:
     """
-    changes_count = 0
+    Insert distributions, skipping the pairs that already have one, and count the
+    inserted ones in the enrollment counters.
 
-    with transaction.atomic():
-        # Get all distributions for this experiment
-        distributions = Distribution.objects.filter(experiment=experiment)
+    On PostgreSQL every batch is inserted and counted with one statement.
 
-        # For each distribution, calculate what the variant should be now
-        for distribution in distributions:
-            expected_variant = assign_variant(distribution.user, experiment)
+    Returns:
+        list: The distributions that were inserted.
+    """
+    if connection.vendor != 'postgresql':
+        with transaction.atomic():
+            Distribution.objects.bulk_create(new_distributions, ignore_conflicts=True)
+            # The ids are new, so the rows having them are the inserted ones
+            inserted_ids = set(Distribution.objects.filter(
+                id__in=[distribution.id for distribution in new_distributions]
+            ).values_list('id', flat=True))
+            inserted = [distribution for distribution in new_distributions if distribution.id in inserted_ids]
+            update_enrollment_counts(count_distributions(inserted))
+        return inserted
 
-            # If the variant has changed, update it
-            if distribution.variant.id != expected_variant.id:
-                distribution.variant = expected_variant
-                distribution.save()
-                changes_count += 1
+    table = connection.ops.quote_name(Distribution._meta.db_table)
+    now = timezone.now()
+    inserted_ids = set()
 
-    return changes_count
+    for start in range(0, len(new_distributions), DISTRIBUTION_INSERT_BATCH_SIZE):
+        batch = new_distributions[start:start + DISTRIBUTION_INSERT_BATCH_SIZE]
+        values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(batch))
+        sql = f"""
+            WITH inserted AS (
+                INSERT INTO {table} (id, user_id, experiment_id, variant_id, created_at, updated_at)
+                VALUES {values}
+                ON CONFLICT (user_id, experiment_id) DO NOTHING
+                RETURNING id, experiment_id, variant_id
+            ), counted AS ({enrollment_upsert_sql('inserted')})
+            SELECT id FROM inserted
+        """
+        params = []
+        for distribution in batch:
+            distribution.created_at = distribution.updated_at = now
+            params.extend([
+                distribution.id,
+                distribution.user_id,
+                distribution.experiment_id,
+                distribution.variant_id,
+                now,
+                now
+            ])
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            inserted_ids.update(distribution_id for distribution_id, in cursor.fetchall())
+
+    return [distribution for distribution in new_distributions if distribution.id in inserted_ids]
+
+
+def _split_by_assignment(
+    experiments: List[CompiledExperiment],
+    new_distributions: List[Distribution]
+) -> Tuple[List[Distribution], List[Tuple[uuid.UUID, uuid.UUID]]]:
+    """
+    Split new distributions by how their experiment persists assignments.
+
+    Returns:
+        tuple: The distributions to insert now (stored experiments), and the
+            (user id, experiment id) pairs to buffer (deferred experiments).
+            Those of stateless experiments are dropped.
+    """
+    assignments = {experiment.id: experiment.assignment for experiment in experiments}
+    stored = []
+    deferred = []
+    for distribution in new_distributions:
+        assignment = assignments[distribution.experiment_id]
+        if assignment == 'stored':
+            stored.append(distribution)
+        elif assignment == 'deferred':
+            deferred.append((distribution.user_id, distribution.experiment_id))
+    return stored, deferred
+
+
+def write_assignments(pairs: List[Tuple[uuid.UUID, uuid.UUID]]) -> List[Distribution]:
+    """
+    Write the distributions of deferred assignments.
+
+    Users are assigned with the experiments' current configuration, so the rows
+    agree with recalculations that ran after the assignment was buffered. Pairs
+    whose user or experiment was deleted meanwhile are skipped.
+
+    Args:
+        pairs: (user id, experiment id) pairs.
+
+    Returns:
+        list: The distributions that were inserted.
+    """
+    experiments = {
+        experiment.id: compile_experiment(experiment)
+        for experiment in Experiment.objects.filter(
+            id__in={experiment_id for _, experiment_id in pairs}
+        ).prefetch_related('variants')
+    }
+    user_ids = set(ProjectUser.objects.filter(
+        id__in={user_id for user_id, _ in pairs}
+    ).values_list('id', flat=True))
+
+    new_distributions = []
+    for user_id, experiment_id in pairs:
+        experiment = experiments.get(experiment_id)
+        if user_id in user_ids and experiment is not None and experiment.bounds:
+            variant = experiment.assign(user_id)
+            new_distributions.append(Distribution(user_id=user_id, experiment_id=experiment_id, variant_id=variant.id))
+
+    if not new_distributions:
+        return []
+    return _insert_distributions(new_distributions)
+
+
+class AssignmentBuffer:
+    """
+    Collects the first assignments of deferred experiments and writes them as
+    distributions in batches. Assignments lost when the process is killed before
+    a flush are buffered again on the user's next request.
+
+    With the assignment store, assignments are queued in Redis instead, where the
+    flusher of any worker picks them up, and new assignments of stored experiments
+    are written behind the same way.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Ordered set of (user id, experiment id) pairs
+        self._pending: Dict[Tuple[uuid.UUID, uuid.UUID], None] = {}
+        self._flusher = None
+
+    def record(self, pairs: List[Tuple[uuid.UUID, uuid.UUID]]) -> None:
+        """Buffer (user id, experiment id) pairs, flushing right away if the buffer is full."""
+        if self._buffer(pairs):
+            self.flush()
+
+    async def arecord(self, pairs: List[Tuple[uuid.UUID, uuid.UUID]]) -> None:
+        """Async version of record, flushing a full buffer in a thread."""
+        if self._buffer(pairs):
+            await sync_to_async(self.flush)()
+
+    def _buffer(self, pairs: List[Tuple[uuid.UUID, uuid.UUID]]) -> bool:
+        """Buffer the pairs, returning whether the buffer is full and should be flushed."""
+        if not pairs:
+            return False
+
+        if is_store_enabled():
+            queue_pending(pairs)
+            self._start_flusher()
+            return False
+
+        with self._lock:
+            self._pending.update(dict.fromkeys(pairs))
+            pending_count = len(self._pending)
+
+        self._start_flusher()
+        return pending_count >= getattr(settings, 'ASSIGNMENT_MAX_PENDING', 10000)
+
+    def flush(self) -> int:
+        """
+        Write all buffered assignments, and those queued in the assignment store.
+        Returns the number of distributions inserted.
+        """
+        inserted = self._flush_local()
+        if is_store_enabled():
+            inserted += self._flush_store()
+        return inserted
+
+    def _flush_local(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        try:
+            return len(write_assignments(list(pending)))
+        except Exception:
+            # Keep the assignments for the next flush
+            with self._lock:
+                self._pending = {**pending, **self._pending}
+            raise
+
+    def _flush_store(self) -> int:
+        batch_size = getattr(settings, 'ASSIGNMENT_MAX_PENDING', 10000)
+        inserted_count = 0
+
+        while True:
+            pairs = pop_pending(batch_size)
+            if not pairs:
+                break
+
+            try:
+                inserted = write_assignments(list(pairs))
+            except Exception:
+                # Queue them again for the next flush
+                queue_pending(pairs)
+                raise
+            inserted_count += len(inserted)
+
+            # Keep the variants the rows were written with, and read the pairs
+            # that had a row already from the database on their next lookup
+            inserted_pairs = {(distribution.user_id, distribution.experiment_id) for distribution in inserted}
+            set_assignments({
+                (distribution.user_id, distribution.experiment_id): distribution.variant_id
+                for distribution in inserted
+            })
+            delete_assignments(pairs - inserted_pairs)
+
+            if len(pairs) < batch_size:
+                break
+
+        return inserted_count
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='assignment-flusher', daemon=True)
+            self._flusher.start()
+
+        atexit.register(self.flush)
+
+    def _run_flusher(self) -> None:
+        interval = getattr(settings, 'ASSIGNMENT_FLUSH_INTERVAL', 1)
+
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered assignments")
+            finally:
+                close_old_connections()
+
+
+assignment_buffer = AssignmentBuffer()
+
+
+def flush_assignments() -> int:
+    """Write all buffered assignments now. Returns the number of distributions inserted."""
+    return assignment_buffer.flush()
+
+
+def _stored_variant_ids(user_ids, experiments: List[CompiledExperiment]) -> Dict[Tuple[uuid.UUID, uuid.UUID], uuid.UUID]:
+    """
+    Read the variant ids of the pairs in the assignment store. Stateless experiments
+    are not stored, and variants the compiled experiments do not know are left to
+    the database.
+    """
+    experiments_by_id = {
+        experiment.id: experiment for experiment in experiments if experiment.assignment != 'stateless'
+    }
+    return {
+        pair: variant_id
+        for pair, variant_id in get_assignments(user_ids, list(experiments_by_id)).items()
+        if experiments_by_id[pair[1]].get_variant(variant_id) is not None
+    }
+
+
+def _update_store(
+    experiments: List[CompiledExperiment],
+    variant_ids: Dict[Tuple[uuid.UUID, uuid.UUID], uuid.UUID],
+    existing: Dict[Tuple[uuid.UUID, uuid.UUID], uuid.UUID],
+    new_pairs: List[Tuple[uuid.UUID, uuid.UUID]]
+) -> None:
+    """
+    Copy the distributions read from the database and the new assignments into the
+    assignment store, and queue the new assignments to be written behind.
+    """
+    stored_experiment_ids = {experiment.id for experiment in experiments if experiment.assignment != 'stateless'}
+    assignments = {pair: variant_id for pair, variant_id in existing.items() if pair[1] in stored_experiment_ids}
+    assignments.update((pair, variant_ids[pair]) for pair in new_pairs)
+
+    if assignments:
+        set_assignments(assignments)
+    assignment_buffer.record(new_pairs)
+
+
+def _changes_by_experiment(experiments: List[CompiledExperiment], new_distributions: List[Distribution]):
+    """Group new distributions into (experiment, [(user_id, variant_id)]) for notify_distribution_changes."""
+    return [
+        (experiment, [
+            (distribution.user_id, distribution.variant_id)
+            for distribution in new_distributions
+            if distribution.experiment_id == experiment.id
+        ])
+        for experiment in experiments
+    ]
+
+
+def _resolve_variants(experiments: List[CompiledExperiment], variant_ids: Dict, stored_variants=None) -> Dict:
+    """
+    Look up the variant of every pair in the compiled experiments, or in stored_variants
+    for variants the compiled experiments do not know yet. Unresolved pairs map to None.
+    """
+    experiments_by_id = {experiment.id: experiment for experiment in experiments}
+    variants = {}
+    for (user_id, experiment_id), variant_id in variant_ids.items():
+        variant = experiments_by_id[experiment_id].get_variant(variant_id)
+        if variant is None and stored_variants is not None:
+            variant = stored_variants.get(variant_id)
+        variants[(user_id, experiment_id)] = variant
+    return variants
+
+
+def get_or_create_distributions(
+    users: List[ProjectUser],
+    experiments: List[CompiledExperiment]
+) -> Dict[Tuple[uuid.UUID, uuid.UUID], Union[CompiledVariant, Variant]]:
+    """
+    Get the variants of many users in many experiments, assigning the missing ones.
+
+    Existing distributions are read with one query and the missing ones are inserted
+    in bulk, together with their enrollment counts. Missing ones of deferred experiments
+    are buffered instead and those of stateless experiments are not written.
+    Experiments without a variant to assign are skipped.
+
+    With the assignment store, the pairs it holds are read from Redis and the
+    database is only read when some are missing. New assignments are then written
+    to the store and written behind to the database by the assignment flusher.
+
+    Returns:
+        dict: The variant for every (user id, experiment id) pair.
+    """
+    user_ids = {user.id for user in users}
+    experiments = [experiment for experiment in experiments if experiment.bounds]
+    if not user_ids or not experiments:
+        return {}
+
+    use_store = is_store_enabled()
+    variant_ids = _stored_variant_ids(user_ids, experiments) if use_store else {}
+
+    existing = {}
+    if len(variant_ids) < len(user_ids) * len(experiments):
+        existing = {
+            (user_id, experiment_id): variant_id
+            for user_id, experiment_id, variant_id in _existing_distributions(user_ids, experiments)
+            if (user_id, experiment_id) not in variant_ids
+        }
+        variant_ids.update(existing)
+
+    new_distributions, deferred = _split_by_assignment(
+        experiments, _assign_missing(user_ids, experiments, variant_ids)
+    )
+    if use_store:
+        new_pairs = [(distribution.user_id, distribution.experiment_id) for distribution in new_distributions]
+        _update_store(experiments, variant_ids, existing, new_pairs + deferred)
+        inserted = new_distributions
+    else:
+        assignment_buffer.record(deferred)
+        # Assignment is deterministic, so a row inserted concurrently has the same variant
+        inserted = _insert_distributions(new_distributions) if new_distributions else []
+
+    if inserted:
+        # The bulk insert does not send post_save, notify the users like distribution_saved_websocket does
+        for experiment, changes in _changes_by_experiment(experiments, inserted):
+            transaction.on_commit(lambda experiment=experiment, changes=changes: notify_distribution_changes(experiment, changes))
+
+    variants = _resolve_variants(experiments, variant_ids)
+    stale_variant_ids = {variant_ids[pair] for pair, variant in variants.items() if variant is None}
+    if stale_variant_ids:
+        # The compiled experiments are older than some distributions
+        variants = _resolve_variants(experiments, variant_ids, Variant.objects.in_bulk(stale_variant_ids))
+
+    return {pair: variant for pair, variant in variants.items() if variant is not None}
+
+
+async def aget_or_create_distributions(
+    users: List[ProjectUser],
+    experiments: List[CompiledExperiment]
+) -> Dict[Tuple[uuid.UUID, uuid.UUID], Union[CompiledVariant, Variant]]:
+    """Async version of get_or_create_distributions."""
+    user_ids = {user.id for user in users}
+    experiments = [experiment for experiment in experiments if experiment.bounds]
+    if not user_ids or not experiments:
+        return {}
+
+    use_store = is_store_enabled()
+    variant_ids = await sync_to_async(_stored_variant_ids)(user_ids, experiments) if use_store else {}
+
+    existing = {}
+    if len(variant_ids) < len(user_ids) * len(experiments):
+        existing = {
+            (user_id, experiment_id): variant_id
+            async for user_id, experiment_id, variant_id in _existing_distributions(user_ids, experiments)
+            if (user_id, experiment_id) not in variant_ids
+        }
+        variant_ids.update(existing)
+
+    new_distributions, deferred = _split_by_assignment(
+        experiments, _assign_missing(user_ids, experiments, variant_ids)
+    )
+    if use_store:
+        new_pairs = [(distribution.user_id, distribution.experiment_id) for distribution in new_distributions]
+        if existing or new_pairs or deferred:
+            await sync_to_async(_update_store)(experiments, variant_ids, existing, new_pairs + deferred)
+        inserted = new_distributions
+    else:
+        await assignment_buffer.arecord(deferred)
+        # Counting the inserted distributions needs a transaction off PostgreSQL
+        inserted = await sync_to_async(_insert_distributions)(new_distributions) if new_distributions else []
+
+    if inserted:
+        # Not in a transaction, so the rows are committed already
+        for experiment, changes in _changes_by_experiment(experiments, inserted):
+            await anotify_distribution_changes(experiment, changes)
+
+    variants = _resolve_variants(experiments, variant_ids)
+    stale_variant_ids = {variant_ids[pair] for pair, variant in variants.items() if variant is None}
+    if stale_variant_ids:
+        variants = _resolve_variants(experiments, variant_ids, await Variant.objects.ain_bulk(stale_variant_ids))
+
+    return {pair: variant for pair, variant in variants.items() if variant is not None}
+
+
+async def aget_or_assign_variant(user: ProjectUser, experiment: CompiledExperiment) -> Union[CompiledVariant, Variant]:
+    """
+    Async version of get_or_assign_variant.
+
+    Reads the existing distribution with one query. First assignments are created
+    with get_or_create in a thread, so the Distribution signals still run, unless
+    the experiment's assignment is deferred or stateless.
+    """
+    if experiment.assignment != 'stateless' and is_store_enabled():
+        variants = await aget_or_create_distributions([user], [experiment])
+        variant = variants.get((user.id, experiment.id))
+        if variant is not None:
+            return variant
+
+    variant_id = await Distribution.objects.filter(
+        user=user,
+        experiment_id=experiment.id
+    ).values_list('variant_id', flat=True).afirst()
+
+    if variant_id is None:
+        if experiment.assignment == 'deferred':
+            await assignment_buffer.arecord([(user.id, experiment.id)])
+        if experiment.assignment != 'stored':
+            return experiment.assign(user.id)
+
+        variant = experiment.assign(user.id)
+        distribution, _ = await Distribution.objects.aget_or_create(
+            user=user,
+            experiment_id=experiment.id,
+            defaults={'variant_id': variant.id}
+        )
+        variant_id = distribution.variant_id
+
+    variant = experiment.get_variant(variant_id)
+    if variant is None:
+        # The compiled experiment is older than the distribution
+        variant = await Variant.objects.aget(id=variant_id)
+    return variant
+
+
+def get_user_variants(
+    project: Project,
+    user: ProjectUser,
+    experiment_keys: List[str]
+) -> List[Tuple[CompiledExperiment, Optional[Union[CompiledVariant, Variant]]]]:
+    """
+    Get or assign a user's variants in the experiments with the given keys.
+
+    Running experiments come from the cached snapshot and the others are loaded
+    with one query, then all variants are resolved with get_or_create_distributions.
+
+    Returns:
+        list: (experiment, variant) pairs in the order of the keys, skipping unknown keys.
+            The variant is None if the experiment has no variant to assign.
+    """
+    snapshot = get_project_snapshot(project.id)
+    keys = list(dict.fromkeys(experiment_keys))
+
+    experiments = {key: snapshot.get(key) for key in keys if snapshot.get(key) is not None}
+    missing_keys = [key for key in keys if key not in experiments]
+    if missing_keys:
+        stored_experiments = Experiment.objects.filter(project=project, key__in=missing_keys).prefetch_related('variants')
+        for experiment in stored_experiments:
+            experiments[experiment.key] = compile_experiment(experiment)
+
+    ordered = [experiments[key] for key in keys if key in experiments]
+    variants = get_or_create_distributions([user], ordered)
+    return [(experiment, variants.get((user.id, experiment.id))) for experiment in ordered]
 
 
 def calculate_distribution_stats(experiment: Experiment) -> Dict[str, float]:
     """
     Calculate the actual distribution of users across variants.
     Returns a dictionary with variant keys and their distribution percentages.
+
+    Reads the per-variant enrollment counters, so the cost does not depend on
+    the number of distributions.
     """
-    # Count distributions by variant
-    total_distributions = Distribution.objects.filter(experiment=experiment).count()
+    counts = get_enrollment_counts(experiment.id)
+    total_distributions = sum(counts.values())
 
     if total_distributions == 0:
         return {}
@@ -243,10 +1030,7 @@ def calculate_distribution_stats(experiment: Experiment) -> Dict[str, float]:
     variants = experiment.variants.all()
 
     for variant in variants:
-        variant_count = Distribution.objects.filter(
-            experiment=experiment,
-            variant=variant
-        ).count()
+        variant_count = counts.get(variant.id, 0)
 
         percentage = (variant_count / total_distributions) * 100
         stats[variant.key] = round(percentage, 2)
@@ -0,0 +1,216 @@
+"""
+Configuration and user versions for conditional requests to the library API.
+
+Versions live in the default cache, so all workers share them. A project's config
+version is bumped whenever its experiments or variants change or a recalculation
+finishes, and a user's version whenever their data or distributions change.
+The event version of a project is bumped whenever its buffered events are written.
+Missing versions are initialised from the clock, so a flushed cache does not hand
+out a version that was already used.
+"""
+import time
+from typing import Optional, Tuple
+
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import parse_etags
+
+from ..notifications import send_config_changed
+
+# Seconds an unchanged user version is kept, an expired one only costs a full response
+USER_VERSION_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def _config_version_key(project_id) -> str:
+    return f"config_version:{project_id}"
+
+
+def _user_version_key(user_id) -> str:
+    return f"user_version:{user_id}"
+
+
+def _event_version_key(project_id) -> str:
+    return f"event_version:{project_id}"
+
+
+def _get_or_init(keys, timeouts):
+    versions = cache.get_many(keys)
+    for key, timeout in zip(keys, timeouts):
+        if key not in versions:
+            initial = time.time_ns() // 1000
+            cache.add(key, initial, timeout=timeout)
+            versions[key] = cache.get(key, initial)
+    return [versions[key] for key in keys]
+
+
+async def _aget_or_init(keys, timeouts):
+    versions = await cache.aget_many(keys)
+    for key, timeout in zip(keys, timeouts):
+        if key not in versions:
+            initial = time.time_ns() // 1000
+            await cache.aadd(key, initial, timeout=timeout)
+            versions[key] = await cache.aget(key, initial)
+    return [versions[key] for key in keys]
+
+
+def _bump(key, timeout) -> int:
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Missing or evicted
+        version = time.time_ns() // 1000
+        cache.set(key, version, timeout=timeout)
+        return version
+
+
+def get_config_version(project_id) -> int:
+    """Get the current configuration version of a project."""
+    return _get_or_init([_config_version_key(project_id)], [None])[0]
+
+
+async def aget_config_version(project_id) -> int:
+    """Async version of get_config_version."""
+    return (await _aget_or_init([_config_version_key(project_id)], [None]))[0]
+
+
+def bump_config_version(project_id) -> int:
+    """
+    Mark the configuration of a project as changed, and push the new version
+    to the project's WebSocket clients.
+    """
+    version = _bump(_config_version_key(project_id), None)
+    send_config_changed(project_id, version)
+    return version
+
+
+def get_user_version(user_id) -> int:
+    """Get the current version of a user's data and distributions."""
+    return _get_or_init([_user_version_key(user_id)], [USER_VERSION_TIMEOUT])[0]
+
+
+async def aget_user_version(user_id) -> int:
+    """Async version of get_user_version."""
+    return (await _aget_or_init([_user_version_key(user_id)], [USER_VERSION_TIMEOUT]))[0]
+
+
+def get_versions(project_id, user_id) -> Tuple[int, int]:
+    """Get the config version of a project and the version of a user in one round trip."""
+    config_version, user_version = _get_or_init(
+        [_config_version_key(project_id), _user_version_key(user_id)],
+        [None, USER_VERSION_TIMEOUT]
+    )
+    return config_version, user_version
+
+
+async def aget_versions(project_id, user_id) -> Tuple[int, int]:
+    """Async version of get_versions."""
+    config_version, user_version = await _aget_or_init(
+        [_config_version_key(project_id), _user_version_key(user_id)],
+        [None, USER_VERSION_TIMEOUT]
+    )
+    return config_version, user_version
+
+
+def bump_user_version(user_id) -> None:
+    """Mark a user's data or distributions as changed."""
+    _bump(_user_version_key(user_id), USER_VERSION_TIMEOUT)
+
+
+def get_event_version(project_id) -> int:
+    """Get the current version of a project's stored events."""
+    return _get_or_init([_event_version_key(project_id)], [None])[0]
+
+
+def bump_event_version(project_id) -> None:
+    """Mark that new events of a project were stored."""
+    _bump(_event_version_key(project_id), None)
+
+
+def _signature(project_id, user_id, config_version, user_version, params: str) -> str:
+    # Keyed with the SECRET_KEY, so clients cannot build tags for other users or versions
+    combined = f"{project_id}:{user_id}:{config_version}:{user_version}:{params}"
+    return salted_hmac('experiments.etag', combined, algorithm='sha256').hexdigest()[:16]
+
+
+def experiments_etag(
+    project_id,
+    user_id,
+    config_version: int,
+    user_version: int,
+    params: str,
+    representation: Optional[str] = None
+) -> str:
+    """
+    Build the ETag of a user experiments response.
+
+    The versions and the user id are part of the tag, so it can be validated
+    against the current versions without loading the user. The signature binds
+    the tag to the request parameters it was issued for. Responses in another
+    format than JSON have it appended, e.g. ";msgpack", so every format has its own tag.
+    """
+    signature = _signature(project_id, user_id, config_version, user_version, params)
+    suffix = f";{representation}" if representation else ''
+    return f'"{config_version}.{user_version}.{user_id}.{signature}{suffix}"'
+
+
+def match_experiments_etag(
+    project_id,
+    params: str,
+    if_none_match: str,
+    representation: Optional[str] = None
+) -> Optional[Tuple[str, str]]:
+    """
+    Check an If-None-Match header against the current versions.
+    Only tags of the requested representation match, see experiments_etag.
+
+    Returns:
+        tuple or None: The matching ETag and the user id it was issued for,
+            or None if no tag is current.
+    """
+    for etag, user_id, versions in _signed_etags(project_id, params, if_none_match, representation):
+        current = _get_or_init(
+            [_config_version_key(project_id), _user_version_key(user_id)],
+            [None, USER_VERSION_TIMEOUT]
+        )
+        if current == versions:
+            return etag, user_id
+
+    return None
+
+
+async def amatch_experiments_etag(
+    project_id,
+    params: str,
+    if_none_match: str,
+    representation: Optional[str] = None
+) -> Optional[Tuple[str, str]]:
+    """Async version of match_experiments_etag."""
+    for etag, user_id, versions in _signed_etags(project_id, params, if_none_match, representation):
+        current = await _aget_or_init(
+            [_config_version_key(project_id), _user_version_key(user_id)],
+            [None, USER_VERSION_TIMEOUT]
+        )
+        if current == versions:
+            return etag, user_id
+
+    return None
+
+
+def _signed_etags(project_id, params: str, if_none_match: str, representation: Optional[str]):
+    """
+    Yield the ETag, user id and versions of every validly signed tag of the
+    representation in an If-None-Match header.
+    """
+    for etag in parse_etags(if_none_match):
+        # Weak tags are the same tags compressed, see LibraryCompressionMiddleware
+        tag, _, tag_representation = etag.removeprefix('W/').strip('"').partition(';')
+        if (tag_representation or None) != representation:
+            continue
+        try:
+            config_version, user_version, user_id, signature = tag.split('.')
+            config_version, user_version = int(config_version), int(user_version)
+        except ValueError:
+            continue
+
+        if constant_time_compare(signature, _signature(project_id, user_id, config_version, user_version, params)):
+            yield etag, user_id, [config_version, user_version]
@@ -1,55 +1,262 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
 from django.db import transaction
+from django.conf import settings
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
-from experiments.models import Variant, Distribution
-from experiments.services.variant_service import recalculate_experiment_distributions
+from experiments.models import Project, Experiment, Variant, ProjectUser, Distribution
+from experiments.notifications import (
+    experiment_data,
+    variant_data,
+    send_distribution_update,
+    distribution_notifications_enabled
+)
+from experiments.services.allocation_service import rebalance_sticky_allocation, sync_experiment_allocation
+from experiments.services.api_key_service import invalidate_project
+from experiments.services.assignment_store import delete_assignments, is_store_enabled, set_assignments
+from experiments.services.enrollment_service import remove_enrollment, update_enrollment_counts
+from experiments.services.experiment_cache import (
+    find_cached_experiment,
+    invalidate_experiment_snapshots,
+    invalidate_project_snapshot
+)
+from experiments.services.recalculation_service import enqueue_recalculation, recalculate_experiment_distributions
+from experiments.services.version_service import bump_config_version, bump_user_version
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def project_changed_api_key(sender, instance, **kwargs):
+    """
+    Drop the cached API key lookups of the project once the change is committed.
+    """
+    transaction.on_commit(lambda: invalidate_project(instance))
+
+
+@receiver(post_save, sender=Experiment)
+@receiver(post_delete, sender=Experiment)
+def experiment_changed_snapshot(sender, instance, **kwargs):
+    """
+    Drop the cached snapshot of the experiment's project once the change is committed.
+    """
+    project_id = instance.project_id
+    transaction.on_commit(lambda: invalidate_project_snapshot(project_id))
+
+
+@receiver(post_save, sender=Variant)
+@receiver(post_delete, sender=Variant)
+def variant_changed_snapshot(sender, instance, **kwargs):
+    """
+    Drop the cached snapshots containing the variant's experiment once the change is committed.
+    """
+    experiment_id = instance.experiment_id
+    transaction.on_commit(lambda: invalidate_experiment_snapshots(experiment_id))
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=Experiment)
+@receiver(post_delete, sender=Experiment)
+def config_changed_version(sender, instance, **kwargs):
+    """
+    Bump the config version of the project once the change is committed.
+    """
+    project_id = instance.id if sender is Project else instance.project_id
+    transaction.on_commit(lambda: bump_config_version(project_id))
+
+
+@receiver(post_save, sender=Variant)
+@receiver(post_delete, sender=Variant)
+def variant_changed_version(sender, instance, **kwargs):
+    """
+    Bump the config version of the variant's project once the change is committed.
+    """
+    experiment_id = instance.experiment_id
+
+    def bump():
+        # Gone if the variant was deleted with its experiment, which bumps the version itself
+        project_id = Experiment.objects.filter(id=experiment_id).values_list('project_id', flat=True).first()
+        if project_id:
+            bump_config_version(project_id)
+
+    transaction.on_commit(bump)
+
+
+@receiver(post_save, sender=ProjectUser)
+@receiver(post_delete, sender=ProjectUser)
+def user_changed_version(sender, instance, **kwargs):
+    """
+    Bump the version of the user once the change is committed.
+    """
+    user_id = instance.id
+    transaction.on_commit(lambda: bump_user_version(user_id))
+
+
+@receiver(post_save, sender=Distribution)
+@receiver(post_delete, sender=Distribution)
+def distribution_changed_version(sender, instance, **kwargs):
+    """
+    Bump the version of the distributed user once the change is committed.
+    """
+    # Bulk changes bump the config version instead
+    if not distribution_notifications_enabled():
+        return
+
+    user_id = instance.user_id
+    transaction.on_commit(lambda: bump_user_version(user_id))
+
+
+@receiver(pre_save, sender=Distribution)
+def distribution_saving_enrollment(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    Remember which variant a distribution updated through the ORM was counted in,
+    for distribution_saved_enrollment.
+    """
+    instance._counted_variant = None
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and not {'experiment', 'experiment_id', 'variant', 'variant_id'} & set(update_fields):
+        return
+
+    instance._counted_variant = Distribution.objects.filter(pk=instance.pk).values_list(
+        'experiment_id', 'variant_id'
+    ).first()
+
+
+@receiver(post_save, sender=Distribution)
+def distribution_saved_enrollment(sender, instance, created, **kwargs):
+    """
+    Count distributions created through the ORM in their variant's enrollment counter,
+    and move updated ones that changed variant to the new variant's counter.
+    Bulk and raw writes count their distributions themselves.
+    """
+    if created:
+        update_enrollment_counts({(instance.experiment_id, instance.variant_id): 1})
+        return
+
+    counted = getattr(instance, '_counted_variant', None)
+    current = (instance.experiment_id, instance.variant_id)
+    if counted is not None and counted != current:
+        update_enrollment_counts({counted: -1, current: 1})
+
+
+@receiver(post_delete, sender=Distribution)
+def distribution_deleted_enrollment(sender, instance, origin=None, **kwargs):
+    """
+    Remove deleted distributions from their variant's enrollment counter.
+    """
+    # Deleted with their variant, experiment or project, whose counters go too
+    origin_model = getattr(origin, 'model', type(origin))
+    if origin_model in (Variant, Experiment, Project):
+        return
+
+    remove_enrollment(instance.experiment_id, instance.variant_id)
+
+
+@receiver(post_save, sender=Distribution)
+def distribution_saved_assignment_store(sender, instance, **kwargs):
+    """
+    Write the distribution's variant to the assignment store once the change is committed.
+    """
+    if not is_store_enabled():
+        return
+
+    pair = (instance.user_id, instance.experiment_id)
+    variant_id = instance.variant_id
+    transaction.on_commit(lambda: set_assignments({pair: variant_id}))
+
+
+@receiver(post_delete, sender=Distribution)
+def distribution_deleted_assignment_store(sender, instance, origin=None, **kwargs):
+    """
+    Remove the deleted distribution from the assignment store once the change is committed.
+    """
+    if not is_store_enabled():
+        return
+
+    # Entries of deleted variants are ignored and reconciled by the lookups
+    origin_model = getattr(origin, 'model', type(origin))
+    if origin_model in (Variant, Experiment, Project):
+        return
+
+    pair = (instance.user_id, instance.experiment_id)
+    transaction.on_commit(lambda: delete_assignments([pair]))
 
 
 @receiver(post_save, sender=Variant)
 def variant_saved(sender, instance, created, **kwargs):
     """
-    When a variant is created or updated, trigger recalculation of distributions
+    When a variant is created or updated, queue recalculation of distributions
     for the associated experiment.
     """
     # Use transaction.on_commit to ensure this runs after the current transaction completes
     if instance.experiment_id:  # Check if it exists before deletion
-        transaction.on_commit(lambda: handle_variant_change(instance, created))
+        experiment_id = instance.experiment_id
+        transaction.on_commit(lambda: handle_variant_change(experiment_id))
 
 
 @receiver(post_delete, sender=Variant)
 def variant_deleted(sender, instance, **kwargs):
     """
-    When a variant is deleted, trigger recalculation of distributions
+    When a variant is deleted, queue recalculation of distributions
     for the associated experiment.
     """
     # Use transaction.on_commit to ensure this runs after the current transaction completes
     if instance.experiment_id:  # Check if it exists before deletion
         experiment_id = instance.experiment_id  # Store the ID before deleting
-        transaction.on_commit(lambda: handle_variant_change(experiment_id, False))
+        transaction.on_commit(lambda: handle_variant_change(experiment_id))
 
 
-def handle_variant_change(variant, created):
+def handle_variant_change(experiment_id):
     """
     Handle variant changes by recalculating distributions if needed.
-    """
-    # Get the experiment associated with this variant
-    experiment = getattr(variant, 'experiment', None)
 
+    Recalculations run in the background worker and are debounced per experiment,
+    so saving several variants in a row results in a single recalculation.
+    """
+    experiment = Experiment.objects.filter(id=experiment_id).first()
     if not experiment:
         return
 
+    # Sticky experiments move only the buckets needed for the new rollouts
+    rebalance_sticky_allocation(experiment)
+
+    queue_recalculation(experiment)
+
+
+@receiver(post_save, sender=Experiment)
+def experiment_saved(sender, instance, created, **kwargs):
+    """
+    When an experiment is saved, make sure its stored bucket ranges match its allocation mode.
+    """
+    experiment_id = instance.id
+    transaction.on_commit(lambda: handle_allocation_change(experiment_id))
+
+
+def handle_allocation_change(experiment_id):
+    """
+    Store or drop the bucket ranges of an experiment, recalculating distributions
+    if that changed assignments.
+    """
+    experiment = Experiment.objects.filter(id=experiment_id).first()
+    if experiment and sync_experiment_allocation(experiment):
+        queue_recalculation(experiment)
+
+
+def queue_recalculation(experiment):
+    """
+    Recalculate the distributions of a running experiment, in the background unless
+    RECALCULATION_ASYNC is disabled.
+    """
     # Only recalculate if the experiment is running
-    if experiment.status == "running":
-        # Log that recalculation is happening
-        action = "created" if created else "updated or deleted"
-        print(f"Variant {variant.key} was {action}. Recalculating distributions for experiment {experiment.key}.")
+    if experiment.status != "running":
+        return
 
-        # Recalculate distributions
-        changed_count = recalculate_experiment_distributions(experiment)
-        print(f"Updated {changed_count} distributions for experiment {experiment.key}.")
+    if getattr(settings, 'RECALCULATION_ASYNC', True):
+        enqueue_recalculation(experiment.id)
+    else:
+        recalculate_experiment_distributions(experiment)
 
 
 @receiver(post_save, sender=Variant)
@@ -63,29 +270,13 @@ def variant_saved_websocket(sender, instance, created, **kwargs):
     if experiment.status == "running":
         channel_layer = get_channel_layer()
 
-        # Format the variant data
-        variant_data = {
-            'id': str(instance.id),
-            'key': instance.key,
-            'payload': instance.payload
-        }
-
-        # Format the experiment data
-        experiment_data = {
-            'id': str(experiment.id),
-            'key': experiment.key,
-            'name': experiment.name,
-            'status': experiment.status,
-            'type': experiment.type,
-        }
-
         # Send notification to the experiment's channel group
         async_to_sync(channel_layer.group_send)(
             f"experiment_{str(experiment.id)}",
             {
                 'type': 'experiment_update',
-                'experiment': experiment_data,
-                'variant': variant_data
+                'experiment': experiment_data(experiment),
+                'variant': variant_data(instance)
             }
         )
 
@@ -94,8 +285,8 @@ def variant_saved_websocket(sender, instance, created, **kwargs):
         #     f"project_{str(experiment.project.id)}",
         #     {
         #         'type': 'experiment_update',
-        #         'experiment': experiment_data,
-        #         'variant': variant_data
+        #         'experiment': experiment_data(experiment),
+        #         'variant': variant_data(instance)
         #     }
         # )
 
@@ -105,34 +296,18 @@ def distribution_saved_websocket(sender, instance, created, **kwargs):
     """
     When a distribution is updated, send notification to the specific user.
     """
-    experiment = instance.experiment
+    # Bulk changes are announced once with config_changed instead
+    if not distribution_notifications_enabled():
+        return
+
+    # Prefer the cached configuration so notifying does not load the experiment and variant,
+    # without loading the user or building a snapshot to find it
+    experiment = find_cached_experiment(instance.experiment_id)
+    variant = experiment.get_variant(instance.variant_id) if experiment else None
+    if experiment is None or variant is None:
+        experiment = instance.experiment
+        variant = instance.variant
 
     # Only send notifications if the experiment is running
     if experiment.status == "running":
-        channel_layer = get_channel_layer()
-
-        # Format the variant data
-        variant_data = {
-            'id': str(instance.variant.id),
-            'key': instance.variant.key,
-            'payload': instance.variant.payload
-        }
-
-        # Format the experiment data
-        experiment_data = {
-            'id': str(experiment.id),
-            'key': experiment.key,
-            'name': experiment.name,
-            'status': experiment.status,
-            'type': experiment.type,
-        }
-
-        # Send notification to the user's channel group
-        async_to_sync(channel_layer.group_send)(
-            f"user_{str(instance.user.id)}",
-            {
-                'type': 'distribution_update',
-                'experiment': experiment_data,
-                'variant': variant_data
-            }
-        )
\ No newline at end of file
+        send_distribution_update(instance.user_id, experiment, variant)
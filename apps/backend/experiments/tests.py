@@ -1,3 +1,2136 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import json
+import math
+import random
+import statistics
+import threading
+import time
+import unittest
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import brotli
+import msgpack
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db import (
+    DataError, DatabaseError, IntegrityError, InterfaceError, OperationalError, connection, transaction
+)
+from django.db.models import QuerySet
+from django.http import HttpResponse, JsonResponse
+from django.test import (
+    AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from . import async_library_views, library_views, signals
+from .async_library_views import AsyncUserExperimentsView
+from .compression import LibraryCompressionMiddleware, choose_encoding
+from .consumers import ExperimentConsumer
+from .library_views import UserExperimentsAPIView
+from .models import AdminUser, Distribution, Event, Experiment, Project, ProjectUser, RecalculationJob, Variant
+from .renderers import USER_FIELDS, accepts_msgpack, compact_response, pack_response
+from .services import (
+    api_key_service, assignment_store, circuit_breaker, degraded_service, event_service, experiment_cache, recalculation_service,
+    user_activity_service, variant_service
+)
+from .services.analysis_service import analyze_moments
+from .services.assignment_token import (
+    amatch_assignment_token, issue_assignment_token, load_assignment_token, match_assignment_token
+)
+from .services.bucketing import (
+    HASH_BUCKETS, CompiledExperiment, allocation_targets, compile_experiment, contiguous_owners, get_hash_bucket,
+    rebalance_owners
+)
+from .services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from .services.enrollment_service import get_enrollment_counts
+from .services.export_service import aiter_export, streaming_export
+from .services.experiment_cache import clear_snapshots, get_project_snapshot
+from .services.recalculation_service import (
+    _BUCKET_SQL, assign_buckets, claim_next_recalculation, enqueue_recalculation, fail_stale_recalculations,
+    get_hash_buckets, run_recalculation_job
+)
+from .services.srm_service import chi_square_sf, expected_shares, srm_test
+from .services.version_service import (
+    bump_config_version, bump_user_version, experiments_etag, get_versions, match_experiments_etag
+)
+
+ROLLOUT_SETS = [
+    [0.2, 0.3, 0.5],
+    [0.1, 0.2, 0.7],
+    [1 / 3, 1 / 3, 1 / 3],
+    [0.15, 0.35, 0.5],
+    [0.333, 0.333, 0.334],
+    [1, 2, 3],
+    [0.05, 0.0, 0.95],
+    [0.0, 1.0, 0.0],
+    [0.7, 0.0],
+]
+
+
+def baseline_hash_number(user_id: str, experiment_id: str) -> float:
+    """The hash of the original assign_variant, from the hex digest."""
+    hash_digest = hashlib.md5(f"{user_id}:{experiment_id}".encode()).hexdigest()
+    return (int(hash_digest, 16) % 10000) / 10000
+
+
+def baseline_assign(rollouts, hash_value: float) -> int:
+    """The original assign_variant, over float ranges. Returns the index of the variant."""
+    total_rollout = sum(rollouts)
+    nonzero = [index for index, rollout in enumerate(rollouts) if rollout > 0]
+    if len(nonzero) == 1:
+        return nonzero[0]
+
+    accumulated = 0
+    for index, rollout in enumerate(rollouts):
+        normalized_rollout = rollout / total_rollout
+        if accumulated <= hash_value < accumulated + normalized_rollout:
+            return index
+        accumulated += normalized_rollout
+    return len(rollouts) - 1
+
+
+def create_project():
+    # A new API key every time, since projects are cached by API key
+    api_key = uuid.uuid4().hex
+    owner = AdminUser.objects.create_user(email=f"{api_key}@example.com", password='password')
+    return Project.objects.create(api_key=api_key, title='Project', owner=owner)
+
+
+def build_experiment(rollouts):
+    """An unsaved experiment with variants in id order."""
+    experiment = Experiment(id=uuid.uuid4(), key='experiment', name='Experiment', project_id=uuid.uuid4())
+    variant_ids = sorted(uuid.uuid4() for _ in rollouts)
+    variants = [
+        Variant(id=variant_id, key=f"variant-{index}", rollout=rollout, experiment=experiment)
+        for index, (variant_id, rollout) in enumerate(zip(variant_ids, rollouts))
+    ]
+    return experiment, variants
+
+
+class BucketingTests(SimpleTestCase):
+    def test_hash_bucket_matches_baseline_hash(self):
+        experiment_id = str(uuid.uuid4())
+        for _ in range(1000):
+            user_id = str(uuid.uuid4())
+            self.assertEqual(
+                get_hash_bucket(user_id, experiment_id) / HASH_BUCKETS,
+                baseline_hash_number(user_id, experiment_id)
+            )
+
+    def test_every_bucket_matches_baseline_assignment(self):
+        for rollouts in ROLLOUT_SETS:
+            experiment, variants = build_experiment(rollouts)
+            compiled = compile_experiment(experiment, variants)
+            for bucket in range(HASH_BUCKETS):
+                with self.subTest(rollouts=rollouts, bucket=bucket):
+                    expected = variants[baseline_assign(rollouts, bucket / HASH_BUCKETS)]
+                    self.assertEqual(compiled.assign_bucket(bucket).id, expected.id)
+
+    def test_boundary_buckets_match_baseline_assignment(self):
+        for rollouts in ROLLOUT_SETS:
+            experiment, variants = build_experiment(rollouts)
+            compiled = compile_experiment(experiment, variants)
+            for bound in compiled.bounds:
+                for bucket in (bound - 1, bound, bound + 1):
+                    if not 0 <= bucket < HASH_BUCKETS:
+                        continue
+                    with self.subTest(rollouts=rollouts, bucket=bucket):
+                        expected = variants[baseline_assign(rollouts, bucket / HASH_BUCKETS)]
+                        self.assertEqual(compiled.assign_bucket(bucket).id, expected.id)
+
+    def test_users_match_baseline_assignment(self):
+        for rollouts in ROLLOUT_SETS:
+            experiment, variants = build_experiment(rollouts)
+            compiled = compile_experiment(experiment, variants)
+            for _ in range(500):
+                user_id = uuid.uuid4()
+                hash_value = baseline_hash_number(str(user_id), str(experiment.id))
+                expected = variants[baseline_assign(rollouts, hash_value)]
+                self.assertEqual(compiled.assign(user_id).id, expected.id)
+
+    def test_variant_order_does_not_matter(self):
+        experiment, variants = build_experiment([0.2, 0.3, 0.5])
+        forward = compile_experiment(experiment, variants)
+        backward = compile_experiment(experiment, list(reversed(variants)))
+        self.assertEqual(forward.bounds, backward.bounds)
+        self.assertEqual([variant.id for variant in forward.variants], [variant.id for variant in variants])
+
+
+class HashBucketsTests(SimpleTestCase):
+    def test_matches_hash_bucket(self):
+        experiment_id = uuid.uuid4()
+        user_ids = [uuid.uuid4() for _ in range(5000)]
+        self.assertEqual(
+            get_hash_buckets(user_ids, experiment_id).tolist(),
+            [get_hash_bucket(str(user_id), str(experiment_id)) for user_id in user_ids]
+        )
+
+    def test_matches_hash_bucket_with_high_bit_words(self):
+        # Digests whose 32-bit words all have the high bit set, where uint64 overflow would show
+        experiment_id = uuid.uuid4()
+        user_ids = []
+        while len(user_ids) < 200:
+            user_id = uuid.uuid4()
+            digest = hashlib.md5(f"{user_id}:{experiment_id}".encode()).digest()
+            if all(digest[offset] & 0x80 for offset in range(0, 16, 4)):
+                user_ids.append(user_id)
+
+        self.assertEqual(
+            get_hash_buckets(user_ids, experiment_id).tolist(),
+            [get_hash_bucket(str(user_id), str(experiment_id)) for user_id in user_ids]
+        )
+
+    def test_empty(self):
+        self.assertEqual(len(get_hash_buckets([], uuid.uuid4())), 0)
+
+    def test_assign_buckets_matches_assign_bucket(self):
+        buckets = np.arange(HASH_BUCKETS, dtype=np.int64)
+        for rollouts in ROLLOUT_SETS:
+            experiment, variants = build_experiment(rollouts)
+            compiled = compile_experiment(experiment, variants)
+            indexes = assign_buckets(compiled, buckets)
+            self.assertEqual(
+                [compiled.variants[index].id for index in indexes],
+                [compiled.assign_bucket(bucket).id for bucket in range(HASH_BUCKETS)]
+            )
+
+
+# (user id, experiment id, bucket) as computed by _BUCKET_SQL on PostgreSQL. The last
+# three digests have the high bit set in every 32-bit word.
+FIXED_BUCKETS = [
+    ('6513270e-269e-4d37-b2a7-4de452e6b438', 'd23f0824-128b-4f33-8c5c-7fd0a6a3a450', 8380),
+    ('9531985d-5d9d-49f8-9818-e811892f902b', '36f675cc-81e7-4ef5-a8e2-5d940ed90475', 1691),
+    ('6b0d549b-6f03-475a-9600-a35a099950d8', '8d116ece-1738-47d9-bd9c-172411e20b8f', 2350),
+    ('10a3d6b2-aa05-411a-b271-5945795e8229', '4f426dcb-b394-4b36-bb2d-420f0f88080b', 8120),
+    ('65dc9f50-3f63-4f83-bd05-61e6211c70cf', '7f1b103c-df15-42b0-aab4-77d26415479c', 8594),
+    ('e0cfab4c-eaef-44d2-93bf-6d016bae4b5b', '26debfdb-8825-4e56-a179-b37d806c10b5', 4593),
+]
+
+
+class FixedBucketsTests(SimpleTestCase):
+    def test_hash_bucket_matches_sql_buckets(self):
+        for user_id, experiment_id, bucket in FIXED_BUCKETS:
+            self.assertEqual(get_hash_bucket(user_id, experiment_id), bucket)
+            self.assertEqual(get_hash_buckets([user_id], experiment_id).tolist(), [bucket])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Requires PostgreSQL")
+class BucketSQLTests(TestCase):
+    def test_fixed_buckets(self):
+        with connection.cursor() as cursor:
+            for user_id, experiment_id, bucket in FIXED_BUCKETS:
+                cursor.execute(
+                    f"SELECT {_BUCKET_SQL} FROM (SELECT md5(%s || ':' || %s) AS h) AS hashed",
+                    [user_id, experiment_id]
+                )
+                self.assertEqual(cursor.fetchone()[0], bucket)
+
+    def test_matches_hash_bucket(self):
+        experiment_id = uuid.uuid4()
+        user_ids = [uuid.uuid4() for _ in range(2000)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT {_BUCKET_SQL} FROM (
+                    SELECT md5(user_id || ':' || %s) AS h, position
+                    FROM unnest(%s::text[]) WITH ORDINALITY AS users(user_id, position)
+                ) AS hashed
+                ORDER BY position
+                """,
+                [str(experiment_id), [str(user_id) for user_id in user_ids]]
+            )
+            buckets = [bucket for bucket, in cursor.fetchall()]
+
+        self.assertEqual(buckets, [get_hash_bucket(str(user_id), str(experiment_id)) for user_id in user_ids])
+
+
+class RecalculationQueueTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=self.project, type='multiple_variant'
+        )
+        self.other_experiment = Experiment.objects.create(
+            key='other', name='Other', project=self.project, type='multiple_variant'
+        )
+        RecalculationJob.objects.all().delete()
+
+    def test_enqueue_postpones_the_pending_job(self):
+        first = enqueue_recalculation(self.experiment.id, delay=5)
+        second = enqueue_recalculation(self.experiment.id, delay=60)
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(RecalculationJob.objects.filter(experiment=self.experiment).count(), 1)
+        first.refresh_from_db()
+        self.assertGreater(first.run_after, timezone.now() + timedelta(seconds=30))
+
+    def test_enqueue_after_claim_queues_another_job(self):
+        first = enqueue_recalculation(self.experiment.id, delay=0)
+        self.assertEqual(claim_next_recalculation().id, first.id)
+
+        second = enqueue_recalculation(self.experiment.id, delay=0)
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(second.status, 'pending')
+
+    def test_claim_skips_jobs_that_are_not_due(self):
+        enqueue_recalculation(self.experiment.id, delay=60)
+        self.assertIsNone(claim_next_recalculation())
+
+    def test_claim_marks_the_job_running(self):
+        job = enqueue_recalculation(self.experiment.id, delay=0)
+
+        claimed = claim_next_recalculation()
+        self.assertEqual(claimed.id, job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'running')
+        self.assertIsNotNone(job.started_at)
+        self.assertIsNone(claim_next_recalculation())
+
+    def test_claim_skips_experiments_with_a_running_job(self):
+        enqueue_recalculation(self.experiment.id, delay=0)
+        claim_next_recalculation()
+        enqueue_recalculation(self.experiment.id, delay=0)
+        other = enqueue_recalculation(self.other_experiment.id, delay=0)
+
+        self.assertEqual(claim_next_recalculation().id, other.id)
+        self.assertIsNone(claim_next_recalculation())
+
+    def test_claim_takes_the_earliest_job(self):
+        later = enqueue_recalculation(self.experiment.id, delay=0)
+        RecalculationJob.objects.filter(id=later.id).update(run_after=timezone.now() - timedelta(seconds=1))
+        earlier = enqueue_recalculation(self.other_experiment.id, delay=0)
+        RecalculationJob.objects.filter(id=earlier.id).update(run_after=timezone.now() - timedelta(seconds=10))
+
+        self.assertEqual(claim_next_recalculation().id, earlier.id)
+
+    def test_run_records_the_outcome(self):
+        enqueue_recalculation(self.experiment.id, delay=0)
+        job = run_recalculation_job(claim_next_recalculation())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertIsNotNone(job.finished_at)
+
+    def test_run_leaves_a_job_failed_as_stale(self):
+        enqueue_recalculation(self.experiment.id, delay=0)
+        job = claim_next_recalculation()
+        RecalculationJob.objects.filter(id=job.id).update(started_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(fail_stale_recalculations(), 1)
+
+        with mock.patch(
+            'experiments.services.recalculation_service.recalculate_experiment_distributions'
+        ) as recalculate:
+            run_recalculation_job(job)
+
+        recalculate.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'Timed out')
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Requires PostgreSQL")
+class StaleRecalculationLockTests(TransactionTestCase):
+    def setUp(self):
+        experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=create_project(), type='multiple_variant'
+        )
+        enqueue_recalculation(experiment.id, delay=0)
+        self.job = claim_next_recalculation()
+        RecalculationJob.objects.filter(id=self.job.id).update(started_at=timezone.now() - timedelta(days=1))
+
+    def hold_lock(self, locked, release):
+        try:
+            with transaction.atomic():
+                RecalculationJob.objects.select_for_update().filter(id=self.job.id).exists()
+                locked.set()
+                release.wait(10)
+        finally:
+            connection.close()
+
+    def test_skips_a_job_its_worker_still_holds(self):
+        locked, release = threading.Event(), threading.Event()
+        worker = threading.Thread(target=self.hold_lock, args=(locked, release))
+        worker.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            self.assertEqual(fail_stale_recalculations(), 0)
+        finally:
+            release.set()
+            worker.join()
+
+        self.assertEqual(fail_stale_recalculations(), 1)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'failed')
+
+
+# Activity is written right away, not by the flusher thread after the test database is gone
+@override_settings(USER_ACTIVITY_BUFFER=False)
+class GetOrCreateUserTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+
+    def test_creates_a_user_once(self):
+        users, created = variant_service._find_or_insert_users(
+            self.project, {'device_id': 'device'}, {'device_id': 'device'}
+        )
+        self.assertTrue(created)
+        self.assertEqual(len(users), 1)
+
+        again, created = variant_service._find_or_insert_users(
+            self.project, {'device_id': 'device'}, {'device_id': 'device'}
+        )
+        self.assertFalse(created)
+        self.assertEqual([user.id for user in again], [users[0].id])
+        self.assertEqual(ProjectUser.objects.filter(project=self.project).count(), 1)
+
+    def test_does_not_create_from_an_id_alone(self):
+        users, created = variant_service._find_or_insert_users(self.project, {'id': uuid.uuid4()}, {'id': 'unknown'})
+        self.assertEqual(users, [])
+        self.assertFalse(created)
+
+    @override_settings(USER_ACTIVITY_BUFFER=False)
+    def test_unknown_id_is_not_found(self):
+        user_id = uuid.uuid4()
+        known = ProjectUser.objects.create(project=self.project, device_id='device')
+
+        with self.assertRaisesMessage(ProjectUser.DoesNotExist, f"User {user_id} not found"):
+            variant_service.get_or_create_user(self.project, {'id': str(user_id)})
+        with self.assertRaises(ProjectUser.DoesNotExist):
+            variant_service.get_or_create_users(self.project, [{'device_id': 'device'}, {'id': str(user_id)}])
+        self.assertEqual(variant_service.get_or_create_user(self.project, {'id': str(known.id)}), known)
+
+        for view in [UserExperimentsAPIView, AsyncUserExperimentsView]:
+            with self.subTest(view=view.__name__):
+                request = RequestFactory().get('/api/experiments', {'id': str(user_id)})
+                request.project = self.project
+                if view is AsyncUserExperimentsView:
+                    response = async_to_sync(view.as_view())(request)
+                else:
+                    response = view.as_view()(request).render()
+
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(json.loads(response.content), {'error': f"User {user_id} not found"})
+
+    def test_concurrent_insert_returns_the_other_user(self):
+        new_user_data = variant_service._new_user_data
+        atomic = variant_service.transaction.atomic
+        concurrent = []
+
+        def insert_concurrently():
+            # Another request inserts the same user between the lookup and the insert
+            if not concurrent:
+                concurrent.append(ProjectUser.objects.create(project=self.project, device_id='device'))
+
+        def before_insert(*args, **kwargs):
+            insert_concurrently()
+            return atomic(*args, **kwargs)
+
+        def before_statement(*args):
+            insert_concurrently()
+            return new_user_data(*args)
+
+        with mock.patch.object(variant_service.transaction, 'atomic', side_effect=before_insert), \
+                mock.patch.object(variant_service, '_new_user_data', side_effect=before_statement):
+            users, created = variant_service._find_or_insert_users(
+                self.project, {'device_id': 'device'}, {'device_id': 'device'}
+            )
+
+        self.assertFalse(created)
+        self.assertEqual([user.id for user in users], [concurrent[0].id])
+        self.assertEqual(ProjectUser.objects.filter(project=self.project).count(), 1)
+
+    def test_retries_when_the_user_disappears(self):
+        find_or_insert_users = variant_service._find_or_insert_users
+        calls = []
+
+        def deleted_concurrently(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                return [], False
+            return find_or_insert_users(*args)
+
+        with mock.patch.object(variant_service, '_find_or_insert_users', side_effect=deleted_concurrently):
+            user = variant_service.get_or_create_user(self.project, {'device_id': 'device'})
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(user.device_id, 'device')
+
+    def test_retries_when_an_identifier_is_taken(self):
+        device_user = ProjectUser.objects.create(project=self.project, device_id='device')
+        email_user = ProjectUser.objects.create(project=self.project, email='user@example.com')
+        find_or_insert_users = variant_service._find_or_insert_users
+        calls = []
+
+        def stale_lookup(*args):
+            # The first lookup ran before the email was claimed by another user
+            calls.append(args)
+            if len(calls) == 1:
+                return [ProjectUser.objects.get(id=device_user.id)], False
+            return find_or_insert_users(*args)
+
+        with mock.patch.object(variant_service, '_find_or_insert_users', side_effect=stale_lookup):
+            user = variant_service.get_or_create_user(
+                self.project, {'device_id': 'device', 'email': 'user@example.com'}
+            )
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((user.device_id, user.email), ('device', 'user@example.com'))
+        self.assertEqual(ProjectUser.objects.filter(project=self.project).count(), 1)
+        self.assertIn(user.id, {device_user.id, email_user.id})
+
+    def test_merges_users_matching_different_identifiers(self):
+        ProjectUser.objects.create(
+            project=self.project, device_id='device', properties={'plan': 'free', 'country': 'KZ'}
+        )
+        ProjectUser.objects.create(
+            project=self.project, email='user@example.com', external_id='external', properties={'plan': 'pro'}
+        )
+
+        user = variant_service.get_or_create_user(self.project, {'device_id': 'device', 'email': 'user@example.com'})
+
+        self.assertEqual(ProjectUser.objects.filter(project=self.project).count(), 1)
+        user.refresh_from_db()
+        self.assertEqual((user.device_id, user.email, user.external_id), ('device', 'user@example.com', 'external'))
+        self.assertEqual(user.properties['country'], 'KZ')
+
+    def test_updates_missing_identifiers(self):
+        existing = ProjectUser.objects.create(project=self.project, device_id='device')
+
+        user = variant_service.get_or_create_user(self.project, {'device_id': 'device', 'external_id': 'external'})
+
+        self.assertEqual(user.id, existing.id)
+        existing.refresh_from_db()
+        self.assertEqual(existing.external_id, 'external')
+
+    def test_requires_an_identifier(self):
+        with self.assertRaises(ValueError):
+            variant_service.get_or_create_user(self.project, {})
+
+
+class InsertDistributionTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=self.project, type='multiple_variant', status='running'
+        )
+        for index, rollout in enumerate([0.2, 0.3, 0.5]):
+            Variant.objects.create(experiment=self.experiment, key=f"variant-{index}", rollout=rollout)
+        self.compiled = compile_experiment(self.experiment)
+        self.users = ProjectUser.objects.bulk_create(
+            ProjectUser(project=self.project, device_id=f"device-{index}") for index in range(30)
+        )
+
+    def assertCountsMatchDistributions(self):
+        stored = {}
+        for variant_id in Distribution.objects.filter(experiment=self.experiment).values_list('variant_id', flat=True):
+            stored[variant_id] = stored.get(variant_id, 0) + 1
+        counts = {variant_id: enrolled for variant_id, enrolled in get_enrollment_counts(self.experiment.id).items() if enrolled}
+        self.assertEqual(counts, stored)
+
+    def test_insert_distribution_once(self):
+        user = self.users[0]
+
+        distribution, created = variant_service._insert_distribution(user, self.compiled)
+        self.assertTrue(created)
+        self.assertEqual(distribution.variant_id, self.compiled.assign(user.id).id)
+
+        again, created = variant_service._insert_distribution(user, self.compiled)
+        self.assertFalse(created)
+        self.assertEqual((again.id, again.variant_id), (distribution.id, distribution.variant_id))
+
+        self.assertEqual(Distribution.objects.filter(experiment=self.experiment).count(), 1)
+        self.assertEqual(get_enrollment_counts(self.experiment.id)[distribution.variant_id], 1)
+
+    def test_insert_distribution_keeps_the_existing_variant(self):
+        user = self.users[0]
+        other_variant = next(variant for variant in self.compiled.variants if variant != self.compiled.assign(user.id))
+        existing = Distribution.objects.create(user=user, experiment=self.experiment, variant_id=other_variant.id)
+
+        distribution, created = variant_service._insert_distribution(user, self.compiled)
+
+        self.assertFalse(created)
+        self.assertEqual((distribution.id, distribution.variant_id), (existing.id, other_variant.id))
+        self.assertCountsMatchDistributions()
+
+    def test_insert_distributions_skips_existing_pairs(self):
+        variant_service._insert_distribution(self.users[0], self.compiled)
+        variant_ids = {}
+        new_distributions = variant_service._assign_missing(
+            [user.id for user in self.users], [self.compiled], variant_ids
+        )
+
+        with mock.patch.object(variant_service, 'DISTRIBUTION_INSERT_BATCH_SIZE', 7):
+            inserted = variant_service._insert_distributions(new_distributions)
+
+        self.assertEqual({distribution.user_id for distribution in inserted}, {user.id for user in self.users[1:]})
+        self.assertEqual(Distribution.objects.filter(experiment=self.experiment).count(), len(self.users))
+        self.assertCountsMatchDistributions()
+
+        # Inserting the same pairs again changes nothing
+        again = variant_service._assign_missing([user.id for user in self.users], [self.compiled], {})
+        self.assertEqual(variant_service._insert_distributions(again), [])
+        self.assertEqual(Distribution.objects.filter(experiment=self.experiment).count(), len(self.users))
+        self.assertCountsMatchDistributions()
+
+
+def variant_moments(values):
+    """Sufficient statistics of (x, y) pairs, as fetch_variant_moments computes them."""
+    return [
+        len(values),
+        sum(y for _, y in values),
+        sum(y * y for _, y in values),
+        sum(x for x, _ in values),
+        sum(x * x for x, _ in values),
+        sum(x * y for x, y in values),
+    ]
+
+
+class AnalyzeMomentsTests(SimpleTestCase):
+    def test_hand_computed_comparison(self):
+        control = [(0, y) for y in [1, 2, 3, 4]]
+        treatment = [(0, y) for y in [2, 4, 6, 8]]
+
+        results = analyze_moments(np.array([variant_moments(control), variant_moments(treatment)]), 0, cuped=False)
+
+        # Means 2.5 and 5, variances 5/3 and 20/3, standard error sqrt(5/12 + 20/12)
+        self.assertEqual(results['mean'].tolist(), [2.5, 5.0])
+        self.assertAlmostEqual(results['std'][0], math.sqrt(5 / 3))
+        self.assertAlmostEqual(results['std'][1], math.sqrt(20 / 3))
+        self.assertAlmostEqual(results['difference'][1], 2.5)
+        self.assertAlmostEqual(results['z'][1], math.sqrt(3))
+        self.assertAlmostEqual(results['p_value'][1], 0.083265, places=6)
+        self.assertAlmostEqual(results['difference_ci'][0][1], -0.328964, places=6)
+        self.assertAlmostEqual(results['difference_ci'][1][1], 5.328964, places=6)
+        self.assertAlmostEqual(results['relative_lift'][1], 1.0)
+        self.assertAlmostEqual(results['relative_lift_ci'][0][1], 1 - 1.959964 * math.sqrt(8 / 15), places=5)
+        self.assertAlmostEqual(results['relative_lift_ci'][1][1], 1 + 1.959964 * math.sqrt(8 / 15), places=5)
+        self.assertEqual(results['difference'][0], 0)
+        self.assertEqual((results['theta'], results['variance_reduction']), (0.0, 0.0))
+
+    def test_confidence_level(self):
+        moments = np.array([variant_moments([(0, y) for y in [1, 2, 3, 4]]), variant_moments([(0, y) for y in [2, 4, 6, 8]])])
+
+        results = analyze_moments(moments, 0, confidence=0.9, cuped=False)
+
+        # 1.644854 is the 95th percentile of the standard normal distribution
+        self.assertAlmostEqual(results['difference_ci'][1][1], 2.5 + 1.644854 * math.sqrt(25 / 12), places=5)
+
+    def test_cuped(self):
+        generator = random.Random(1)
+        groups = []
+        for lift in [0, 0.5, 1]:
+            values = []
+            for _ in range(200):
+                x = generator.gauss(10, 2)
+                values.append((x, 0.8 * x + lift + generator.gauss(0, 1)))
+            groups.append(values)
+
+        results = analyze_moments(np.array([variant_moments(values) for values in groups]), 0)
+
+        pooled = [pair for values in groups for pair in values]
+        xs, ys = [x for x, _ in pooled], [y for _, y in pooled]
+        theta = statistics.covariance(xs, ys) / statistics.variance(xs)
+        self.assertAlmostEqual(results['theta'], theta)
+        adjusted = [y - theta * x for x, y in pooled]
+        self.assertAlmostEqual(results['variance_reduction'], 1 - statistics.variance(adjusted) / statistics.variance(ys))
+        self.assertGreater(results['variance_reduction'], 0.5)
+
+        mean_x = statistics.mean(xs)
+        for index, values in enumerate(groups):
+            group_xs, group_ys = [x for x, _ in values], [y for _, y in values]
+            self.assertAlmostEqual(results['unadjusted_mean'][index], statistics.mean(group_ys))
+            self.assertAlmostEqual(
+                results['mean'][index],
+                statistics.mean(group_ys) - theta * (statistics.mean(group_xs) - mean_x)
+            )
+            self.assertAlmostEqual(results['std'][index], statistics.stdev([y - theta * x for x, y in values]))
+
+        # The adjusted variances are smaller, so the z-scores are larger
+        unadjusted = analyze_moments(np.array([variant_moments(values) for values in groups]), 0, cuped=False)
+        self.assertGreater(abs(results['z'][2]), abs(unadjusted['z'][2]))
+
+    def test_constant_covariate_is_not_adjusted(self):
+        moments = np.array([variant_moments([(1, y) for y in [1, 2, 3]]), variant_moments([(1, y) for y in [2, 3, 5]])])
+
+        results = analyze_moments(moments, 0)
+
+        self.assertEqual(results['theta'], 0.0)
+        self.assertEqual(results['mean'].tolist(), results['unadjusted_mean'].tolist())
+
+    def test_empty_variant(self):
+        moments = np.array([variant_moments([(0, y) for y in [1, 2, 3]]), [0] * 6])
+
+        results = analyze_moments(moments, 0)
+
+        self.assertTrue(np.isnan(results['mean'][1]))
+        self.assertTrue(np.isnan(results['p_value'][1]))
+
+
+# Critical values of the chi-square distribution: degrees of freedom -> {p-value: statistic}
+CHI_SQUARE_TABLE = {
+    1: {0.1: 2.706, 0.05: 3.841, 0.01: 6.635, 0.001: 10.828},
+    2: {0.1: 4.605, 0.05: 5.991, 0.01: 9.210, 0.001: 13.816},
+    3: {0.1: 6.251, 0.05: 7.815, 0.01: 11.345, 0.001: 16.266},
+    4: {0.1: 7.779, 0.05: 9.488, 0.01: 13.277, 0.001: 18.467},
+    5: {0.1: 9.236, 0.05: 11.070, 0.01: 15.086, 0.001: 20.515},
+}
+
+
+class SampleRatioTests(SimpleTestCase):
+    def test_chi_square_sf_matches_table(self):
+        for degrees_of_freedom, critical_values in CHI_SQUARE_TABLE.items():
+            for p_value, statistic in critical_values.items():
+                with self.subTest(degrees_of_freedom=degrees_of_freedom, p_value=p_value):
+                    # The table is rounded to three decimals
+                    self.assertAlmostEqual(chi_square_sf(statistic, degrees_of_freedom), p_value, delta=p_value * 0.002)
+
+    def test_chi_square_sf_closed_forms(self):
+        for statistic in [0.5, 1, 3, 10, 40]:
+            self.assertAlmostEqual(chi_square_sf(statistic, 1), math.erfc(math.sqrt(statistic / 2)))
+            self.assertAlmostEqual(chi_square_sf(statistic, 2), math.exp(-statistic / 2))
+
+    def test_chi_square_sf_edges(self):
+        self.assertEqual(chi_square_sf(0, 3), 1.0)
+        self.assertEqual(chi_square_sf(5, 0), 1.0)
+        self.assertLess(chi_square_sf(1000, 5), 1e-100)
+
+    def test_srm_test(self):
+        statistic, p_value = srm_test([50, 50], [0.5, 0.5])
+        self.assertEqual((statistic, p_value), (0.0, 1.0))
+
+        # (60 - 50)^2 / 50 + (40 - 50)^2 / 50 = 4
+        statistic, p_value = srm_test([60, 40], [0.5, 0.5])
+        self.assertAlmostEqual(statistic, 4.0)
+        self.assertAlmostEqual(p_value, math.erfc(math.sqrt(2)))
+
+        self.assertEqual(srm_test([10, 5], [1.0, 0.0])[1], 0.0)
+        self.assertEqual(srm_test([0, 0], [0.5, 0.5]), (0.0, 1.0))
+
+    def test_expected_shares_contiguous(self):
+        experiment, variants = build_experiment([0.2, 0.3, 0.5])
+        self.assertEqual(expected_shares(compile_experiment(experiment, variants)), [0.2, 0.3, 0.5])
+
+        experiment, variants = build_experiment([0.0, 1.0, 0.0])
+        self.assertEqual(expected_shares(compile_experiment(experiment, variants)), [0.0, 1.0, 0.0])
+
+    def test_expected_shares_sticky(self):
+        experiment, variants = build_experiment([0.25, 0.25, 0.5])
+        experiment.allocation = 'sticky'
+        experiment.bucket_ranges = [
+            [0, 1000, str(variants[2].id)],
+            [1000, 3500, str(variants[0].id)],
+            [3500, 4000, str(variants[2].id)],
+            [4000, 6500, str(variants[1].id)],
+            [6500, HASH_BUCKETS, str(variants[2].id)],
+        ]
+
+        compiled = compile_experiment(experiment, variants)
+
+        self.assertEqual(expected_shares(compiled), [0.25, 0.25, 0.5])
+        self.assertEqual(compiled.assign_bucket(500).id, variants[2].id)
+        self.assertEqual(compiled.assign_bucket(3600).id, variants[2].id)
+
+    def test_expected_shares_sticky_falls_back_to_contiguous(self):
+        experiment, variants = build_experiment([0.2, 0.3, 0.5])
+        experiment.allocation = 'sticky'
+        # Does not cover the bucket space, so it is not used
+        experiment.bucket_ranges = [[0, 5000, str(variants[0].id)], [6000, HASH_BUCKETS, str(variants[1].id)]]
+
+        self.assertEqual(expected_shares(compile_experiment(experiment, variants)), [0.2, 0.3, 0.5])
+
+
+class AssignmentTokenTests(SimpleTestCase):
+    params = 'device_id=device'
+
+    def setUp(self):
+        self.project_id = uuid.uuid4()
+        self.user_id = uuid.uuid4()
+        self.variant_ids = {uuid.uuid4(): uuid.uuid4(), uuid.uuid4(): uuid.uuid4()}
+        config_version, user_version = get_versions(self.project_id, self.user_id)
+        self.token = issue_assignment_token(
+            self.project_id, self.params, self.user_id, config_version, user_version, self.variant_ids
+        )
+
+    def test_round_trip(self):
+        assignment = match_assignment_token(self.project_id, self.params, self.token)
+
+        self.assertEqual(assignment.user_id, self.user_id)
+        self.assertEqual(assignment.variant_ids, self.variant_ids)
+        self.assertEqual((assignment.config_version, assignment.user_version), get_versions(self.project_id, self.user_id))
+
+    async def test_async_round_trip(self):
+        assignment = await amatch_assignment_token(self.project_id, self.params, self.token)
+        self.assertEqual(assignment.variant_ids, self.variant_ids)
+
+    def test_tampered(self):
+        payload, signature = self.token.rsplit(':', 1)
+        forged = f"{payload}:{signature[:-1]}{'A' if signature[-1] != 'A' else 'B'}"
+
+        self.assertIsNone(load_assignment_token(self.project_id, self.params, forged))
+        self.assertIsNone(load_assignment_token(self.project_id, self.params, 'not a token'))
+        self.assertIsNone(load_assignment_token(self.project_id, self.params, ''))
+
+    def test_other_project(self):
+        self.assertIsNone(load_assignment_token(uuid.uuid4(), self.params, self.token))
+
+    def test_other_params(self):
+        self.assertIsNone(load_assignment_token(self.project_id, 'device_id=other', self.token))
+
+    @override_settings(ASSIGNMENT_TOKEN_MAX_AGE=60)
+    def test_expired(self):
+        now = time.time()
+        with mock.patch('django.core.signing.time.time', return_value=now + 59):
+            self.assertIsNotNone(load_assignment_token(self.project_id, self.params, self.token))
+        with mock.patch('django.core.signing.time.time', return_value=now + 61):
+            self.assertIsNone(load_assignment_token(self.project_id, self.params, self.token))
+
+    def test_stale_config_version(self):
+        bump_config_version(self.project_id)
+
+        self.assertIsNotNone(load_assignment_token(self.project_id, self.params, self.token))
+        self.assertIsNone(match_assignment_token(self.project_id, self.params, self.token))
+
+    async def test_stale_user_version(self):
+        bump_user_version(self.user_id)
+
+        self.assertIsNone(match_assignment_token(self.project_id, self.params, self.token))
+        self.assertIsNone(await amatch_assignment_token(self.project_id, self.params, self.token))
+
+
+def user_data(user_id):
+    return {
+        'id': str(user_id),
+        'device_id': 'device',
+        'email': None,
+        'external_id': 'external',
+        'latest_current_url': None,
+        'latest_os': 'iOS',
+        'latest_os_version': '17',
+        'latest_device_type': 'mobile',
+        'properties': {'plan': 'pro'},
+        'first_seen': '2024-01-01T00:00:00Z',
+    }
+
+
+def assignment_data(experiment_id, variant_id):
+    return {
+        'experiment': {'id': str(experiment_id), 'key': 'experiment', 'name': 'Experiment'},
+        'variant': {'id': str(variant_id), 'key': 'control', 'payload': {'color': 'red'}},
+    }
+
+
+class MessagePackTests(SimpleTestCase):
+    def test_accepts_msgpack(self):
+        for accept, expected in [
+            (None, False),
+            ('', False),
+            ('*/*', False),
+            ('application/json', False),
+            ('application/msgpack', True),
+            ('Application/MsgPack', True),
+            ('application/msgpack, application/json', True),
+            ('application/json, application/msgpack;q=0.9', False),
+            ('application/json;q=0.5, application/msgpack;q=0.8', True),
+            ('application/json;q=0.8, application/msgpack;q=0.8', True),
+            ('application/msgpack;q=0', False),
+            ('application/msgpack; q=0.1, */*', True),
+            ('application/msgpack;q=abc', False),
+        ]:
+            with self.subTest(accept=accept):
+                self.assertEqual(accepts_msgpack(accept), expected)
+
+    def test_compact_user_experiments(self):
+        user_id, experiment_id, variant_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+        compact = compact_response({'user': user_data(user_id), 'experiments': [assignment_data(experiment_id, variant_id)]})
+
+        self.assertEqual(len(compact['user']), len(USER_FIELDS))
+        self.assertEqual(compact['user'], [
+            user_id.bytes, 'device', None, 'external', None, 'iOS', '17', 'mobile', {'plan': 'pro'}
+        ])
+        self.assertEqual(compact['experiments'], [
+            [experiment_id.bytes, 'experiment', 'Experiment', variant_id.bytes, 'control', {'color': 'red'}]
+        ])
+
+    def test_compact_variant(self):
+        experiment_id, variant_id = uuid.uuid4(), uuid.uuid4()
+
+        self.assertEqual(
+            compact_response(assignment_data(experiment_id, variant_id)),
+            [experiment_id.bytes, 'experiment', 'Experiment', variant_id.bytes, 'control', {'color': 'red'}]
+        )
+
+    def test_compact_batch(self):
+        user_id, experiment_id, variant_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        result = {'user': user_data(user_id), 'experiments': [assignment_data(experiment_id, variant_id)]}
+        error = {'error': 'At least one identifier must be provided'}
+
+        compact = compact_response({'results': [result, error]})
+
+        self.assertEqual(compact['results'][0], compact_response(result))
+        self.assertEqual(compact['results'][1], error)
+
+    def test_other_responses_keep_their_shape(self):
+        self.assertEqual(compact_response({'error': 'Experiment not found'}), {'error': 'Experiment not found'})
+        self.assertEqual(compact_response([1, 2]), [1, 2])
+
+    def test_pack_response(self):
+        experiment_id, variant_id = uuid.uuid4(), uuid.uuid4()
+
+        packed = pack_response(assignment_data(experiment_id, variant_id))
+
+        self.assertEqual(
+            msgpack.unpackb(packed, raw=False),
+            [experiment_id.bytes, 'experiment', 'Experiment', variant_id.bytes, 'control', {'color': 'red'}]
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    USER_ACTIVITY_BUFFER=False
+)
+class ExperimentConsumerTests(TransactionTestCase):
+    # Channels closes database connections between calls, which a TestCase transaction does not survive
+    def setUp(self):
+        self.project = create_project()
+        self.experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=self.project, type='multiple_variant', status='running'
+        )
+        Variant.objects.create(experiment=self.experiment, key='control', rollout=1)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(
+            ExperimentConsumer.as_asgi(),
+            f"/ws/experiments/?api_key={self.project.api_key}&device_id=device&experiments=none"
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_rejects_malformed_experiment_keys(self):
+        communicator = await self.connect()
+        try:
+            for message in [
+                {'type': 'evaluate', 'experiment_keys': 'experiment'},
+                {'type': 'subscribe', 'experiment_keys': ['experiment', 1]},
+                {'type': 'unsubscribe', 'experiment_keys': {'key': 'experiment'}},
+                {'type': 'subscribe_experiment', 'experiment_key': ['experiment']},
+            ]:
+                with self.subTest(message=message):
+                    await communicator.send_json_to(message)
+                    response = await communicator.receive_json_from()
+                    self.assertEqual(response['type'], 'error')
+                    self.assertEqual(response['request_type'], message['type'])
+        finally:
+            await communicator.disconnect()
+
+    async def test_evaluate(self):
+        communicator = await self.connect()
+        try:
+            await communicator.send_json_to({'type': 'evaluate', 'experiment_keys': ['experiment']})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['type'], 'experiments_state')
+            self.assertEqual([state['experiment']['key'] for state in response['experiments']], ['experiment'])
+        finally:
+            await communicator.disconnect()
+
+    async def test_config_changed_carries_the_version(self):
+        communicator = await self.connect()
+        try:
+            version = await sync_to_async(bump_config_version)(self.project.id)
+
+            response = await communicator.receive_json_from()
+            self.assertEqual(response, {'type': 'config_changed', 'version': version})
+            self.assertTrue(await communicator.receive_nothing())
+        finally:
+            await communicator.disconnect()
+
+    async def test_unsubscribe_leaves_the_experiment_group(self):
+        communicator = await self.connect()
+        group_name = f"experiment_{self.experiment.id}"
+        update = {'type': 'experiment_update', 'experiment': {'key': 'experiment'}, 'variant': None}
+        try:
+            # Evaluating the experiment assigns the user, which sends a distribution update as well
+            await communicator.send_json_to({'type': 'subscribe', 'experiment_keys': ['experiment']})
+            received = {(await communicator.receive_json_from())['type'] for _ in range(2)}
+            self.assertEqual(received, {'experiments_state', 'distribution_updated'})
+
+            await get_channel_layer().group_send(group_name, update)
+            self.assertEqual((await communicator.receive_json_from())['type'], 'experiment_updated')
+
+            # Unknown and unsubscribed keys are ignored
+            await communicator.send_json_to({'type': 'unsubscribe', 'experiment_keys': ['experiment', 'unknown']})
+            await communicator.send_json_to({'type': 'unsubscribe_experiment', 'experiment_key': 'experiment'})
+            # Answered once the messages before it were handled
+            await communicator.send_json_to({'type': 'evaluate', 'experiment_keys': ['experiment']})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'experiments_state')
+
+            await get_channel_layer().group_send(group_name, update)
+            self.assertTrue(await communicator.receive_nothing())
+        finally:
+            await communicator.disconnect()
+
+
+@override_settings(USER_ACTIVITY_BUFFER=False)
+class ExperimentsETagTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=self.project, type='multiple_variant', status='running'
+        )
+        Variant.objects.create(experiment=experiment, key='control', rollout=1)
+
+    def get(self, view, accept, if_none_match=None):
+        headers = {'X-API-KEY': self.project.api_key, 'Accept': accept}
+        if if_none_match:
+            headers['If-None-Match'] = if_none_match
+        request = RequestFactory().get('/api/experiments', {'device_id': 'device'}, headers=headers)
+        # Set by the ProjectAuthMiddleware
+        request.project = self.project
+
+        if view is AsyncUserExperimentsView:
+            return async_to_sync(view.as_view())(request)
+        return view.as_view()(request).render()
+
+    def test_formats_have_their_own_etags(self):
+        for view in [UserExperimentsAPIView, AsyncUserExperimentsView]:
+            with self.subTest(view=view.__name__):
+                json_etag = self.get(view, 'application/json')['ETag']
+                msgpack_response = self.get(view, 'application/msgpack')
+                msgpack_etag = msgpack_response['ETag']
+
+                self.assertEqual(msgpack_response['Content-Type'], 'application/msgpack')
+                self.assertNotEqual(json_etag, msgpack_etag)
+                self.assertTrue(msgpack_etag.endswith(';msgpack"'))
+
+                self.assertEqual(self.get(view, 'application/json', json_etag).status_code, 304)
+                self.assertEqual(self.get(view, 'application/msgpack', msgpack_etag).status_code, 304)
+                self.assertEqual(self.get(view, 'application/msgpack', json_etag).status_code, 200)
+                self.assertEqual(self.get(view, 'application/json', msgpack_etag).status_code, 200)
+
+
+class ETagSignatureTests(SimpleTestCase):
+    params = 'device_id=device'
+
+    def setUp(self):
+        self.project_id = uuid.uuid4()
+        self.user_id = uuid.uuid4()
+        self.config_version, self.user_version = get_versions(self.project_id, self.user_id)
+
+    def test_current_tag_matches(self):
+        etag = experiments_etag(self.project_id, self.user_id, self.config_version, self.user_version, self.params)
+
+        self.assertEqual(
+            match_experiments_etag(self.project_id, self.params, etag),
+            (etag, str(self.user_id))
+        )
+        bump_user_version(self.user_id)
+        self.assertIsNone(match_experiments_etag(self.project_id, self.params, etag))
+
+    def test_unkeyed_signature_is_rejected(self):
+        combined = f"{self.project_id}:{self.user_id}:{self.config_version}:{self.user_version}:{self.params}"
+        signature = hashlib.sha256(combined.encode()).hexdigest()[:16]
+        forged = f'"{self.config_version}.{self.user_version}.{self.user_id}.{signature}"'
+
+        self.assertIsNone(match_experiments_etag(self.project_id, self.params, forged))
+
+    def test_tag_of_another_secret_key_is_rejected(self):
+        with override_settings(SECRET_KEY='another secret key'):
+            etag = experiments_etag(self.project_id, self.user_id, self.config_version, self.user_version, self.params)
+
+        self.assertIsNone(match_experiments_etag(self.project_id, self.params, etag))
+
+
+class AllocationTargetsTests(SimpleTestCase):
+    rollout_sets = ROLLOUT_SETS + [[1] * 7, [1 / 6] * 6, [0.78, 0.91, 0.43, 0.04, 0.27], [0.0, 0.0]]
+
+    def test_targets_match_contiguous_allocation(self):
+        for rollouts in self.rollout_sets:
+            with self.subTest(rollouts=rollouts):
+                variant_ids = [f"variant-{index}" for index in range(len(rollouts))]
+                owners = contiguous_owners(variant_ids, rollouts)
+
+                self.assertEqual(
+                    allocation_targets(rollouts),
+                    [owners.count(variant_id) for variant_id in variant_ids]
+                )
+
+    def test_rebalancing_contiguous_allocation_moves_nothing(self):
+        for rollouts in self.rollout_sets:
+            with self.subTest(rollouts=rollouts):
+                variant_ids = [f"variant-{index}" for index in range(len(rollouts))]
+                owners = contiguous_owners(variant_ids, rollouts)
+
+                new_owners, moved = rebalance_owners(owners, variant_ids, rollouts)
+
+                self.assertEqual(moved, 0)
+                self.assertEqual(new_owners, owners)
+
+    def test_rebalancing_moves_the_fewest_buckets(self):
+        variant_ids = ['a', 'b']
+        owners = contiguous_owners(variant_ids, [0.5, 0.5])
+
+        new_owners, moved = rebalance_owners(owners, variant_ids, [0.3, 0.7])
+
+        self.assertEqual(moved, 2000)
+        self.assertEqual([new_owners.count(variant_id) for variant_id in variant_ids], [3000, 7000])
+        self.assertEqual(new_owners[:3000], ['a'] * 3000)
+
+
+def event_row(**values):
+    row = {
+        'id': uuid.uuid4(), 'project_id': uuid.uuid4(), 'user_id': uuid.uuid4(), 'experiment_id': None,
+        'variant_id': None, 'name': 'event', 'value': None, 'timestamp': timezone.now(), 'received_at': timezone.now()
+    }
+    row.update(values)
+    return tuple(row[column] for column in event_service.EVENT_COLUMNS)
+
+
+@override_settings(EVENT_BATCH_SIZE=2, EVENT_MAX_PENDING=5, EVENT_MAX_FLUSH_ATTEMPTS=3)
+class EventBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.buffer = event_service.EventBuffer()
+        # No background flusher, the tests flush themselves
+        self.buffer._start_flusher = lambda: None
+        self.written = []
+
+    def write(self, rows):
+        self.written.extend(rows)
+        return len(rows)
+
+    def test_flush_writes_in_batches(self):
+        rows = [event_row() for _ in range(5)]
+        self.buffer.record(rows)
+
+        with mock.patch.object(event_service, 'write_events', side_effect=self.write) as write_events:
+            self.assertEqual(self.buffer.flush(), 5)
+
+        self.assertEqual(self.written, rows)
+        self.assertEqual([len(call.args[0]) for call in write_events.call_args_list], [2, 2, 1])
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_record_drops_the_oldest_events(self):
+        rows = [event_row() for _ in range(7)]
+        self.buffer.record(rows[:4])
+        self.buffer.record(rows[4:])
+
+        self.assertEqual(self.buffer.dropped, 2)
+        with mock.patch.object(event_service, 'write_events', side_effect=self.write):
+            self.buffer.flush()
+        self.assertEqual(self.written, rows[2:])
+
+    def test_record_never_writes(self):
+        with mock.patch.object(event_service, 'write_events', side_effect=DatabaseError) as write_events:
+            self.buffer.record([event_row() for _ in range(10)])
+
+        write_events.assert_not_called()
+        self.assertTrue(self.buffer._wake.is_set())
+
+    def test_unreachable_database_keeps_the_events(self):
+        rows = [event_row() for _ in range(3)]
+        self.buffer.record(rows)
+
+        with mock.patch.object(event_service, 'write_events', side_effect=OperationalError):
+            for _ in range(5):
+                with self.assertRaises(OperationalError):
+                    self.buffer.flush()
+
+        with mock.patch.object(event_service, 'write_events', side_effect=self.write):
+            self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(self.written, rows)
+        self.assertEqual(self.buffer.dropped, 0)
+
+    def test_failing_batch_is_written_row_by_row(self):
+        bad_row = event_row()
+        rows = [event_row(), bad_row, event_row()]
+        self.buffer.record(rows)
+
+        def write(batch):
+            if bad_row in batch:
+                raise DataError
+            return self.write(batch)
+
+        with mock.patch.object(event_service, 'write_events', side_effect=write):
+            for _ in range(2):
+                with self.assertRaises(DataError):
+                    self.buffer.flush()
+            self.assertEqual(self.written, [])
+
+            # The last attempt writes the good rows of the batch and drops the bad one
+            self.assertEqual(self.buffer.flush(), 2)
+
+        self.assertEqual(self.written, [rows[0], rows[2]])
+        self.assertEqual(self.buffer.dropped, 1)
+
+
+@override_settings(EVENT_BUFFER=False, USER_ACTIVITY_BUFFER=False)
+class IngestEventVariantTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        # Deferred assignments stay buffered, the background flusher would outlive the test database
+        patcher = mock.patch.object(variant_service.assignment_buffer, 'record')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_experiment(self, key, assignment):
+        experiment = Experiment.objects.create(
+            key=key, name=key, project=self.project, type='multiple_variant', status='running', assignment=assignment
+        )
+        for index, rollout in enumerate([0.5, 0.5]):
+            Variant.objects.create(experiment=experiment, key=f"variant-{index}", rollout=rollout)
+        return experiment
+
+    def ingest(self, experiment, device_id='device'):
+        event_service.ingest_events(self.project, [{'device_id': device_id, 'name': 'event', 'experiment': experiment.key}])
+        return Event.objects.filter(experiment=experiment).latest('received_at')
+
+    def test_event_has_the_served_variant(self):
+        for assignment in ['stateless', 'deferred', 'stored']:
+            with self.subTest(assignment=assignment):
+                experiment = self.create_experiment(assignment, assignment)
+                user = variant_service.get_or_create_user(self.project, {'device_id': 'device'})
+                served = variant_service.get_user_variants(self.project, user, [experiment.key])[0][1]
+
+                self.assertEqual(self.ingest(experiment).variant_id, served.id)
+
+    def test_event_does_not_assign_stored_experiments(self):
+        experiment = self.create_experiment('stored', 'stored')
+
+        self.assertIsNone(self.ingest(experiment).variant_id)
+        self.assertFalse(Distribution.objects.filter(experiment=experiment).exists())
+
+
+@override_settings(USER_ACTIVITY_BATCH_SIZE=2, USER_ACTIVITY_MAX_PENDING=3)
+class UserActivityBufferTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.users = ProjectUser.objects.bulk_create(
+            ProjectUser(project=self.project, device_id=f"device-{index}") for index in range(4)
+        )
+        self.buffer = user_activity_service.UserActivityBuffer()
+        # No background flusher, the tests flush themselves
+        self.buffer._start_flusher = lambda: None
+
+    def test_flush_writes_the_latest_values(self):
+        user = self.users[0]
+        user.latest_os = 'iOS'
+        self.buffer.record(user, ['latest_os'])
+        user.latest_os = 'Android'
+        self.buffer.record(user, ['latest_os'])
+        self.buffer.record(self.users[1])
+
+        self.assertEqual(self.buffer.flush(), 2)
+
+        stored = ProjectUser.objects.in_bulk([self.users[0].id, self.users[1].id])
+        self.assertEqual(stored[self.users[0].id].latest_os, 'Android')
+        self.assertEqual(stored[self.users[1].id].last_seen, self.users[1].last_seen)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_record_never_writes(self):
+        with self.assertNumQueries(0):
+            for user in self.users[:3]:
+                self.buffer.record(user)
+
+        self.assertTrue(self.buffer._wake.is_set())
+
+    def test_record_drops_the_first_users(self):
+        for user in self.users:
+            self.buffer.record(user)
+
+        self.assertEqual(self.buffer.dropped, 1)
+        self.assertEqual(list(self.buffer._pending), [user.id for user in self.users[1:]])
+
+    def test_failed_flush_keeps_the_updates(self):
+        user = self.users[0]
+        user.latest_os = 'iOS'
+        self.buffer.record(user, ['latest_os'])
+
+        with mock.patch.object(ProjectUser.objects, 'bulk_update', side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+
+        # Newer values recorded meanwhile win over the ones put back
+        self.buffer.record(user)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(ProjectUser.objects.get(id=user.id).latest_os, 'iOS')
+        self.assertEqual(ProjectUser.objects.get(id=user.id).last_seen, user.last_seen)
+
+
+@override_settings(
+    DB_BREAKER_FAILURE_THRESHOLD=2, DB_BREAKER_WINDOW_SECONDS=10, DB_BREAKER_RESET_SECONDS=5,
+    DB_BREAKER_SLOW_CALL_SECONDS=1
+)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test')
+        self.now = 100.0
+        patcher = mock.patch.object(circuit_breaker.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fail_call(self, error=OperationalError):
+        with self.assertRaises(error):
+            with self.breaker.guard():
+                raise error
+
+    def test_opens_on_connection_errors(self):
+        self.fail_call()
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.fail_call(InterfaceError)
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            with self.breaker.guard():
+                self.fail('The block must not run')
+        self.assertEqual(self.breaker.metrics()['rejected_calls'], 1)
+
+    def test_data_errors_are_not_failures(self):
+        for error in [IntegrityError, DataError, ValueError]:
+            self.fail_call(error)
+            self.fail_call(error)
+
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.assertEqual(self.breaker.metrics()['recent_failures'], 0)
+
+    def test_failures_expire(self):
+        self.fail_call()
+        self.now += 11
+        self.fail_call()
+
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+
+    def test_slow_calls_are_failures(self):
+        for _ in range(2):
+            with self.breaker.guard():
+                self.now += 2
+
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+
+    def test_half_open_probe_closes_the_breaker(self):
+        self.fail_call()
+        self.fail_call()
+        self.now += 5
+        self.assertEqual(self.breaker.state, circuit_breaker.HALF_OPEN)
+
+        with self.breaker.guard():
+            # Only the probe is let through
+            self.assertFalse(self.breaker.allow())
+
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_the_breaker_again(self):
+        self.fail_call()
+        self.fail_call()
+        self.now += 5
+
+        self.fail_call()
+
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        self.assertEqual(self.breaker.metrics()['trips'], 2)
+
+    def test_data_error_releases_the_probe(self):
+        self.fail_call()
+        self.fail_call()
+        self.now += 5
+
+        self.fail_call(IntegrityError)
+
+        self.assertEqual(self.breaker.state, circuit_breaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+
+@override_settings(USER_ACTIVITY_BUFFER=False)
+class LibraryDatabaseErrorTests(TestCase):
+    views = [
+        (UserExperimentsAPIView, library_views, 'get_or_create_user'),
+        (AsyncUserExperimentsView, async_library_views, 'aget_or_create_user'),
+    ]
+
+    def setUp(self):
+        self.project = create_project()
+        experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=self.project, type='multiple_variant', status='running'
+        )
+        Variant.objects.create(experiment=experiment, key='control', rollout=1)
+
+        # A breaker of the test's own, and no backfill of the skipped writes
+        for module in [library_views, async_library_views]:
+            patcher = mock.patch.object(module, 'database_breaker', CircuitBreaker('test'))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(degraded_service, '_record_skipped_write')
+        self.skipped_writes = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, view, **params):
+        request = RequestFactory().get('/api/experiments', params, headers={'X-API-KEY': self.project.api_key})
+        # Set by the ProjectAuthMiddleware
+        request.project = self.project
+
+        if view is AsyncUserExperimentsView:
+            response = async_to_sync(view.as_view())(request)
+        else:
+            response = view.as_view()(request).render()
+        return response, json.loads(response.content)
+
+    def test_unavailable_database_serves_degraded_variants(self):
+        for view, module, get_user in self.views:
+            with self.subTest(view=view.__name__):
+                response, data = self.get(view, device_id='device')
+                self.assertEqual(response.status_code, 200)
+                user_id = data['user']['id']
+
+                with mock.patch.object(module, get_user, side_effect=OperationalError):
+                    response, degraded = self.get(view, id=user_id)
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['X-Degraded'], 'true')
+                self.assertEqual(degraded['experiments'], data['experiments'])
+                self.skipped_writes.assert_called()
+
+    def test_users_served_before_keep_their_variants(self):
+        for view, module, get_user in self.views:
+            with self.subTest(view=view.__name__):
+                response, data = self.get(view, device_id='known')
+
+                with mock.patch.object(module, get_user, side_effect=OperationalError):
+                    response, degraded = self.get(view, device_id='known')
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(degraded['user']['id'], data['user']['id'])
+                self.assertEqual(degraded['experiments'], data['experiments'])
+
+    def test_unknown_users_are_not_served(self):
+        for view, module, get_user in self.views:
+            with self.subTest(view=view.__name__):
+                # Builds the snapshot degraded responses are served from
+                self.get(view, device_id='device')
+
+                with mock.patch.object(module, get_user, side_effect=OperationalError):
+                    response, data = self.get(view, device_id='unknown')
+
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(data, library_views.DATABASE_UNAVAILABLE)
+
+    def test_data_errors_are_not_degraded(self):
+        for view, module, get_user in self.views:
+            with self.subTest(view=view.__name__):
+                with mock.patch.object(module, get_user, side_effect=IntegrityError('duplicate key')):
+                    response, data = self.get(view, device_id='device')
+
+                self.assertEqual(response.status_code, 500)
+                self.assertFalse(response.has_header('X-Degraded'))
+                self.assertEqual(module.database_breaker.metrics()['recent_failures'], 0)
+
+
+@override_settings(USER_ACTIVITY_BUFFER=False)
+class EnrollmentCounterTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=self.project, type='multiple_variant', status='running'
+        )
+        self.control = Variant.objects.create(experiment=self.experiment, key='control', rollout=0.5)
+        self.treatment = Variant.objects.create(experiment=self.experiment, key='treatment', rollout=0.5)
+        self.user = ProjectUser.objects.create(project=self.project, device_id='device')
+
+    def assertEnrolled(self, control, treatment):
+        counts = get_enrollment_counts(self.experiment.id)
+        self.assertEqual(
+            (counts.get(self.control.id, 0), counts.get(self.treatment.id, 0)),
+            (control, treatment)
+        )
+
+    def test_created_distribution_is_counted(self):
+        Distribution.objects.create(user=self.user, experiment=self.experiment, variant=self.control)
+
+        self.assertEnrolled(1, 0)
+
+    def test_changed_variant_moves_the_count(self):
+        distribution = Distribution.objects.create(user=self.user, experiment=self.experiment, variant=self.control)
+
+        distribution.variant = self.treatment
+        distribution.save()
+        self.assertEnrolled(0, 1)
+
+        # Saved again without a change, or with other fields only
+        distribution.save()
+        distribution.save(update_fields=['updated_at'])
+        self.assertEnrolled(0, 1)
+
+    def test_stale_instance_is_counted_once(self):
+        distribution = Distribution.objects.create(user=self.user, experiment=self.experiment, variant=self.control)
+
+        stale = Distribution.objects.get(id=distribution.id)
+        distribution.variant = self.treatment
+        distribution.save()
+        stale.variant = self.treatment
+        stale.save(update_fields=['variant'])
+
+        self.assertEnrolled(0, 1)
+
+    def test_deleted_distribution_is_removed(self):
+        distribution = Distribution.objects.create(user=self.user, experiment=self.experiment, variant=self.control)
+
+        distribution.delete()
+
+        self.assertEnrolled(0, 0)
+
+
+@override_settings(USER_ACTIVITY_BUFFER=False)
+class DistributionNotificationTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=self.project, type='multiple_variant', status='running'
+        )
+        self.control = Variant.objects.create(experiment=self.experiment, key='control', rollout=0.5)
+        self.treatment = Variant.objects.create(experiment=self.experiment, key='treatment', rollout=0.5)
+        user = ProjectUser.objects.create(project=self.project, device_id='device')
+        Distribution.objects.create(user=user, experiment=self.experiment, variant=self.control)
+        # Loaded without its user
+        self.distribution = Distribution.objects.get(experiment=self.experiment)
+        clear_snapshots()
+        self.addCleanup(clear_snapshots)
+
+    def save(self):
+        self.distribution.variant = self.treatment
+        with mock.patch.object(signals, 'send_distribution_update') as send_update:
+            with CaptureQueriesContext(connection) as queries:
+                self.distribution.save()
+        send_update.assert_called_once()
+        return send_update.call_args.args, [query['sql'] for query in queries]
+
+    def queried(self, model, queries):
+        return [sql for sql in queries if connection.ops.quote_name(model._meta.db_table) in sql]
+
+    def test_uses_the_cached_experiment(self):
+        get_project_snapshot(self.project.id)
+
+        (user_id, experiment, variant), queries = self.save()
+
+        self.assertEqual(user_id, self.distribution.user_id)
+        self.assertIsInstance(experiment, CompiledExperiment)
+        self.assertEqual(variant.id, self.treatment.id)
+        self.assertFalse(self.queried(ProjectUser, queries))
+        self.assertFalse(self.queried(Experiment, queries))
+
+    def test_does_not_build_a_snapshot(self):
+        with mock.patch.object(experiment_cache, 'build_project_snapshot') as build_snapshot:
+            (_, experiment, variant), queries = self.save()
+
+        build_snapshot.assert_not_called()
+        self.assertEqual(experiment, self.experiment)
+        self.assertEqual(variant, self.treatment)
+        self.assertFalse(self.queried(ProjectUser, queries))
+
+
+@override_settings(USER_ACTIVITY_BUFFER=False)
+class RecalculationPushTests(TestCase):
+    def setUp(self):
+        project = create_project()
+        self.experiment = Experiment.objects.create(
+            key='experiment', name='Experiment', project=project, type='multiple_variant', status='running'
+        )
+        control = Variant.objects.create(experiment=self.experiment, key='control', rollout=1)
+        Variant.objects.create(experiment=self.experiment, key='treatment', rollout=1)
+        for i in range(10):
+            user = ProjectUser.objects.create(project=project, device_id=f"device-{i}")
+            Distribution.objects.create(user=user, experiment=self.experiment, variant=control)
+        # Everyone moves to the treatment, without the variant signals
+        Variant.objects.filter(id=control.id).update(rollout=0)
+
+    def recalculate(self):
+        with mock.patch.object(recalculation_service, 'bump_config_version') as bump, \
+                mock.patch.object(recalculation_service, 'notify_distribution_changes') as notify, \
+                mock.patch.object(signals, 'send_distribution_update') as send_update, \
+                self.captureOnCommitCallbacks(execute=True):
+            changed = recalculation_service.recalculate_experiment_distributions(self.experiment)
+
+        self.assertEqual(changed, 10)
+        bump.assert_called_once_with(self.experiment.project_id)
+        send_update.assert_not_called()
+        return notify
+
+    def test_pushes_one_config_change(self):
+        self.recalculate().assert_not_called()
+
+    @override_settings(DISTRIBUTION_PUSH_MODE='user')
+    def test_user_push_mode_notifies_the_moved_users(self):
+        notify = self.recalculate()
+
+        notify.assert_called_once()
+        self.assertEqual(len(notify.call_args.args[1]), 10)
+
+
+@override_settings(RESPONSE_COMPRESSION_MIN_SIZE=100)
+class CompressionTests(SimpleTestCase):
+    body = {'experiments': [{'key': f"experiment-{index}", 'variant': 'control'} for index in range(20)]}
+
+    def respond(self, accept_encoding=None, response=None, project=True):
+        headers = {'Accept-Encoding': accept_encoding} if accept_encoding is not None else {}
+        request = RequestFactory().get('/api/experiments', headers=headers)
+        request.project = Project(id=uuid.uuid4()) if project else None
+        response = response or JsonResponse(self.body, headers={'ETag': '"etag"'})
+        return LibraryCompressionMiddleware(lambda request: response)(request)
+
+    def test_choose_encoding(self):
+        for accept_encoding, expected in [
+            (None, None),
+            ('', None),
+            ('identity', None),
+            ('gzip', 'gzip'),
+            ('br', 'br'),
+            ('gzip, deflate, br', 'br'),
+            ('BR', 'br'),
+            ('br;q=0, gzip', 'gzip'),
+            ('br;q=0.5, gzip;q=0.8', 'gzip'),
+            ('br;q=0.8, gzip;q=0.8', 'br'),
+            ('gzip;q=0', None),
+            ('*', 'br'),
+            ('*;q=0.5, br;q=0', 'gzip'),
+            ('br;q=abc, gzip', 'gzip'),
+        ]:
+            with self.subTest(accept_encoding=accept_encoding):
+                self.assertEqual(choose_encoding(accept_encoding), expected)
+
+    def test_brotli(self):
+        response = self.respond('gzip, br')
+
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.content)), self.body)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(response['ETag'], 'W/"etag"')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_gzip(self):
+        response = self.respond('gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content)), self.body)
+
+    def test_uncompressed_responses(self):
+        for name, response in [
+            ('not accepted', self.respond('identity')),
+            ('small', self.respond('br', JsonResponse({'error': 'Not found'}))),
+            ('msgpack', self.respond('br', HttpResponse(b'x' * 200, content_type='application/msgpack'))),
+            ('admin', self.respond('br', project=False)),
+        ]:
+            with self.subTest(name):
+                self.assertFalse(response.has_header('Content-Encoding'))
+
+
+# The worker's cache alone, except for the shared cache tests
+@override_settings(API_KEY_CACHE_REDIS=False, API_KEY_CACHE_SYNC_INTERVAL=0)
+class ApiKeyCacheTests(TestCase):
+    def setUp(self):
+        api_key_service._entries.clear()
+        self.project = create_project()
+        self.api_key = self.project.api_key
+
+    def change_key(self):
+        # Without the project signals, as another worker would see it
+        Project.objects.filter(id=self.project.id).update(api_key=uuid.uuid4().hex)
+
+    def test_caches_the_project(self):
+        self.assertEqual(api_key_service.get_project_by_api_key(self.api_key), self.project)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(api_key_service.get_project_by_api_key(self.api_key), self.project)
+
+    def test_caches_unknown_keys(self):
+        self.assertIsNone(api_key_service.get_project_by_api_key('unknown'))
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(api_key_service.get_project_by_api_key('unknown'))
+
+    def test_invalidate_api_key(self):
+        api_key_service.get_project_by_api_key(self.api_key)
+        self.change_key()
+
+        api_key_service.invalidate_api_key(self.api_key)
+        self.assertIsNone(api_key_service.get_project_by_api_key(self.api_key))
+
+    def test_invalidation_by_another_worker(self):
+        api_key_service.get_project_by_api_key(self.api_key)
+        self.change_key()
+
+        # Another worker only bumps the generation, this worker's entries are left as they are
+        api_key_service._bump_generation()
+        self.assertIsNone(api_key_service.get_project_by_api_key(self.api_key))
+
+    @override_settings(API_KEY_CACHE_SYNC_INTERVAL=60)
+    def test_generation_is_checked_at_the_sync_interval(self):
+        api_key_service.get_project_by_api_key(self.api_key)
+        self.change_key()
+
+        api_key_service._bump_generation()
+        self.assertEqual(api_key_service.get_project_by_api_key(self.api_key), self.project)
+
+    def test_invalidate_project_drops_previous_keys(self):
+        api_key_service.get_project_by_api_key(self.api_key)
+        self.change_key()
+        self.project.refresh_from_db()
+
+        api_key_service.invalidate_project(self.project)
+        self.assertIsNone(api_key_service.get_project_by_api_key(self.api_key))
+        self.assertEqual(api_key_service.get_project_by_api_key(self.project.api_key), self.project)
+
+    @override_settings(API_KEY_CACHE_REDIS=True)
+    def test_shared_cache(self):
+        api_key_service.get_project_by_api_key(self.api_key)
+        api_key_service.get_project_by_api_key('unknown')
+        # A new worker
+        api_key_service._entries.clear()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(api_key_service.get_project_by_api_key(self.api_key), self.project)
+            self.assertIsNone(api_key_service.get_project_by_api_key('unknown'))
+
+        self.change_key()
+        api_key_service.invalidate_api_key(self.api_key)
+        api_key_service._entries.clear()
+        self.assertIsNone(api_key_service.get_project_by_api_key(self.api_key))
+
+
+# Assignments written to the database, not behind the assignment store
+@override_settings(ASSIGNMENT_STORE=False, USER_ACTIVITY_BUFFER=False)
+class BatchEvaluationTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        for key in ['first', 'second', 'third']:
+            experiment = Experiment.objects.create(
+                key=key, name=key, project=self.project, type='multiple_variant', status='running'
+            )
+            Variant.objects.create(experiment=experiment, key='control', rollout=1)
+            Variant.objects.create(experiment=experiment, key='treatment', rollout=1)
+
+    def evaluate(self, users, experiments=None):
+        data = {'users': users}
+        if experiments is not None:
+            data['experiments'] = experiments
+        request = RequestFactory().post(
+            '/api/experiments/evaluate', data, content_type='application/json',
+            headers={'X-API-KEY': self.project.api_key}
+        )
+        request.project = self.project
+        response = library_views.BatchEvaluationAPIView.as_view()(request).render()
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def count_queries(self, users, experiments=None):
+        # Activity is buffered, and written by the flusher thread apart from the request
+        with override_settings(USER_ACTIVITY_BUFFER=True), \
+                mock.patch.object(user_activity_service.user_activity_buffer, 'record'), \
+                CaptureQueriesContext(connection) as queries:
+            self.evaluate(users, experiments)
+        return len(queries)
+
+    def test_evaluates_every_user(self):
+        data = self.evaluate([{'device_id': 'a'}, {'device_id': 'b'}], ['first', 'unknown'])
+
+        self.assertEqual(data['missing_experiments'], ['unknown'])
+        self.assertEqual(len(data['results']), 2)
+        for result in data['results']:
+            self.assertEqual([item['experiment']['key'] for item in result['experiments']], ['first'])
+        self.assertEqual(Distribution.objects.filter(experiment__project=self.project).count(), 2)
+
+    def test_assignments_are_stable(self):
+        users = [{'device_id': f"device-{i}"} for i in range(5)]
+
+        self.assertEqual(self.evaluate(users), self.evaluate(users))
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        # Builds the snapshot
+        self.evaluate([{'device_id': 'warmup'}])
+
+        small = self.count_queries([{'device_id': 'small'}], ['first'])
+        large = self.count_queries([{'device_id': f"large-{i}"} for i in range(20)])
+        self.assertEqual(small, large)
+
+        # Known users with their distributions
+        small = self.count_queries([{'device_id': 'small'}], ['first'])
+        large = self.count_queries([{'device_id': f"large-{i}"} for i in range(20)])
+        self.assertEqual(small, large)
+
+
+# Assignments written to the database, not behind the assignment store
+@override_settings(ASSIGNMENT_STORE=False, USER_ACTIVITY_BUFFER=False)
+class UserExperimentsQueryTests(TestCase):
+    def create_project(self, experiments):
+        project = create_project()
+        for i in range(experiments):
+            experiment = Experiment.objects.create(
+                key=f"experiment-{i}", name='Experiment', project=project, type='multiple_variant', status='running'
+            )
+            Variant.objects.create(experiment=experiment, key='control', rollout=1)
+            Variant.objects.create(experiment=experiment, key='treatment', rollout=1)
+        return project
+
+    def get(self, project, device_id):
+        request = RequestFactory().get(
+            '/api/experiments', {'device_id': device_id}, headers={'X-API-KEY': project.api_key}
+        )
+        request.project = project
+        response = UserExperimentsAPIView.as_view()(request).render()
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def count_queries(self, project, device_id):
+        # Activity is buffered, and written by the flusher thread apart from the request
+        with override_settings(USER_ACTIVITY_BUFFER=True), \
+                mock.patch.object(user_activity_service.user_activity_buffer, 'record'), \
+                CaptureQueriesContext(connection) as queries:
+            self.get(project, device_id)
+        return len(queries)
+
+    def test_queries_do_not_grow_with_the_experiments(self):
+        small, large = self.create_project(1), self.create_project(10)
+        # Builds the snapshots
+        for project in [small, large]:
+            self.get(project, 'warmup')
+
+        # New users
+        self.assertEqual(self.count_queries(small, 'new'), self.count_queries(large, 'new'))
+
+        # Known users, read with their distributions
+        self.assertEqual(self.count_queries(small, 'new'), 2)
+        self.assertEqual(self.count_queries(large, 'new'), 2)
+
+    def test_assignments_are_stable(self):
+        project = self.create_project(5)
+
+        data = self.get(project, 'device')
+        self.assertEqual(len(data['experiments']), 5)
+        self.assertEqual(self.get(project, 'device')['experiments'], data['experiments'])
+
+
+@unittest.skipUnless(settings.LIBRARY_ASYNC_VIEWS, "Requires the async library views")
+@override_settings(EVENT_BUFFER=False, USER_ACTIVITY_BUFFER=False)
+class AsyncLibraryViewTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.headers = {'X-API-KEY': self.project.api_key}
+        for key in ['first', 'second']:
+            experiment = Experiment.objects.create(
+                key=key, name=key, project=self.project, type='multiple_variant', status='running'
+            )
+            Variant.objects.create(experiment=experiment, key='control', rollout=1)
+            Variant.objects.create(experiment=experiment, key='treatment', rollout=1)
+
+    async def test_user_experiments(self):
+        response = await self.async_client.get('/api/experiments', {'device_id': 'device'}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['experiments']), 2)
+
+        # Answered from the assignment token, then from the ETag
+        again = await self.async_client.get('/api/experiments', {'device_id': 'device'}, headers={
+            **self.headers, 'X-Assignment-Token': response['X-Assignment-Token']
+        })
+        self.assertEqual(again.json(), data)
+        not_modified = await self.async_client.get('/api/experiments', {'device_id': 'device'}, headers={
+            **self.headers, 'If-None-Match': response['ETag']
+        })
+        self.assertEqual(not_modified.status_code, 304)
+
+    async def test_matches_the_drf_view(self):
+        response = await self.async_client.get('/api/experiments', {'device_id': 'device'}, headers=self.headers)
+
+        request = RequestFactory().get('/api/experiments', {'device_id': 'device'}, headers=self.headers)
+        request.project = self.project
+        drf_response = await sync_to_async(lambda: UserExperimentsAPIView.as_view()(request).render())()
+        self.assertEqual(response.json(), json.loads(drf_response.content))
+
+    async def test_experiment_variant(self):
+        experiments = (await self.async_client.get(
+            '/api/experiments', {'device_id': 'device'}, headers=self.headers
+        )).json()['experiments']
+
+        response = await self.async_client.get(
+            '/api/experiments/first/variant', {'device_id': 'device'}, headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(response.json(), experiments)
+
+        missing = await self.async_client.get(
+            '/api/experiments/missing/variant', {'device_id': 'device'}, headers=self.headers
+        )
+        self.assertEqual(missing.status_code, 404)
+
+    async def test_identify(self):
+        response = await self.async_client.post(
+            '/api/users/identify', {'device_id': 'device', 'email': 'user@example.com'},
+            content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['email'], 'user@example.com')
+
+        invalid = await self.async_client.post(
+            '/api/users/identify', '{', content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(invalid.status_code, 400)
+
+    async def test_events(self):
+        response = await self.async_client.post(
+            '/api/events', {'events': [{'device_id': 'device', 'name': 'purchase', 'value': 10}]},
+            content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(await Event.objects.filter(project=self.project).acount(), 1)
+
+    async def test_invalid_api_key(self):
+        response = await self.async_client.get('/api/experiments', {'device_id': 'device'}, headers={
+            'X-API-KEY': 'invalid'
+        })
+        self.assertEqual(response.status_code, 401)
+
+
+@override_settings(USER_ACTIVITY_BUFFER=False, EXPORT_CHUNK_SIZE=2)
+class ExportTests(TestCase):
+    fields = ['device_id', 'properties']
+
+    def setUp(self):
+        self.project = create_project()
+        for i in range(5):
+            ProjectUser.objects.create(project=self.project, device_id=f"device-{i}", properties={'index': i})
+        self.queryset = ProjectUser.objects.filter(project=self.project).order_by('device_id')
+
+    def export(self, export_format):
+        response = streaming_export(RequestFactory().get('/'), self.queryset, self.fields, export_format, 'users')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="users.{export_format}"')
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_ndjson(self):
+        response, content = self.export('ndjson')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(line) for line in content.splitlines()],
+            [{'device_id': f"device-{i}", 'properties': {'index': i}} for i in range(5)]
+        )
+
+    def test_csv(self):
+        response, content = self.export('csv')
+
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = content.splitlines()
+        self.assertEqual(lines[0], 'device_id,properties')
+        self.assertEqual(lines[1], 'device-0,"{""index"": 0}"')
+        self.assertEqual(len(lines), 6)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.export('xml')
+
+    def test_streams_asynchronously_under_asgi(self):
+        response = streaming_export(AsyncRequestFactory().get('/'), self.queryset, self.fields, 'ndjson', 'users')
+
+        self.assertTrue(response.is_async)
+
+    async def test_closes_the_cursor_when_the_client_disconnects(self):
+        threads = []
+        iterator = QuerySet.iterator
+
+        def tracked_iterator(queryset, *args, **kwargs):
+            threads.append(threading.get_ident())
+            try:
+                yield from iterator(queryset, *args, **kwargs)
+            finally:
+                threads.append(threading.get_ident())
+
+        with mock.patch.object(QuerySet, 'iterator', tracked_iterator):
+            lines = aiter_export(self.queryset, self.fields, 'ndjson')
+            first = await anext(lines)
+            await lines.aclose()
+
+        self.assertEqual(json.loads(first)['device_id'], 'device-0')
+        # Opened and closed in the same thread, not left to the garbage collector
+        self.assertEqual(len(threads), 2)
+        self.assertEqual(threads[0], threads[1])
+
+
+@override_settings(ASSIGNMENT_STORE=False, USER_ACTIVITY_BUFFER=False)
+class AssignmentModeTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.users = [ProjectUser.objects.create(project=self.project, device_id=f"device-{i}") for i in range(20)]
+        # Keeps deferred assignments in the buffer, without the background flusher
+        patcher = mock.patch.object(variant_service.assignment_buffer, '_start_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(variant_service.assignment_buffer._pending.clear)
+
+    def create_experiment(self, assignment):
+        experiment = Experiment.objects.create(
+            key=assignment, name=assignment, project=self.project, type='multiple_variant', status='running',
+            assignment=assignment
+        )
+        for index, rollout in enumerate([0.3, 0.7]):
+            Variant.objects.create(experiment=experiment, key=f"variant-{index}", rollout=rollout)
+        return compile_experiment(Experiment.objects.prefetch_related('variants').get(id=experiment.id))
+
+    def variant_ids(self, experiment):
+        variants = variant_service.get_or_create_distributions(self.users, [experiment])
+        return {pair: variant.id for pair, variant in variants.items()}
+
+    def test_stateless_assignments_are_stable_and_not_written(self):
+        experiment = self.create_experiment('stateless')
+
+        first = self.variant_ids(experiment)
+        self.assertEqual(len(first), len(self.users))
+        self.assertEqual(self.variant_ids(experiment), first)
+        for (user_id, _), variant_id in first.items():
+            self.assertEqual(experiment.assign(user_id).id, variant_id)
+        self.assertFalse(Distribution.objects.filter(experiment_id=experiment.id).exists())
+        self.assertFalse(variant_service.assignment_buffer._pending)
+
+    def test_deferred_assignments_are_written_with_the_served_variant(self):
+        experiment = self.create_experiment('deferred')
+
+        served = self.variant_ids(experiment)
+        self.assertFalse(Distribution.objects.filter(experiment_id=experiment.id).exists())
+        self.assertEqual(len(variant_service.assignment_buffer._pending), len(self.users))
+
+        self.assertEqual(variant_service.flush_assignments(), len(self.users))
+        written = Distribution.objects.filter(experiment_id=experiment.id).values_list('user_id', 'variant_id')
+        self.assertEqual({(user_id, experiment.id): variant_id for user_id, variant_id in written}, served)
+        self.assertEqual(self.variant_ids(experiment), served)
+        self.assertFalse(variant_service.assignment_buffer._pending)
+
+    def test_distributions_override_computed_assignments(self):
+        for assignment in ['stateless', 'deferred']:
+            with self.subTest(assignment=assignment):
+                experiment = self.create_experiment(assignment)
+                user = self.users[0]
+                other = next(variant for variant in experiment.variants if variant.id != experiment.assign(user.id).id)
+                Distribution.objects.create(user=user, experiment_id=experiment.id, variant_id=other.id)
+
+                self.assertEqual(self.variant_ids(experiment)[(user.id, experiment.id)], other.id)
+                self.assertEqual(async_to_sync(variant_service.aget_or_assign_variant)(user, experiment).id, other.id)
+
+    def test_async_assignments_match(self):
+        for assignment in ['stateless', 'deferred']:
+            with self.subTest(assignment=assignment):
+                experiment = self.create_experiment(assignment)
+                served = self.variant_ids(experiment)
+
+                for user in self.users:
+                    variant = async_to_sync(variant_service.aget_or_assign_variant)(user, experiment)
+                    self.assertEqual(variant.id, served[(user.id, experiment.id)])
+
+
+@unittest.skipUnless(
+    settings.CACHES['default']['BACKEND'].startswith('django_redis.'), "Requires Redis as the default cache"
+)
+@override_settings(ASSIGNMENT_STORE=True, USER_ACTIVITY_BUFFER=False)
+class AssignmentStoreTests(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.users = [ProjectUser.objects.create(project=self.project, device_id=f"device-{i}") for i in range(10)]
+        self.experiment = self.create_experiment('stored')
+        # New assignments stay queued, without the background flusher
+        patcher = mock.patch.object(variant_service.assignment_buffer, '_start_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.clear_store)
+
+    def clear_store(self):
+        experiment_ids = Experiment.objects.filter(project=self.project).values_list('id', flat=True)
+        pairs = [(user.id, experiment_id) for user in self.users for experiment_id in experiment_ids]
+        assignment_store.delete_assignments(pairs)
+        members = [f"{user_id}:{experiment_id}" for user_id, experiment_id in pairs]
+        get_redis_connection('default').srem(assignment_store.PENDING_KEY, *members)
+
+    def create_experiment(self, assignment):
+        experiment = Experiment.objects.create(
+            key=assignment, name=assignment, project=self.project, type='multiple_variant', status='running',
+            assignment=assignment
+        )
+        for index, rollout in enumerate([0.5, 0.5]):
+            Variant.objects.create(experiment=experiment, key=f"variant-{index}", rollout=rollout)
+        return compile_experiment(Experiment.objects.prefetch_related('variants').get(id=experiment.id))
+
+    def variant_ids(self, experiment=None):
+        experiment = experiment or self.experiment
+        variants = variant_service.get_or_create_distributions(self.users, [experiment])
+        return {pair: variant.id for pair, variant in variants.items()}
+
+    def stored(self, experiment=None):
+        experiment = experiment or self.experiment
+        return assignment_store.get_assignments([user.id for user in self.users], [experiment.id])
+
+    def test_serves_new_assignments_from_the_store(self):
+        served = self.variant_ids()
+
+        self.assertEqual(len(served), len(self.users))
+        self.assertEqual(self.stored(), served)
+        self.assertFalse(Distribution.objects.filter(experiment_id=self.experiment.id).exists())
+        with self.assertNumQueries(0):
+            self.assertEqual(self.variant_ids(), served)
+
+    def test_flush_writes_the_served_variants(self):
+        served = self.variant_ids()
+
+        variant_service.flush_assignments()
+
+        written = Distribution.objects.filter(experiment_id=self.experiment.id).values_list('user_id', 'variant_id')
+        self.assertEqual({(user_id, self.experiment.id): variant_id for user_id, variant_id in written}, served)
+        self.assertEqual(self.stored(), served)
+        self.assertEqual(self.variant_ids(), served)
+
+    def test_copies_distributions_into_the_store(self):
+        variant = self.experiment.variants[0]
+        # Without the signals, as if written before the store was enabled
+        Distribution.objects.bulk_create([
+            Distribution(user=user, experiment_id=self.experiment.id, variant_id=variant.id) for user in self.users
+        ])
+
+        expected = {(user.id, self.experiment.id): variant.id for user in self.users}
+        self.assertEqual(self.variant_ids(), expected)
+        self.assertEqual(self.stored(), expected)
+
+    def test_saved_distributions_update_the_store(self):
+        self.variant_ids()
+        variant_service.flush_assignments()
+        distribution = Distribution.objects.filter(experiment_id=self.experiment.id).first()
+        other = next(variant for variant in self.experiment.variants if variant.id != distribution.variant_id)
+
+        distribution.variant_id = other.id
+        with self.captureOnCommitCallbacks(execute=True):
+            distribution.save()
+
+        self.assertEqual(self.variant_ids()[(distribution.user_id, self.experiment.id)], other.id)
+
+    def test_recalculations_update_the_store(self):
+        self.variant_ids()
+        variant_service.flush_assignments()
+        # Everyone moves to the second variant, without the variant signals
+        Variant.objects.filter(id=self.experiment.variants[0].id).update(rollout=0)
+
+        with mock.patch.object(recalculation_service, 'bump_config_version'), \
+                self.captureOnCommitCallbacks(execute=True):
+            recalculation_service.recalculate_experiment_distributions(Experiment.objects.get(id=self.experiment.id))
+
+        second = self.experiment.variants[1].id
+        self.assertEqual(set(self.stored().values()), {second})
+        self.assertEqual(
+            set(Distribution.objects.filter(experiment_id=self.experiment.id).values_list('variant_id', flat=True)),
+            {second}
+        )
+
+    def test_stateless_assignments_are_not_stored(self):
+        experiment = self.create_experiment('stateless')
+
+        served = self.variant_ids(experiment)
+        self.assertEqual(len(served), len(self.users))
+        self.assertEqual(self.stored(experiment), {})
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenRefreshView
@@ -9,12 +10,33 @@ from experiments.admin_views import (
     AdminProjectUserViewSet,
     AdminDistributionViewSet
 )
+from experiments.async_library_views import (
+    AsyncEventIngestionView,
+    AsyncExperimentVariantView,
+    AsyncUserExperimentsView,
+    AsyncUserIdentifyView
+)
 from experiments.library_views import (
     ExperimentVariantAPIView,
-    UserExperimentsAPIView, UserIdentifyAPIView
+    UserExperimentsAPIView, UserIdentifyAPIView,
+    BatchEvaluationAPIView,
+    EventIngestionAPIView,
+    ServiceMetricsAPIView
 )
 from experiments.token_views import CustomTokenObtainPairView
 
+# Library endpoints run natively async on ASGI, the DRF views are the fallback
+if settings.LIBRARY_ASYNC_VIEWS:
+    experiment_variant_view = AsyncExperimentVariantView.as_view()
+    user_experiments_view = AsyncUserExperimentsView.as_view()
+    user_identify_view = AsyncUserIdentifyView.as_view()
+    event_ingestion_view = AsyncEventIngestionView.as_view()
+else:
+    experiment_variant_view = ExperimentVariantAPIView.as_view()
+    user_experiments_view = UserExperimentsAPIView.as_view()
+    user_identify_view = UserIdentifyAPIView.as_view()
+    event_ingestion_view = EventIngestionAPIView.as_view()
+
 # Create a router for admin viewsets
 admin_router = DefaultRouter()
 admin_router.register(r'projects', AdminProjectViewSet)
@@ -40,17 +62,34 @@ urlpatterns = [
     # Library API endpoints (API key protected)
     path(
         'experiments/<str:experiment_key>/variant',
-        ExperimentVariantAPIView.as_view(),
+        experiment_variant_view,
         name='experiment_variant'
     ),
+    path(
+        'experiments/evaluate',
+        BatchEvaluationAPIView.as_view(),
+        name='batch_evaluation'
+    ),
     path(
         'experiments',
-        UserExperimentsAPIView.as_view(),
+        user_experiments_view,
         name='user_experiments'
     ),
     path(
         'users/identify',
-        UserIdentifyAPIView.as_view(),
+        user_identify_view,
         name='user_identify'
     ),
+    path(
+        'events',
+        event_ingestion_view,
+        name='event_ingestion'
+    ),
+
+    # Per-worker metrics for monitoring
+    path(
+        'metrics',
+        ServiceMetricsAPIView.as_view(),
+        name='service_metrics'
+    ),
 ]
\ No newline at end of file